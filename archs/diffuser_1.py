@@ -80,7 +80,7 @@ class Block(nn.Module):
     self.gn_v_nodes = VecGroupNorm(vdim, vgroups)
     self.gn_a_edges = ScalGroupNorm(adim, agroups)
     self.gn_v_edges = VecGroupNorm(vdim, vgroups)
-  def forward(self, tup):
+  def forward(self, tup, vec_only=False):
     a_node, v_node, a_edge, v_edge, graph, t = tup
     # pre conv:
     x_a_node = self.a_nodes_conv_0(a_node, graph)
@@ -90,29 +90,32 @@ class Block(nn.Module):
     # mix in the time embedding
     x_a_node = x_a_node + self.t_embed(t)
     # non-linearities:
-    y_a_node = self.a_node_layers(x_a_node)
-    y_a_edge = self.a_edge_layers(x_a_edge)
     y_v_node = self.v_node_layers(x_v_node)
     y_v_edge = self.v_edge_layers(x_v_edge)
-    prod_a_node, prod_v_node = self.av_node_prod(x_a_node, x_v_node)
-    prod_a_edge, prod_v_edge = self.av_node_prod(x_a_edge, x_v_edge)
-    z_a_node, z_v_node = y_a_node + prod_a_node, y_v_node + prod_v_node
-    z_a_edge, z_v_edge = y_a_edge + prod_a_edge, y_v_edge + prod_v_edge
+    prod_a_node, prod_v_node = self.av_node_prod(x_a_node, x_v_node, vec_only)
+    prod_a_edge, prod_v_edge = self.av_node_prod(x_a_edge, x_v_edge, vec_only)
+    z_v_node, z_v_edge = y_v_node + prod_v_node, y_v_edge + prod_v_edge
     # post conv:
-    z_a_node = z_a_node + self.a_edges_write(z_a_edge, graph)
     z_v_node = z_v_node + self.v_edges_write(z_v_edge, graph)
-    z_a_node = self.a_nodes_conv_1(z_a_node, graph)
     z_v_node = self.v_nodes_conv_1(z_v_node, graph)
     # groupnorms:
-    z_a_node = self.gn_a_nodes(z_a_node)
     z_v_node = self.gn_v_nodes(z_v_node)
-    z_a_edge = self.gn_a_edges(z_a_edge)
     z_v_edge = self.gn_v_edges(z_v_edge)
     # residual-style result:
-    out_a_node = a_node + z_a_node
     out_v_node = v_node + z_v_node
-    out_a_edge = a_edge + z_a_edge
     out_v_edge = v_edge + z_v_edge
+    if vec_only: # the scalar outputs are not used, so skip the layers that only feed them
+      return (None, out_v_node, None, out_v_edge, graph, t)
+    # same for the scalars:
+    y_a_node = self.a_node_layers(x_a_node)
+    y_a_edge = self.a_edge_layers(x_a_edge)
+    z_a_node, z_a_edge = y_a_node + prod_a_node, y_a_edge + prod_a_edge
+    z_a_node = z_a_node + self.a_edges_write(z_a_edge, graph)
+    z_a_node = self.a_nodes_conv_1(z_a_node, graph)
+    z_a_node = self.gn_a_nodes(z_a_node)
+    z_a_edge = self.gn_a_edges(z_a_edge)
+    out_a_node = a_node + z_a_node
+    out_a_edge = a_edge + z_a_edge
     return (out_a_node, out_v_node, out_a_edge, out_v_edge, graph, t)
 
 
@@ -122,12 +125,12 @@ class Model(nn.Module):
     adim, vdim = config["adim"], config["vdim"]
     self.node_enc = NodeRelativeEmbedMLP(adim, vdim)
     self.edge_enc = EdgeRelativeEmbedMLP(adim, vdim)
-    self.blocks = nn.Sequential(
+    self.blocks = BlockStack(config,
       Block(config),
       Block(config),
       Block(config),
-      Block(config))
-    # some wastage of compute here, since the final sets of scalar values are not really used
+      Block(config), vec_only=True)
+    # the final sets of scalar values are not used, so the last blocks skip computing them (vec_only)
     self.v_edges_write = VecEdgesWrite(vdim, vdim)
     self.lin_v_node = VecLinear(vdim, 1)
     self.out_norm_coeff = vdim**(-0.5)
@@ -139,7 +142,7 @@ class Model(nn.Module):
     a_edge, v_edge = self.edge_enc(pos0, noised, graph)
     a_node, v_node, a_edge, v_edge, *_ = self.blocks((a_node, v_node, a_edge, v_edge, graph, t))
     v_node = (v_node + self.v_edges_write(v_edge, graph))*INV_SQRT_2
-    return self.lin_v_node(v_node)[:, :, 0]*self.out_norm_coeff
+    return self.lin_v_node(v_node)[..., 0]*self.out_norm_coeff
 
 
 class Diffuser3D:
@@ -160,7 +163,7 @@ class Diffuser3D:
     r = torch.arange(n_nodes - 1, device=self.config.device)
     src = torch.cat([r, r + 1])
     dst = torch.cat([r + 1, r])
-    self.graph = Graph(src, dst, n_nodes)
+    self.graph = Graph(src, dst, n_nodes, backend=self.config.graph_backend)
   @staticmethod
   def load_from_dict(states, config):
     model = Model(config).to(config.device)
@@ -180,19 +183,26 @@ class Diffuser3D:
     batch,          must_be[nodes*3] = data.shape
     must_be[batch], must_be[nodes*3] = cond.shape
     return self._train_step(cond.reshape(-1, nodes, 3), data.reshape(-1, nodes, 3))
-  def _train_step(self, pos0, pos1):
+  def eval_loss(self, data, cond):
+    """ loss on data, without training. used for held-out evaluation """
+    nodes = self.graph.n_nodes
+    with torch.no_grad():
+      return self._loss(cond.reshape(-1, nodes, 3), data.reshape(-1, nodes, 3))
+  def _loss(self, pos0, pos1):
     batch, nodes, must_be[3] = pos0.shape
-    self.model.zero_grad()
     t = torch.rand(batch, device=self.config.device)
     sigma = self.config["z_scale"]*torch.sqrt(self.get_var(0.0, t))[:, None, None]
     noise = torch.randn_like(pos0)
     mu_coeff = self.get_mu_coeff(0.0, t)[:, None, None]
     noised = pos0 + sigma*noise + mu_coeff*(pos1 - pos0)
     pred_noise = self.model(pos0, noised, t, self.graph)
-    loss = ((noise - pred_noise)**2).sum((1, 2)).mean()
+    return ((noise - pred_noise)**2).sum((1, 2)).mean()
+  def _train_step(self, pos0, pos1):
+    self.model.zero_grad()
+    loss = self._loss(pos0, pos1)
     loss.backward()
     self.optim.step()
-    return loss.item()
+    return loss.detach()
   def predict(self, cond, gen_steps=80):
     batch, must_be[3*self.graph.n_nodes] = cond.shape
     return self._predict(cond.reshape(batch, self.graph.n_nodes, 3), gen_steps).reshape(batch, 3*self.graph.n_nodes)
@@ -241,7 +251,6 @@ class DiffuserTrainer:
     cond = self.model.config.cond(trajs[:, :-1].reshape(N*(L - 1), state_dim))
     data = trajs[:, 1:].reshape(N*(L - 1), state_dim)
     loss = self.model.train_step(data, cond)
-    print(f"{i}\t ℒ = {loss:05.6f}")
     self.board.scalar("loss", i, loss)
 
 
@@ -65,7 +65,7 @@ class Meanpred:
     loss = loss / batch # take the mean
     loss.backward()
     self.optim.step()
-    return loss.item()
+    return loss.detach()
   def predict(self, cond):
     with torch.no_grad():
       cond = cond.reshape(self.config.sim.poly_len, 3)
@@ -85,7 +85,6 @@ class MeanpredTrainer:
     cond = self.model.config.cond(trajs[:, :-1].reshape(N*(L - 1), state_dim))
     data = trajs[:, 1:].reshape(N*(L - 1), state_dim)
     loss = self.model.train_step(data, cond)
-    print(f"{i}\t ℒ = {loss:05.6f}")
     self.board.scalar("loss", i, loss)
 
 
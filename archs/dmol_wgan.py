@@ -5,7 +5,9 @@ import torch_geometric
 import e3nn
 from e3nn.nn.models.gate_points_2101 import Network
 
-from gan_common import GANTrainer
+from utils import must_be
+from gan_common import GANTrainer, n_disc_points, disc_points, fused_disc_eval, pairwise_endpoint_penalty
+from precision import float32
 
 
 # This example from https://dmol.pub/applied/e3nn_traj.html
@@ -25,7 +27,7 @@ gen_kwargs = {
     "radial_layers": 1,
     "radial_neurons": 128,
     "num_neighbors": 11,  # average number of neighbors w/in max_radius
-    "num_nodes": 12,  # not important unless reduce_output is True
+    "num_nodes": 12,  # not important unless reduce_output is True, set from the config by network_kwargs()
     "reduce_output": False,  # setting this to true would give us one scalar as an output.
 }
 
@@ -41,34 +43,48 @@ disc_kwargs = {
     "radial_layers": 1,
     "radial_neurons": 128,
     "num_neighbors": 11,  # average number of neighbors w/in max_radius
-    "num_nodes": 12,  # not important unless reduce_output is True
+    "num_nodes": 12,  # not important unless reduce_output is True, set from the config by network_kwargs()
     "reduce_output": True,  # reduce output to a single scalar!
 }
 
 
+def network_kwargs(kwargs, config):
+  """ kwargs for an e3nn Network, for the polymer length of config """
+  return dict(kwargs, num_nodes=config.sim.poly_len)
+
+def batch_graph(x, pos):
+  """ put a batch of graphs into one torch_geometric Data object, so the whole batch goes through a Network in
+      one call. the Network builds its radius graph separately for each graph in the batch.
+      x: (batch, nodes, ...)
+      pos: (batch, nodes, 3) """
+  batch, nodes, must_be[3] = pos.shape
+  batch_index = torch.arange(batch, device=pos.device).repeat_interleave(nodes)
+  return torch_geometric.data.Data(x=x.reshape(batch*nodes, *x.shape[2:]), pos=pos.reshape(batch*nodes, 3), batch=batch_index, y=None)
+
+
 class GAN:
   is_gan = True
   def __init__(self, disc, gen, config):
     self.disc = disc
     self.gen = gen
     self.config = config
+    self.n_nodes = config.sim.poly_len
     self.init_optim()
-    assert config.sim.poly_len == 12
   def init_optim(self):
     betas = (self.config["beta_1"], self.config["beta_2"])
     self.optim_d = torch.optim.Adam(self.disc.parameters(), self.config["lr_d"], betas)
     self.optim_g = torch.optim.Adam(self.gen.parameters(), self.config["lr_g"], betas)
   @staticmethod
   def load_from_dict(states, config):
-    disc = e3nn.nn.models.gate_points_2101.Network(**disc_kwargs).to(config.device)
-    gen = e3nn.nn.models.gate_points_2101.Network(**gen_kwargs).to(config.device)
+    disc = e3nn.nn.models.gate_points_2101.Network(**network_kwargs(disc_kwargs, config)).to(config.device)
+    gen = e3nn.nn.models.gate_points_2101.Network(**network_kwargs(gen_kwargs, config)).to(config.device)
     disc.load_state_dict(states["disc"])
     gen.load_state_dict(states["gen"])
     return GAN(disc, gen, config)
   @staticmethod
   def makenew(config):
-    disc = e3nn.nn.models.gate_points_2101.Network(**disc_kwargs).to(config.device)
-    gen = e3nn.nn.models.gate_points_2101.Network(**gen_kwargs).to(config.device)
+    disc = e3nn.nn.models.gate_points_2101.Network(**network_kwargs(disc_kwargs, config)).to(config.device)
+    gen = e3nn.nn.models.gate_points_2101.Network(**network_kwargs(gen_kwargs, config)).to(config.device)
     return GAN(disc, gen, config)
   def save_to_dict(self):
     return {
@@ -76,7 +92,7 @@ class GAN:
         "gen": self.gen.state_dict(),
       }
   def train_step(self, data, cond):
-    data, cond = data.reshape(-1, 12, 3), cond.reshape(-1, 12, 3)
+    data, cond = data.reshape(-1, self.n_nodes, 3), cond.reshape(-1, self.n_nodes, 3)
     loss_d = self.disc_step(data, cond)
     loss_g = self.gen_step(cond)
     return loss_d, loss_g
@@ -85,30 +101,21 @@ class GAN:
     # train on real data (with instance noise)
     instance_noise_r = self.config["inst_noise_str_r"]*torch.randn_like(data)
     r_data = data + instance_noise_r # instance noise
-    y_r = self.eval_disc(cond, r_data)
     # train on generated data (with instance noise)
     g_data = self.eval_gen(cond)
     instance_noise_g = self.config["inst_noise_str_g"]*torch.randn_like(g_data)
     g_data = g_data + instance_noise_g # instance noise
-    y_g = self.eval_disc(cond, g_data)
-    # endpoint penalty on interpolated data
-    mix_factors1 = torch.rand(cond.shape[0], 1, 1, device=self.config.device)
-    mixed_data1 = mix_factors1*g_data + (1 - mix_factors1)*r_data
-    y_mixed1 = self.eval_disc(cond, mixed_data1)
-    mix_factors2 = torch.rand(cond.shape[0], 1, 1, device=self.config.device)
-    mixed_data2 = mix_factors2*g_data + (1 - mix_factors2)*r_data
-    y_mixed2 = self.eval_disc(cond, mixed_data2)
-    ep_penalty = (self.endpoint_penalty(r_data, g_data, y_r, y_g)
-                + self.endpoint_penalty(mixed_data1, r_data, y_mixed1, y_r)
-                + self.endpoint_penalty(g_data, mixed_data1, y_g, y_mixed1)
-                + self.endpoint_penalty(mixed_data2, r_data, y_mixed2, y_r)
-                + self.endpoint_penalty(g_data, mixed_data2, y_g, y_mixed2)
-                + self.endpoint_penalty(mixed_data1, mixed_data2, y_mixed1, y_mixed2))
+    # evaluate discriminator on real data, generated data and interpolants between them, all in one batch
+    x = disc_points(r_data, g_data, n_disc_points(self.config))
+    y = fused_disc_eval(self.eval_disc, cond, x)
+    y_r, y_g = y[0], y[1]
+    # endpoint penalty between each pair of points
+    ep_penalty = pairwise_endpoint_penalty(self.endpoint_penalty, x, y)
     # loss, backprop, update
     loss = ep_penalty.mean() + y_r.mean() - y_g.mean()
     loss.backward()
     self.optim_d.step()
-    return loss.item()
+    return loss.detach()
   def gen_step(self, cond):
     self.optim_g.zero_grad()
     g_data = self.eval_gen(cond)
@@ -118,35 +125,27 @@ class GAN:
     loss = y_g.mean()
     loss.backward()
     self.optim_g.step()
-    return loss.item()
+    return loss.detach()
+  @float32
   def endpoint_penalty(self, x1, x2, y1, y2):
-    dist = torch.sqrt(((x1 - x2)**2).mean(1))
+    dist = torch.sqrt(((x1 - x2)**2).sum(2).mean(1))
     # one-sided L1 penalty:
     penalty = F.relu(torch.abs(y1 - y2)/(dist*k_L + 1e-6) - 1.)
     # weight by square root of separation
     return torch.sqrt(dist)*penalty
   def eval_gen(self, cond):
-    batch = cond.shape[0]
-    ans = []
-    for i in range(batch):
-      noise = NOISE_IRREPS.randn(12, -1, device=self.config.device)
-      tg_cond = torch_geometric.data.Data(x=noise, pos=cond[i], y=None)
-      delta = self.gen(tg_cond)
-      ans.append(cond[i] + delta)
-    return torch.stack(ans, dim=0)
+    batch, must_be[self.n_nodes], must_be[3] = cond.shape
+    noise = NOISE_IRREPS.randn(batch, self.n_nodes, -1, device=self.config.device)
+    delta = self.gen(batch_graph(noise, cond))
+    return cond + delta.reshape(batch, self.n_nodes, 3)
   def eval_disc(self, cond, data):
-    batch = cond.shape[0]
-    ans = []
-    for i in range(batch):
-      delta = data[i] - cond[i]
-      tg_cond = torch_geometric.data.Data(x=delta, pos=cond[i], y=None)
-      y = self.disc(tg_cond)
-      ans.append(y)
-    return torch.stack(ans, dim=0)
+    batch, must_be[self.n_nodes], must_be[3] = cond.shape
+    y = self.disc(batch_graph(data - cond, cond)) # (batch, 1)
+    return y[:, 0]
   def predict(self, cond):
     with torch.no_grad():
-      ans = self.eval_gen(cond.reshape(-1, 12, 3))
-      return ans.reshape(-1, 36)
+      ans = self.eval_gen(cond.reshape(-1, self.n_nodes, 3))
+      return ans.reshape(-1, 3*self.n_nodes)
   def set_eval(self, *args):
     pass
 
@@ -160,7 +159,6 @@ class MeanpredTrainer:
     cond = self.model.config.cond(trajs[:, :-1].reshape(N*(L - 1), state_dim))
     data = trajs[:, 1:].reshape(N*(L - 1), state_dim)
     loss = self.model.train_step(data, cond)
-    print(f"{i}\t ℒ = {loss:05.6f}")
     self.board.scalar("loss", i, loss)
 
 
@@ -5,6 +5,7 @@ import e3nn
 
 from config import Condition
 from utils import must_be
+from precision import vector_norm
 from layers_common import *
 
 
@@ -30,17 +31,18 @@ class VecConv1d(nn.Module):
     if edges_to_nodes:
       assert kernsz % 2 == 0
       self.conv = nn.Conv1d(chan, chan, kernsz, padding=(kernsz//2), bias=False)
+      self.padding = (kernsz//2, 0)
     else:
       assert kernsz % 2 == 1
       self.conv = nn.Conv1d(chan, chan, kernsz, padding="same", bias=False)
+      self.padding = "same"
   def forward(self, x):
-    """ x: (batch, length, chan, 3) """
-    batch, length, chan, must_be[3] = x.shape
-    x = x.permute(0, 3, 2, 1).reshape(3*batch, chan, length) # (batch*3, chan, length)
-    y = self.conv(x)
-    must_be[batch*3], must_be[chan], newlength = y.shape # length might have changed!
-    y = y.reshape(batch, 3, chan, newlength).permute(0, 3, 2, 1) # (batch, newlength, chan, 3)
-    return y
+    """ x: (batch, length, 3, chan) """
+    batch, length, must_be[3], chan = x.shape
+    # (batch, chan, length, 3) view of x is channels_last, so conv2d with a (kernsz, 1) kernel needs no copy
+    y = F.conv2d(x.permute(0, 3, 1, 2), self.conv.weight[..., None], padding=self.padding)
+    must_be[batch], must_be[chan], newlength, must_be[3] = y.shape # length might have changed!
+    return y.permute(0, 2, 3, 1) # (batch, newlength, 3, chan)
 
 class EdgeRelativeEmbedMLPPath(nn.Module):
   """ input embedding for edges, where 2 positions are passed as input.
@@ -59,7 +61,7 @@ class EdgeRelativeEmbedMLPPath(nn.Module):
         pos1: (batch, nodes, 3)
         return: tuple(a_out, v_out)
         a_out: (batch, nodes, adim)
-        v_out: (batch, nodes, vdim, 3) """
+        v_out: (batch, nodes, 3, vdim) """
     batch,          nodes,          must_be[3] = pos_0.shape
     must_be[batch], must_be[nodes], must_be[3] = pos_1.shape
     vecs = torch.stack([ # 4 relative vectors
@@ -67,8 +69,8 @@ class EdgeRelativeEmbedMLPPath(nn.Module):
         pos_1[:,  1:] - pos_1[:, :-1],
         pos_1[:, :-1] - pos_0[:,  1:],
         pos_1[:,  1:] - pos_0[:, :-1],
-      ], dim=2) # (batch, nodes - 1, 4, 3)
-    norms = torch.linalg.vector_norm(vecs, dim=-1) # (batch, nodes - 1, 4)
+      ], dim=3) # (batch, nodes - 1, 3, 4)
+    norms = vector_norm(vecs, dim=2) # (batch, nodes - 1, 4)
     y_a = self.scalar_layers(norms)
     y_v = self.lin_v(vecs)
     a_out = self.conv_a(y_a)
@@ -96,11 +98,15 @@ class LocalResidual(nn.Module):
     self.av_prod = ScalVecProducts(adim, vdim, rank)
     self.gnorm_a = ScalGroupNorm(adim, agroups)
     self.gnorm_v = VecGroupNorm(vdim, vgroups)
-  def forward(self, x_a, x_v):
-    y_a = self.layers_a(x_a)
+  def forward(self, x_a, x_v, vec_only=False):
+    """ vec_only: skip the scalar output, return None in its place """
     y_v = self.layers_v(x_v)
-    p_a, p_v = self.av_prod(x_a, x_v)
-    z_a, z_v = self.gnorm_a(y_a + p_a), self.gnorm_v(y_v + p_v)
+    p_a, p_v = self.av_prod(x_a, x_v, vec_only)
+    z_v = self.gnorm_v(y_v + p_v)
+    if vec_only:
+      return None, (x_v + z_v)
+    y_a = self.layers_a(x_a)
+    z_a = self.gnorm_a(y_a + p_a)
     return (x_a + z_a), (x_v + z_v)
 
 class Block(nn.Module):
@@ -121,14 +127,16 @@ class Block(nn.Module):
     emb_edge_a, emb_edge_v = self.edge_embed(pos_0, pos_1)
     emb_node_a, emb_node_v = self.node_embed(pos_0, pos_1)
     return emb_edge_a + emb_node_a, emb_edge_v + emb_node_v
-  def forward(self, tup):
+  def forward(self, tup, vec_only=False):
     pos_0, pos_1, x_a, x_v = tup
     emb_a, emb_v = self.get_embedding(pos_0, pos_1)
     y_a = self.conv_0_a(x_a) + emb_a
     y_v = self.conv_0_v(x_v) + emb_v
-    y_a, y_v = self.local_res(y_a, y_v)
-    z_a = self.gnorm_a(self.conv_1_a(y_a))
+    y_a, y_v = self.local_res(y_a, y_v, vec_only)
     z_v = self.gnorm_v(self.conv_1_v(y_v))
+    if vec_only:
+      return pos_0, pos_1, None, (x_v + z_v)
+    z_a = self.gnorm_a(self.conv_1_a(y_a))
     return pos_0, pos_1, (x_a + z_a), (x_v + z_v)
 
 class Meanpred(nn.Module):
@@ -136,18 +144,18 @@ class Meanpred(nn.Module):
     super().__init__()
     adim, vdim = config["adim"], config["vdim"]
     self.node_enc = NodeRelativeEmbedMLP(adim, vdim)
-    self.blocks = nn.Sequential(
+    self.blocks = BlockStack(config,
       Block(config),
       Block(config),
-      Block(config))
-    # some wastage of compute here, since the final sets of scalar values are not really used
+      Block(config), vec_only=True)
+    # the final sets of scalar values are not used, so the last blocks skip computing them (vec_only)
     self.lin_v_vel = VecLinear(vdim, 1)
     self.lin_v_pos = VecLinear(vdim, 1)
     self.out_norm_coeff = vdim**(-0.5)
   def _predict(self, pos0, vel0):
     x_a, x_v = self.node_enc(pos0, pos0 + vel0)
     *_, y_v = self.blocks((pos0, pos0 + vel0, x_a, x_v))
-    return self.lin_v_pos(y_v)[:, :, 0]*self.out_norm_coeff, self.lin_v_vel(y_v)[:, :, 0]*self.out_norm_coeff
+    return self.lin_v_pos(y_v)[..., 0]*self.out_norm_coeff, self.lin_v_vel(y_v)[..., 0]*self.out_norm_coeff
   def forward(self, pos0, vel0):
     pred_dpos, pred_vel = self._predict(pos0, vel0)
     return pos0 + pred_dpos, pred_vel
@@ -207,7 +215,7 @@ class MeanpredModel:
     loss = loss_x + loss_v
     loss.backward()
     self.optim.step()
-    return loss_x, loss_v
+    return loss_x.detach(), loss_v.detach()
   def predict(self, cond):
     x0, v0 = self._to_internal_shape(cond)
     with torch.no_grad():
@@ -231,7 +239,6 @@ class MeanpredTrainer:
     data = trajs[:, 1:].reshape(N*(L - 1), state_dim)
     loss_x, loss_v = self.model.train_step(data, cond)
     loss = loss_x + loss_v
-    print(f"{i}\t ℒx = {loss_x:05.6f}\t ℒv = {loss_v:05.6f}\t ℒ = {loss:05.6f}")
     self.board.scalar("loss_x", i, loss_x)
     self.board.scalar("loss_v", i, loss_v)
     self.board.scalar("loss", i, loss)
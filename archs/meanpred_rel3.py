@@ -62,7 +62,7 @@ class MeanpredModel:
     loss = ((data - y_hat)**2).sum(1).mean(0)
     loss.backward()
     self.optim.step()
-    return loss.item()
+    return loss.detach()
   def predict(self, cond):
     with torch.no_grad():
       y_hat = self.meanpred(cond)
@@ -82,7 +82,6 @@ class MeanpredTrainer:
     cond = self.model.config.cond(trajs[:, :-1].reshape(N*(L - 1), state_dim))
     data = trajs[:, 1:].reshape(N*(L - 1), state_dim)
     loss = self.model.train_step(data, cond)
-    print(f"{i}\t ℒ = {loss:05.6f}")
     self.board.scalar("loss", i, loss)
 
 
@@ -58,6 +58,7 @@ class KoopmanModel:
     self.trans_1 = trans_1
     self.S = S
     self.config = config
+    self.ensemble_size = 1 # set by ensemble.Ensemble when several replicas are trained together
     self.init_optim()
   def init_optim(self):
     self.optim = torch.optim.Adam(self.model.parameters(),
@@ -83,14 +84,16 @@ class KoopmanModel:
     N, L, in_dim = trajs.shape
     self.model.zero_grad()
     chi = self.model(trajs.reshape(N*L, in_dim)).reshape(N, L, -1)
-    chi_0 = chi[:, :-1].reshape(N*(L - 1), -1)
-    chi_1 = chi[:, 1: ].reshape(N*(L - 1), -1)
-    loss = -vamp_score(chi_0, chi_1)
-    loss_wd = res_layers_weight_decay(self.model, coeff=self.config["wd"])
+    # vamp score is not a mean over samples, so for ensembles we compute it separately for each replica's data
+    G = self.ensemble_size
+    chi_0 = chi[:, :-1].reshape(G, (N//G)*(L - 1), -1)
+    chi_1 = chi[:, 1: ].reshape(G, (N//G)*(L - 1), -1)
+    loss = -sum(vamp_score(chi_0[g], chi_1[g]) for g in range(G))/G
+    loss_wd = res_layers_weight_decay(self.model, coeff=self.config["wd"])/G
     total_loss = loss + loss_wd
     total_loss.backward()
     self.optim.step()
-    return loss.item(), loss_wd.item()
+    return loss.detach(), loss_wd.detach()
   def calculate_transforms(self, dataset):
     N, L, in_dim = dataset.shape
     assert in_dim == self.config.state_dim
@@ -141,7 +144,6 @@ class KoopmanTrainer:
   def step(self, i, trajs):
     loss, loss_wd = self.model.train_step(trajs)
     loss_tot = loss + loss_wd
-    print(f"{i}\t ℒ = {loss:05.6f}\t ℒᵂᴰ = {loss_wd:05.6f}\tℒᵀᴼᵀ = {loss_tot:05.6f}")
     self.board.scalar("loss", i, loss)
     self.board.scalar("loss_wd", i, loss_wd)
     self.board.scalar("loss_tot", i, loss_tot)
@@ -149,6 +151,13 @@ class KoopmanTrainer:
       self.final_tuning_data.append(trajs)
     if i + 1 == self.model.config.nsteps:
       self.perform_final_tuning()
+  def finish(self):
+    """ called by train() if training stops before config.nsteps """
+    self.perform_final_tuning()
+  def save_to_dict(self):
+    return {"final_tuning_data": self.final_tuning_data}
+  def load_from_dict(self, states):
+    self.final_tuning_data = [trajs.to(self.model.config.device) for trajs in states["final_tuning_data"]]
   def perform_final_tuning(self):
     print("performing final tuning of the model's transforms...")
     # combine tuning data into one big batch
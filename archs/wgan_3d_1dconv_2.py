@@ -5,7 +5,8 @@ import e3nn
 
 from config import Condition
 from utils import must_be
-from gan_common import GANTrainer
+from precision import float32, vector_norm
+from gan_common import GANTrainer, disc_and_gen_steps, n_disc_points, disc_points, fused_disc_eval, pairwise_endpoint_penalty
 from layers_common import *
 
 
@@ -43,17 +44,18 @@ class VecConv1d(nn.Module):
     if edges_to_nodes:
       assert kernsz % 2 == 0
       self.conv = nn.Conv1d(chan, chan, kernsz, padding=(kernsz//2), bias=False)
+      self.padding = (kernsz//2, 0)
     else:
       assert kernsz % 2 == 1
       self.conv = nn.Conv1d(chan, chan, kernsz, padding="same", bias=False)
+      self.padding = "same"
   def forward(self, x):
-    """ x: (batch, length, chan, 3) """
-    batch, length, chan, must_be[3] = x.shape
-    x = x.permute(0, 3, 2, 1).reshape(3*batch, chan, length) # (batch*3, chan, length)
-    y = self.conv(x)
-    must_be[batch*3], must_be[chan], newlength = y.shape # length might have changed!
-    y = y.reshape(batch, 3, chan, newlength).permute(0, 3, 2, 1) # (batch, newlength, chan, 3)
-    return y
+    """ x: (batch, length, 3, chan) """
+    batch, length, must_be[3], chan = x.shape
+    # (batch, chan, length, 3) view of x is channels_last, so conv2d with a (kernsz, 1) kernel needs no copy
+    y = F.conv2d(x.permute(0, 3, 1, 2), self.conv.weight[..., None], padding=self.padding)
+    must_be[batch], must_be[chan], newlength, must_be[3] = y.shape # length might have changed!
+    return y.permute(0, 2, 3, 1) # (batch, newlength, 3, chan)
 
 
 class EdgeRelativeEmbedMLPPath(nn.Module):
@@ -73,7 +75,7 @@ class EdgeRelativeEmbedMLPPath(nn.Module):
         pos1: (batch, nodes, 3)
         return: tuple(a_out, v_out)
         a_out: (batch, nodes, adim)
-        v_out: (batch, nodes, vdim, 3) """
+        v_out: (batch, nodes, 3, vdim) """
     batch,          nodes,          must_be[3] = pos_0.shape
     must_be[batch], must_be[nodes], must_be[3] = pos_1.shape
     vecs = torch.stack([ # 4 relative vectors
@@ -81,8 +83,8 @@ class EdgeRelativeEmbedMLPPath(nn.Module):
         pos_1[:,  1:] - pos_1[:, :-1],
         pos_1[:, :-1] - pos_0[:,  1:],
         pos_1[:,  1:] - pos_0[:, :-1],
-      ], dim=2) # (batch, nodes - 1, 4, 3)
-    norms = torch.linalg.vector_norm(vecs, dim=-1) # (batch, nodes - 1, 4)
+      ], dim=3) # (batch, nodes - 1, 3, 4)
+    norms = vector_norm(vecs, dim=2) # (batch, nodes - 1, 4)
     y_a = self.scalar_layers(norms)
     y_v = self.lin_v(vecs)
     a_out = self.conv_a(y_a)
@@ -111,11 +113,15 @@ class LocalResidual(nn.Module):
     self.av_prod = ScalVecProducts(adim, vdim, rank)
     self.gnorm_a = ScalGroupNorm(adim, agroups)
     self.gnorm_v = VecGroupNorm(vdim, vgroups)
-  def forward(self, x_a, x_v):
-    y_a = self.layers_a(x_a)
+  def forward(self, x_a, x_v, vec_only=False):
+    """ vec_only: skip the scalar output, return None in its place """
     y_v = self.layers_v(x_v)
-    p_a, p_v = self.av_prod(x_a, x_v)
-    z_a, z_v = self.gnorm_a(y_a + p_a), self.gnorm_v(y_v + p_v)
+    p_a, p_v = self.av_prod(x_a, x_v, vec_only)
+    z_v = self.gnorm_v(y_v + p_v)
+    if vec_only:
+      return None, (x_v + z_v)
+    y_a = self.layers_a(x_a)
+    z_a = self.gnorm_a(y_a + p_a)
     return (x_a + z_a), (x_v + z_v)
 
 
@@ -137,14 +143,16 @@ class Block(nn.Module):
     emb_edge_a, emb_edge_v = self.edge_embed(pos_0, pos_1)
     emb_node_a, emb_node_v = self.node_embed(pos_0, pos_1)
     return emb_edge_a + emb_node_a, emb_edge_v + emb_node_v
-  def forward(self, tup):
+  def forward(self, tup, vec_only=False):
     pos_0, pos_1, x_a, x_v = tup
     emb_a, emb_v = self.get_embedding(pos_0, pos_1)
     y_a = self.conv_0_a(x_a) + emb_a
     y_v = self.conv_0_v(x_v) + emb_v
-    y_a, y_v = self.local_res(y_a, y_v)
-    z_a = self.gnorm_a(self.conv_1_a(y_a))
+    y_a, y_v = self.local_res(y_a, y_v, vec_only)
     z_v = self.gnorm_v(self.conv_1_v(y_v))
+    if vec_only:
+      return pos_0, pos_1, None, (x_v + z_v)
+    z_a = self.gnorm_a(self.conv_1_a(y_a))
     return pos_0, pos_1, (x_a + z_a), (x_v + z_v)
 
 
@@ -154,7 +162,7 @@ class Discriminator(nn.Module):
     super().__init__()
     adim, vdim = config["adim"], config["vdim"]
     self.node_enc = NodeRelativeEmbedMLP(adim, vdim)
-    self.blocks = nn.Sequential(
+    self.blocks = BlockStack(config,
       Block(config),
       Block(config),
       Block(config),
@@ -165,7 +173,7 @@ class Discriminator(nn.Module):
   def forward(self, pos_0, pos_1):
     x_a, x_v = self.node_enc(pos_0, pos_1)
     *_, y_a, y_v = self.blocks((pos_0, pos_1, x_a, x_v))
-    v_norms = torch.linalg.vector_norm(y_v, dim=-1)
+    v_norms = vector_norm(y_v, dim=-2)
     return (self.lin_a(y_a) + self.lin_v(v_norms)).sum(2).mean(1)
 
 
@@ -174,19 +182,19 @@ class Generator(nn.Module):
     super().__init__()
     adim, vdim = config["adim"], config["vdim"]
     self.node_enc = NodeRelativeEmbedMLP(adim, vdim)
-    self.blocks1 = nn.Sequential(
+    self.blocks1 = BlockStack(config,
       Block(config),
       Block(config),
       Block(config),
       Block(config))
-    self.blocks2 = nn.Sequential(
+    self.blocks2 = BlockStack(config,
       Block(config),
       Block(config),
       Block(config))
-    self.blocks_tune = nn.Sequential(
+    self.blocks_tune = BlockStack(config,
       Block(config),
-      Block(config))
-    # some wastage of compute here, since the final sets of scalar values are not really used
+      Block(config), vec_only=True)
+    # the final scalar values of blocks_tune are not used, so its last block skips computing them (vec_only)
     self.lin_v_node1 = VecLinear(vdim, 1)
     self.lin_v_node2 = VecLinear(vdim, 1)
     self.lin_v_node_tune = VecLinear(vdim, 1)
@@ -194,15 +202,15 @@ class Generator(nn.Module):
   def _predict1(self, pos0, noised):
     x_a, x_v = self.node_enc(pos0, noised)
     *_, y_a, y_v = self.blocks1((pos0, noised, x_a, x_v))
-    return self.lin_v_node1(y_v)[:, :, 0]*self.out_norm_coeff, y_a, y_v
+    return self.lin_v_node1(y_v)[..., 0]*self.out_norm_coeff, y_a, y_v
   def _predict2(self, pos0, noised, x_a, x_v):
     *_, y_a, y_v = self.blocks2((pos0, noised, x_a, x_v))
-    return self.lin_v_node2(y_v)[:, :, 0]*self.out_norm_coeff, y_a, y_v
+    return self.lin_v_node2(y_v)[..., 0]*self.out_norm_coeff, y_a, y_v
   def _finetune(self, pos0, noised, x_a, x_v, ε_a, ε_v):
     x_a = x_a + ε_a
     x_v = x_v + ε_v
     *_, y_v = self.blocks_tune((pos0, noised, x_a, x_v))
-    return self.lin_v_node_tune(y_v)[:, :, 0]*self.out_norm_coeff
+    return self.lin_v_node_tune(y_v)[..., 0]*self.out_norm_coeff
   def forward(self, pos0, noise_1, noise_2, ε_a, ε_v):
     noised = pos0 + noise_1
     pred_noise, x_a, x_v = self._predict1(pos0, noised)
@@ -248,48 +256,39 @@ class WGAN3D:
       }
   def train_step(self, data, cond):
     data, cond = data.reshape(-1, self.n_nodes, 3), cond.reshape(-1, self.n_nodes, 3)
-    loss_d = self.disc_step(data, cond)
-    loss_g = self.gen_step(cond)
+    loss_d, loss_g = disc_and_gen_steps(self, data, cond)
     return loss_d, loss_g
-  def disc_step(self, data, cond):
+  def disc_step(self, data, cond, g_data=None):
     self.optim_d.zero_grad()
     # train on real data (with instance noise)
     instance_noise_r = self.config["inst_noise_str_r"]*torch.randn_like(data)
     r_data = data + instance_noise_r # instance noise
-    y_r = self.disc(cond, r_data)
     # train on generated data (with instance noise)
-    g_data = self.generate(cond)
+    if g_data is None: g_data = self.generate(cond)
     instance_noise_g = self.config["inst_noise_str_g"]*torch.randn_like(g_data)
     g_data = g_data + instance_noise_g # instance noise
-    y_g = self.disc(cond, g_data)
-    # endpoint penalty on interpolated data
-    mix_factors1 = torch.rand(cond.shape[0], 1, 1, device=self.config.device)
-    mixed_data1 = mix_factors1*g_data + (1 - mix_factors1)*r_data
-    y_mixed1 = self.disc(cond, mixed_data1)
-    mix_factors2 = torch.rand(cond.shape[0], 1, 1, device=self.config.device)
-    mixed_data2 = mix_factors2*g_data + (1 - mix_factors2)*r_data
-    y_mixed2 = self.disc(cond, mixed_data2)
-    ep_penalty = (self.endpoint_penalty(r_data, g_data, y_r, y_g)
-                + self.endpoint_penalty(mixed_data1, r_data, y_mixed1, y_r)
-                + self.endpoint_penalty(g_data, mixed_data1, y_g, y_mixed1)
-                + self.endpoint_penalty(mixed_data2, r_data, y_mixed2, y_r)
-                + self.endpoint_penalty(g_data, mixed_data2, y_g, y_mixed2)
-                + self.endpoint_penalty(mixed_data1, mixed_data2, y_mixed1, y_mixed2))
+    # evaluate discriminator on real data, generated data and interpolants between them, all in one batch
+    x = disc_points(r_data, g_data, n_disc_points(self.config))
+    y = fused_disc_eval(self.disc, cond, x)
+    y_r, y_g = y[0], y[1]
+    # endpoint penalty between each pair of points
+    ep_penalty = pairwise_endpoint_penalty(self.endpoint_penalty, x, y)
     # loss, backprop, update
     loss = self.config["lpen_wt"]*ep_penalty.mean() + y_r.mean() - y_g.mean()
     loss.backward()
     self.optim_d.step()
-    return loss.item()
-  def gen_step(self, cond):
+    return loss.detach()
+  def gen_step(self, cond, g_data=None):
     self.optim_g.zero_grad()
-    g_data = self.generate(cond)
+    if g_data is None: g_data = self.generate(cond)
     instance_noise_g = self.config["inst_noise_str_g"]*torch.randn_like(g_data)
     g_data = g_data + instance_noise_g # instance noise
     y_g = self.disc(cond, g_data)
     loss = y_g.mean()
     loss.backward()
     self.optim_g.step()
-    return loss.item()
+    return loss.detach()
+  @float32
   def endpoint_penalty(self, x1, x2, y1, y2):
     dist = torch.sqrt(((x1 - x2)**2).sum(2).mean(1)) # average across nodes to make scaling easier
     # one-sided L1 penalty:
@@ -305,7 +304,7 @@ class WGAN3D:
     pos_noise_1 = self.config["z_scale_1"]*torch.randn(batchsz, self.n_nodes, 3, device=self.config.device)
     pos_noise_2 = self.config["z_scale_2"]*torch.randn(batchsz, self.n_nodes, 3, device=self.config.device)
     z_a = torch.randn(batchsz, self.n_nodes, self.config["adim"], device=self.config.device)
-    z_v = torch.randn(batchsz, self.n_nodes, self.config["vdim"], 3, device=self.config.device)
+    z_v = torch.randn(batchsz, self.n_nodes, 3, self.config["vdim"], device=self.config.device)
     return pos_noise_1, pos_noise_2, z_a, z_v
   def set_eval(self, bool_eval):
     if bool_eval:
@@ -5,7 +5,8 @@ from itertools import chain
 
 from config import Condition
 from utils import must_be
-from gan_common import GANTrainer
+from precision import float32, vector_norm
+from gan_common import GANTrainer, disc_and_gen_steps, n_disc_points, disc_points, fused_disc_eval, pairwise_endpoint_penalty
 from layers_common import *
 
 
@@ -34,11 +35,15 @@ class LocalResidual(nn.Module):
     self.av_prod = ScalVecProducts(adim, vdim, rank)
     self.gnorm_a = ScalGroupNorm(adim, agroups)
     self.gnorm_v = VecGroupNorm(vdim, vgroups)
-  def forward(self, x_a, x_v):
-    y_a = self.layers_a(x_a)
+  def forward(self, x_a, x_v, vec_only=False):
+    """ vec_only: skip the scalar output, return None in its place """
     y_v = self.layers_v(x_v)
-    p_a, p_v = self.av_prod(x_a, x_v)
-    z_a, z_v = self.gnorm_a(y_a + p_a), self.gnorm_v(y_v + p_v)
+    p_a, p_v = self.av_prod(x_a, x_v, vec_only)
+    z_v = self.gnorm_v(y_v + p_v)
+    if vec_only:
+      return None, (x_v + z_v)
+    y_a = self.layers_a(x_a)
+    z_a = self.gnorm_a(y_a + p_a)
     return (x_a + z_a), (x_v + z_v)
 
 
@@ -60,14 +65,16 @@ class Block(nn.Module):
     emb_edge_a, emb_edge_v = self.edge_embed(pos_0, pos_1)
     emb_node_a, emb_node_v = self.node_embed(pos_0, pos_1)
     return emb_edge_a + emb_node_a, emb_edge_v + emb_node_v
-  def forward(self, tup):
+  def forward(self, tup, vec_only=False):
     pos_0, pos_1, x_a, x_v = tup
     emb_a, emb_v = self.get_embedding(pos_0, pos_1)
     y_a = self.conv_0_a(x_a) + emb_a
     y_v = self.conv_0_v(x_v) + emb_v
-    y_a, y_v = self.local_res(y_a, y_v)
-    z_a = self.gnorm_a(self.conv_1_a(y_a))
+    y_a, y_v = self.local_res(y_a, y_v, vec_only)
     z_v = self.gnorm_v(self.conv_1_v(y_v))
+    if vec_only:
+      return pos_0, pos_1, None, (x_v + z_v)
+    z_a = self.gnorm_a(self.conv_1_a(y_a))
     return pos_0, pos_1, (x_a + z_a), (x_v + z_v)
 
 
@@ -77,7 +84,7 @@ class Discriminator(nn.Module):
     super().__init__()
     adim, vdim = config["adim"], config["vdim"]
     self.node_enc = NodeRelativeEmbedMLP(adim, vdim)
-    self.blocks = nn.Sequential(
+    self.blocks = BlockStack(config,
       Block(config),
       Block(config),
       Block(config),
@@ -87,7 +94,7 @@ class Discriminator(nn.Module):
   def forward(self, pos_0, pos_1):
     x_a, x_v = self.node_enc(pos_0, pos_1)
     *_, y_a, y_v = self.blocks((pos_0, pos_1, x_a, x_v))
-    v_norms = torch.linalg.vector_norm(y_v, dim=-1)
+    v_norms = vector_norm(y_v, dim=-2)
     return (self.lin_a(y_a) + self.lin_v(v_norms)).sum(2).mean(1)
 
 
@@ -96,28 +103,28 @@ class Generator(nn.Module):
     super().__init__()
     adim, vdim = config["adim"], config["vdim"]
     self.node_enc = NodeRelativeEmbedMLP(adim, vdim)
-    self.blocks = nn.Sequential(
+    self.blocks = BlockStack(config,
       Block(config),
       Block(config),
-      Block(config))
-    self.blocks_tune = nn.Sequential(
+      Block(config), vec_only=True)
+    self.blocks_tune = BlockStack(config,
       Block(config),
       Block(config),
-      Block(config))
-    # some wastage of compute here, since the final sets of scalar values are not really used
+      Block(config), vec_only=True)
+    # the final sets of scalar values are not used, so the last blocks skip computing them (vec_only)
     self.lin_v_node = VecLinear(vdim, 1)
     self.lin_v_node_tune = VecLinear(vdim, 1)
     self.out_norm_coeff = vdim**(-0.5)
   def _predict(self, pos0, noised):
     x_a, x_v = self.node_enc(pos0, noised)
     *_, y_v = self.blocks((pos0, noised, x_a, x_v))
-    return self.lin_v_node(y_v)[:, :, 0]*self.out_norm_coeff
+    return self.lin_v_node(y_v)[..., 0]*self.out_norm_coeff
   def _finetune(self, pos0, noised, ε_a, ε_v):
     x_a, x_v = self.node_enc(pos0, noised)
     x_a = x_a + ε_a
     x_v = x_v + ε_v
     *_, y_v = self.blocks_tune((pos0, noised, x_a, x_v))
-    return self.lin_v_node_tune(y_v)[:, :, 0]*self.out_norm_coeff
+    return self.lin_v_node_tune(y_v)[..., 0]*self.out_norm_coeff
   def forward(self, pos0, noise, ε_a, ε_v):
     noised = pos0 + noise
     pred_noise = self._predict(pos0, noised)
@@ -167,41 +174,34 @@ class WGAN3D:
       }
   def train_step(self, data, cond):
     data, cond = data.reshape(-1, self.n_nodes, 3), cond.reshape(-1, self.n_nodes, 3)
-    loss_d = self.disc_step(data, cond)
-    loss_g = self.gen_step(cond)
+    loss_d, loss_g = disc_and_gen_steps(self, data, cond)
     return loss_d, loss_g
-  def disc_step(self, r_data, cond):
+  def disc_step(self, r_data, cond, g_data=None):
     self.optim_d.zero_grad()
-    # train on real data
-    y_r_crow, y_r_taxi = self.y_disc(cond, r_data)
-    # train on generated data
-    g_data = self.generate(cond)
-    y_g_crow, y_g_taxi = self.y_disc(cond, g_data)
-    # endpoint penalty on interpolated data, each discriminator gets its own penalty
-    mix_factors = torch.rand(cond.shape[0], 1, 1, device=self.config.device)
-    m_data = mix_factors*g_data + (1 - mix_factors)*r_data
-    y_m_crow, y_m_taxi = self.y_disc(cond, m_data)
-    penalty_crow = (self.endpoint_penalty_crow(r_data, g_data, y_r_crow, y_g_crow)
-                  + self.endpoint_penalty_crow(r_data, m_data, y_r_crow, y_m_crow)
-                  + self.endpoint_penalty_crow(m_data, g_data, y_m_crow, y_g_crow))
-    penalty_taxi = (self.endpoint_penalty_taxi(r_data, g_data, y_r_taxi, y_g_taxi)
-                  + self.endpoint_penalty_taxi(r_data, m_data, y_r_taxi, y_m_taxi)
-                  + self.endpoint_penalty_taxi(m_data, g_data, y_m_taxi, y_g_taxi))
+    if g_data is None: g_data = self.generate(cond)
+    # evaluate discriminators on real data, generated data and an interpolant between them, all in one batch
+    x = disc_points(r_data, g_data, n_disc_points(self.config, 3))
+    y_crow = fused_disc_eval(self.crow, cond, x)
+    y_taxi = fused_disc_eval(self.taxi, cond, x)
+    # endpoint penalty between each pair of points, each discriminator gets its own penalty
+    penalty_crow = pairwise_endpoint_penalty(self.endpoint_penalty_crow, x, y_crow)
+    penalty_taxi = pairwise_endpoint_penalty(self.endpoint_penalty_taxi, x, y_taxi)
     # loss, backprop, update
-    loss = (y_r_crow.mean() + y_r_taxi.mean()) - (y_g_crow.mean() + y_g_taxi.mean())
+    loss = (y_crow[0].mean() + y_taxi[0].mean()) - (y_crow[1].mean() + y_taxi[1].mean())
     loss = loss + self.config["lpen_wt"]*(penalty_crow.mean() + penalty_taxi.mean())
     loss.backward()
     self.optim_d.step()
-    return loss.item()
-  def gen_step(self, cond):
+    return loss.detach()
+  def gen_step(self, cond, g_data=None):
     self.optim_g.zero_grad()
-    g_data = self.generate(cond)
+    if g_data is None: g_data = self.generate(cond)
     y_g_crow, y_g_taxi = self.y_disc(cond, g_data)
     y_g = y_g_crow + y_g_taxi
     loss = y_g.mean()
     loss.backward()
     self.optim_g.step()
-    return loss.item()
+    return loss.detach()
+  @float32
   def endpoint_penalty_crow(self, x1, x2, y1, y2):
     # use the euclidean metric (take RMS distance)
     dist = torch.sqrt(((x1 - x2)**2).sum(2).mean(1))
@@ -209,6 +209,7 @@ class WGAN3D:
     penalty = F.relu(torch.abs(y1 - y2)/(dist*k_L + 1e-6) - 1.)
     # weight by square root of separation
     return torch.sqrt(dist)*penalty
+  @float32
   def endpoint_penalty_taxi(self, x1, x2, y1, y2):
     # use the taxicab metric (take average distance that node moved rather than RMS distance)
     dist = torch.sqrt(((x1 - x2)**2).sum(2)).mean(1)
@@ -228,7 +229,7 @@ class WGAN3D:
     """ sample latent space for generator """
     pos_noise = self.config["z_scale"]*torch.randn(batchsz, self.n_nodes, 3, device=self.config.device)
     z_a = torch.randn(batchsz, self.n_nodes, self.config["adim"], device=self.config.device)
-    z_v = torch.randn(batchsz, self.n_nodes, self.config["vdim"], 3, device=self.config.device)
+    z_v = torch.randn(batchsz, self.n_nodes, 3, self.config["vdim"], device=self.config.device)
     return pos_noise, z_a, z_v
   def set_eval(self, bool_eval):
     if bool_eval:
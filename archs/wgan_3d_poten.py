@@ -4,7 +4,8 @@ import torch.nn.functional as F
 
 from config import Condition
 from utils import must_be
-from gan_common import GANTrainer
+from precision import float32, vector_norm
+from gan_common import GANTrainer, disc_and_gen_steps, n_disc_points, disc_points, fused_disc_eval, pairwise_endpoint_penalty
 from layers_common import *
 from attention_layers import *
 
@@ -36,11 +37,15 @@ class LocalResidual(nn.Module):
     self.av_prod = ScalVecProducts(adim, vdim, rank)
     self.gnorm_a = ScalGroupNorm(adim, agroups)
     self.gnorm_v = VecGroupNorm(vdim, vgroups)
-  def forward(self, x_a, x_v):
-    y_a = self.layers_a(x_a)
+  def forward(self, x_a, x_v, vec_only=False):
+    """ vec_only: skip the scalar output, return None in its place """
     y_v = self.layers_v(x_v)
-    p_a, p_v = self.av_prod(x_a, x_v)
-    z_a, z_v = self.gnorm_a(y_a + p_a), self.gnorm_v(y_v + p_v)
+    p_a, p_v = self.av_prod(x_a, x_v, vec_only)
+    z_v = self.gnorm_v(y_v + p_v)
+    if vec_only:
+      return None, (x_v + z_v)
+    y_a = self.layers_a(x_a)
+    z_a = self.gnorm_a(y_a + p_a)
     return (x_a + z_a), (x_v + z_v)
 
 
@@ -62,16 +67,16 @@ class GetPotentialData(nn.Module):
     """ shapes:
     pos_0, pos_1: (batch, nodes, 3)
     x_a: (batch, nodes, adim)
-    x_v: (batch, nodes, vdim, 3)
+    x_v: (batch, nodes, 3, vdim)
     ans: tuple(y_a, y_v)
     y_a: (batch, nodes, adim)
-    y_v: (batch, nodes, vdim, 3) """
+    y_v: (batch, nodes, 3, vdim) """
     pos_0, pos_1, x_a, x_v = tup
     probe_pts = self.probes(x_a, x_v, [pos_0, pos_1]) # (npts, batch, nodes, 3)
     U = (probe_pts**4).sum(-1)/24 # (npts, batch, nodes)
     dU = (probe_pts**3)/6 # (npts, batch, nodes, 3)
     y_a = torch.einsum("pbn, jp -> bnj", U, self.W_a)
-    y_v = torch.einsum("pbnv, jp -> bnjv", dU, self.W_v)
+    y_v = torch.einsum("pbnv, jp -> bnvj", dU, self.W_v)
     return y_a, y_v
 
 
@@ -89,14 +94,14 @@ class Block(nn.Module):
     self.conv_1_a = ScalConv1d(adim, 7)
     self.conv_1_v = VecConv1d(vdim, 7)
     self.probe_pts = ProbePoints(2, 2, adim, vdim)
-    self.prox_attn = ProximityAttention(config["r0_list"], config["kq_dim"], (adim, vdim))
+    self.prox_attn = ProximityAttention(config["r0_list"], config["kq_dim"], (adim, vdim), topk=attention_topk(config))
     self.gnorm_a = ScalGroupNorm(adim, agroups)
     self.gnorm_v = VecGroupNorm(vdim, vgroups)
   def get_embedding(self, pos_0, pos_1):
     emb_edge_a, emb_edge_v = self.edge_embed(pos_0, pos_1)
     emb_node_a, emb_node_v = self.node_embed(pos_0, pos_1)
     return emb_edge_a + emb_node_a, emb_edge_v + emb_node_v
-  def forward(self, tup):
+  def forward(self, tup, vec_only=False):
     pos_0, pos_1, x_a, x_v = tup
     emb_a, emb_v = self.get_embedding(pos_0, pos_1)
     emb_poten_a, emb_poten_v = self.poten_embed(tup)
@@ -105,10 +110,13 @@ class Block(nn.Module):
     y_a, y_v = self.local_res(y_a, y_v)
     probes = self.probe_pts(y_a, y_v, [pos_0, pos_1])
     probes_k, probes_q = probes[0], probes[1]
-    dy_a, dy_v = self.prox_attn((y_a, y_v), probes_k, probes_q)
-    y_a, y_v = y_a + dy_a, y_v + dy_v
-    z_a = self.gnorm_a(self.conv_1_a(y_a))
+    dy_a, dy_v = self.prox_attn((y_a, y_v), probes_k, probes_q, vec_only)
+    y_v = y_v + dy_v
     z_v = self.gnorm_v(self.conv_1_v(y_v))
+    if vec_only:
+      return pos_0, pos_1, None, (x_v + z_v)
+    y_a = y_a + dy_a
+    z_a = self.gnorm_a(self.conv_1_a(y_a))
     return pos_0, pos_1, (x_a + z_a), (x_v + z_v)
 
 
@@ -118,7 +126,7 @@ class Discriminator(nn.Module):
     super().__init__()
     adim, vdim = config["adim"], config["vdim"]
     self.node_enc = NodeRelativeEmbedMLP(adim, vdim)
-    self.blocks = nn.Sequential(
+    self.blocks = BlockStack(config,
       Block(config),
       Block(config),
       Block(config),
@@ -128,7 +136,7 @@ class Discriminator(nn.Module):
   def forward(self, pos_0, pos_1):
     x_a, x_v = self.node_enc(pos_0, pos_1)
     *_, y_a, y_v = self.blocks((pos_0, pos_1, x_a, x_v))
-    v_norms = torch.linalg.vector_norm(y_v, dim=-1)
+    v_norms = vector_norm(y_v, dim=-2)
     return (self.lin_a(y_a) + self.lin_v(v_norms)).sum(2).mean(1)
 
 
@@ -137,28 +145,28 @@ class Generator(nn.Module):
     super().__init__()
     adim, vdim = config["adim"], config["vdim"]
     self.node_enc = NodeRelativeEmbedMLP(adim, vdim)
-    self.blocks = nn.Sequential(
+    self.blocks = BlockStack(config,
       Block(config),
       Block(config),
-      Block(config))
-    self.blocks_tune = nn.Sequential(
+      Block(config), vec_only=True)
+    self.blocks_tune = BlockStack(config,
       Block(config),
       Block(config),
-      Block(config))
-    # some wastage of compute here, since the final sets of scalar values are not really used
+      Block(config), vec_only=True)
+    # the final sets of scalar values are not used, so the last blocks skip computing them (vec_only)
     self.lin_v_node = VecLinear(vdim, 1)
     self.lin_v_node_tune = VecLinear(vdim, 1)
     self.out_norm_coeff = vdim**(-0.5)
   def _predict(self, pos0, noised):
     x_a, x_v = self.node_enc(pos0, noised)
     *_, y_v = self.blocks((pos0, noised, x_a, x_v))
-    return self.lin_v_node(y_v)[:, :, 0]*self.out_norm_coeff
+    return self.lin_v_node(y_v)[..., 0]*self.out_norm_coeff
   def _finetune(self, pos0, noised, ε_a, ε_v):
     x_a, x_v = self.node_enc(pos0, noised)
     x_a = x_a + ε_a
     x_v = x_v + ε_v
     *_, y_v = self.blocks_tune((pos0, noised, x_a, x_v))
-    return self.lin_v_node_tune(y_v)[:, :, 0]*self.out_norm_coeff
+    return self.lin_v_node_tune(y_v)[..., 0]*self.out_norm_coeff
   def forward(self, pos0, noise, ε_a, ε_v):
     noised = pos0 + noise
     pred_noise = self._predict(pos0, noised)
@@ -204,8 +212,7 @@ class WGAN3D:
       }
   def train_step(self, data, cond):
     data, cond = data.reshape(-1, self.n_nodes, 3), cond.reshape(-1, self.n_nodes, 3)
-    loss_d = self.disc_step(data, cond)
-    loss_g = self.gen_step(cond)
+    loss_d, loss_g = disc_and_gen_steps(self, data, cond)
     self.step_count += 1
     if self.step_count % 1024 == 0:
       self.lr_schedule_update()
@@ -215,45 +222,37 @@ class WGAN3D:
       group["lr"] *= 0.95
     for group in self.optim_d.param_groups: # learning rate schedule
       group["lr"] *= 0.99
-  def disc_step(self, data, cond):
+  def disc_step(self, data, cond, g_data=None):
     self.optim_d.zero_grad()
     # train on real data (with instance noise)
     instance_noise_r = self.config["inst_noise_str_r"]*torch.randn_like(data)
     r_data = data + instance_noise_r # instance noise
-    y_r = self.disc(cond, r_data)
     # train on generated data (with instance noise)
-    g_data = self.generate(cond)
+    if g_data is None: g_data = self.generate(cond)
     instance_noise_g = self.config["inst_noise_str_g"]*torch.randn_like(g_data)
     g_data = g_data + instance_noise_g # instance noise
-    y_g = self.disc(cond, g_data)
-    # endpoint penalty on interpolated data
-    mix_factors1 = torch.rand(cond.shape[0], 1, 1, device=self.config.device)
-    mixed_data1 = mix_factors1*g_data + (1 - mix_factors1)*r_data
-    y_mixed1 = self.disc(cond, mixed_data1)
-    mix_factors2 = torch.rand(cond.shape[0], 1, 1, device=self.config.device)
-    mixed_data2 = mix_factors2*g_data + (1 - mix_factors2)*r_data
-    y_mixed2 = self.disc(cond, mixed_data2)
-    ep_penalty = (self.endpoint_penalty(r_data, g_data, y_r, y_g)
-                + self.endpoint_penalty(mixed_data1, r_data, y_mixed1, y_r)
-                + self.endpoint_penalty(g_data, mixed_data1, y_g, y_mixed1)
-                + self.endpoint_penalty(mixed_data2, r_data, y_mixed2, y_r)
-                + self.endpoint_penalty(g_data, mixed_data2, y_g, y_mixed2)
-                + self.endpoint_penalty(mixed_data1, mixed_data2, y_mixed1, y_mixed2))
+    # evaluate discriminator on real data, generated data and interpolants between them, all in one batch
+    x = disc_points(r_data, g_data, n_disc_points(self.config))
+    y = fused_disc_eval(self.disc, cond, x)
+    y_r, y_g = y[0], y[1]
+    # endpoint penalty between each pair of points
+    ep_penalty = pairwise_endpoint_penalty(self.endpoint_penalty, x, y)
     # loss, backprop, update
     loss = self.config["lpen_wt"]*ep_penalty.mean() + y_r.mean() - y_g.mean()
     loss.backward()
     self.optim_d.step()
-    return loss.item()
-  def gen_step(self, cond):
+    return loss.detach()
+  def gen_step(self, cond, g_data=None):
     self.optim_g.zero_grad()
-    g_data = self.generate(cond)
+    if g_data is None: g_data = self.generate(cond)
     instance_noise_g = self.config["inst_noise_str_g"]*torch.randn_like(g_data)
     g_data = g_data + instance_noise_g # instance noise
     y_g = self.disc(cond, g_data)
     loss = y_g.mean()
     loss.backward()
     self.optim_g.step()
-    return loss.item()
+    return loss.detach()
+  @float32
   def endpoint_penalty(self, x1, x2, y1, y2):
     epsilon = 0.01 # this will be put into distance, since we'll be dividing by it
     # use the taxicab metric (take average distance that nodes moved rather than RMS distance)
@@ -271,7 +270,7 @@ class WGAN3D:
     """ sample latent space for generator """
     pos_noise = self.config["z_scale"]*torch.randn(batchsz, self.n_nodes, 3, device=self.config.device)
     z_a = torch.randn(batchsz, self.n_nodes, self.config["adim"], device=self.config.device)
-    z_v = torch.randn(batchsz, self.n_nodes, self.config["vdim"], 3, device=self.config.device)
+    z_v = torch.randn(batchsz, self.n_nodes, 3, self.config["vdim"], device=self.config.device)
     return pos_noise, z_a, z_v
   def set_eval(self, bool_eval):
     if bool_eval:
@@ -5,6 +5,7 @@ import e3nn
 
 from config import Condition
 from utils import must_be
+from precision import float32, vector_norm
 from gan_common import GANTrainer
 from layers_common import *
 
@@ -53,7 +54,7 @@ class Block(nn.Module):
     self.bn_v_nodes = e3nn.nn.BatchNorm(f"{vdim}x1o")
     self.bn_a_edges = e3nn.nn.BatchNorm(f"{adim}x0e")
     self.bn_v_edges = e3nn.nn.BatchNorm(f"{vdim}x1o")
-  def forward(self, tup):
+  def forward(self, tup, vec_only=False):
     a_node, v_node, a_edge, v_edge, graph = tup
     # pre conv:
     x_a_node = self.a_nodes_conv_0(a_node, graph)
@@ -61,31 +62,34 @@ class Block(nn.Module):
     x_a_edge = a_edge + self.a_edges_read(x_a_node, graph)
     x_v_edge = v_edge + self.v_edges_read(x_v_node, graph)
     # non-linearities:
-    y_a_node = self.a_node_layers(x_a_node)
-    y_a_edge = self.a_edge_layers(x_a_edge)
     y_v_node = self.v_node_layers(x_v_node)
     y_v_edge = self.v_edge_layers(x_v_edge)
-    prod_a_node, prod_v_node = self.av_node_prod(x_a_node, x_v_node)
-    prod_a_edge, prod_v_edge = self.av_node_prod(x_a_edge, x_v_edge)
-    z_a_node, z_v_node = y_a_node + prod_a_node, y_v_node + prod_v_node
-    z_a_edge, z_v_edge = y_a_edge + prod_a_edge, y_v_edge + prod_v_edge
+    prod_a_node, prod_v_node = self.av_node_prod(x_a_node, x_v_node, vec_only)
+    prod_a_edge, prod_v_edge = self.av_node_prod(x_a_edge, x_v_edge, vec_only)
+    z_v_node, z_v_edge = y_v_node + prod_v_node, y_v_edge + prod_v_edge
     # post conv:
-    z_a_node = z_a_node + self.a_edges_write(z_a_edge, graph)
     z_v_node = z_v_node + self.v_edges_write(z_v_edge, graph)
-    z_a_node = self.a_nodes_conv_1(z_a_node, graph)
     z_v_node = self.v_nodes_conv_1(z_v_node, graph)
     # batchnorms:
-    batch,          nodes,          vdim, must_be[3] = z_v_node.shape
-    must_be[batch], edges, must_be[vdim], must_be[3] = z_v_edge.shape
+    batch,          nodes,          must_be[3], vdim = z_v_node.shape
+    must_be[batch], edges, must_be[3], must_be[vdim] = z_v_edge.shape
+    z_v_node = self.bn_v_nodes(z_v_node.transpose(2, 3).reshape(batch, nodes, 3*vdim)).reshape(batch, nodes, vdim, 3).transpose(2, 3)
+    z_v_edge = self.bn_v_edges(z_v_edge.transpose(2, 3).reshape(batch, edges, 3*vdim)).reshape(batch, edges, vdim, 3).transpose(2, 3)
+    # residual-style result:
+    out_v_node = v_node + z_v_node
+    out_v_edge = v_edge + z_v_edge
+    if vec_only: # the scalar outputs are not used, so skip the layers that only feed them
+      return (None, out_v_node, None, out_v_edge, graph)
+    # same for the scalars:
+    y_a_node = self.a_node_layers(x_a_node)
+    y_a_edge = self.a_edge_layers(x_a_edge)
+    z_a_node, z_a_edge = y_a_node + prod_a_node, y_a_edge + prod_a_edge
+    z_a_node = z_a_node + self.a_edges_write(z_a_edge, graph)
+    z_a_node = self.a_nodes_conv_1(z_a_node, graph)
     z_a_node = self.bn_a_nodes(z_a_node)
-    z_v_node = self.bn_v_nodes(z_v_node.reshape(batch, nodes, 3*vdim)).reshape(batch, nodes, vdim, 3)
     z_a_edge = self.bn_a_edges(z_a_edge)
-    z_v_edge = self.bn_v_edges(z_v_edge.reshape(batch, edges, 3*vdim)).reshape(batch, edges, vdim, 3)
-    # residual-style result:
     out_a_node = a_node + z_a_node
-    out_v_node = v_node + z_v_node
     out_a_edge = a_edge + z_a_edge
-    out_v_edge = v_edge + z_v_edge
     return (out_a_node, out_v_node, out_a_edge, out_v_edge, graph)
 
 
@@ -97,7 +101,7 @@ class Discriminator(nn.Module):
     adim, vdim = config["adim"], config["vdim"]
     self.node_enc = NodeRelativeEmbedMLP(adim, vdim)
     self.edge_enc = EdgeRelativeEmbedMLP(adim, vdim)
-    self.blocks = nn.Sequential(
+    self.blocks = BlockStack(config,
       Block(config),
       Block(config),
       Block(config),
@@ -112,7 +116,7 @@ class Discriminator(nn.Module):
     a_node, v_node, a_edge, v_edge, _ = self.blocks((a_node, v_node, a_edge, v_edge, graph))
     a_node = (a_node + self.a_edges_write(a_edge, graph))*INV_SQRT_2
     v_node = (v_node + self.v_edges_write(v_edge, graph))*INV_SQRT_2
-    v_norms = torch.linalg.vector_norm(v_node, dim=-1)
+    v_norms = vector_norm(v_node, dim=-2)
     return (self.lin_a_node(a_node) + self.lin_v_node(v_norms)).sum(2).mean(1)
 
 
@@ -122,11 +126,11 @@ class Generator(nn.Module):
     adim, vdim = config["adim"], config["vdim"]
     self.node_enc = NodeRelativeEmbedMLP(adim, vdim)
     self.edge_enc = EdgeRelativeEmbedMLP(adim, vdim)
-    self.blocks = nn.Sequential(
+    self.blocks = BlockStack(config,
       Block(config),
       Block(config),
-      Block(config))
-    # some wastage of compute here, since the final sets of scalar values are not really used
+      Block(config), vec_only=True)
+    # the final sets of scalar values are not used, so the last blocks skip computing them (vec_only)
     self.v_edges_write = VecEdgesWrite(vdim, vdim)
     self.lin_v_node = VecLinear(vdim, 1)
     self.out_norm_coeff = vdim**(-0.5)
@@ -137,7 +141,7 @@ class Generator(nn.Module):
     v_node = v_node + z_v
     a_node, v_node, a_edge, v_edge, _ = self.blocks((a_node, v_node, a_edge, v_edge, graph))
     v_node = (v_node + self.v_edges_write(v_edge, graph))*INV_SQRT_2
-    return self.lin_v_node(v_node)[:, :, 0]*self.out_norm_coeff
+    return self.lin_v_node(v_node)[..., 0]*self.out_norm_coeff
   def forward(self, pos0, noise, z_a, z_v, graph):
     noised = pos0 + noise
     pred_noise = self._predict(pos0, noised, z_a, z_v, graph)
@@ -165,7 +169,7 @@ class WGAN3D:
     r = torch.arange(n_nodes - 1, device=self.config.device)
     src = torch.cat([r, r + 1])
     dst = torch.cat([r + 1, r])
-    self.graph = Graph(src, dst, n_nodes)
+    self.graph = Graph(src, dst, n_nodes, backend=self.config.graph_backend)
   @staticmethod
   def load_from_dict(states, config):
     disc, gen = Discriminator(config).to(config.device), Generator(config).to(config.device)
@@ -216,7 +220,7 @@ class WGAN3D:
     loss = self.config["lpen_wt"]*ep_penalty.mean() + y_r.mean() - y_g.mean()
     loss.backward()
     self.optim_d.step()
-    return loss.item()
+    return loss.detach()
   def gen_step(self, cond):
     self.optim_g.zero_grad()
     g_data = self.generate(cond)
@@ -226,7 +230,8 @@ class WGAN3D:
     loss = y_g.mean()
     loss.backward()
     self.optim_g.step()
-    return loss.item()
+    return loss.detach()
+  @float32
   def endpoint_penalty(self, x1, x2, y1, y2):
     dist = torch.sqrt(((x1 - x2)**2).sum(2).mean(1)) # average across nodes to make scaling easier
     # one-sided L1 penalty:
@@ -241,7 +246,7 @@ class WGAN3D:
     """ sample latent space for generator """
     pos_noise = self.config["z_scale"]*torch.randn(batchsz, self.graph.n_nodes, 3, device=self.config.device)
     z_a = torch.randn(batchsz, self.graph.n_nodes, self.config["adim"], device=self.config.device)
-    z_v = torch.randn(batchsz, self.graph.n_nodes, self.config["vdim"], 3, device=self.config.device)
+    z_v = torch.randn(batchsz, self.graph.n_nodes, 3, self.config["vdim"], device=self.config.device)
     return pos_noise, z_a, z_v
   def set_eval(self, bool_eval):
     if bool_eval:
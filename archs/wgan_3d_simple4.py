@@ -5,7 +5,8 @@ import e3nn
 
 from config import Condition
 from utils import must_be
-from gan_common import GANTrainer
+from precision import float32, vector_norm
+from gan_common import GANTrainer, disc_and_gen_steps, n_disc_points, disc_points, fused_disc_eval, pairwise_endpoint_penalty
 from layers_common import *
 
 
@@ -55,7 +56,7 @@ class Block(nn.Module):
     self.gn_v_nodes = VecGroupNorm(vdim, vgroups)
     self.gn_a_edges = ScalGroupNorm(adim, agroups)
     self.gn_v_edges = VecGroupNorm(vdim, vgroups)
-  def forward(self, tup):
+  def forward(self, tup, vec_only=False):
     a_node, v_node, a_edge, v_edge, graph = tup
     # pre conv:
     x_a_node = self.a_nodes_conv_0(a_node, graph)
@@ -63,29 +64,32 @@ class Block(nn.Module):
     x_a_edge = a_edge + self.a_edges_read(x_a_node, graph)
     x_v_edge = v_edge + self.v_edges_read(x_v_node, graph)
     # non-linearities:
-    y_a_node = self.a_node_layers(x_a_node)
-    y_a_edge = self.a_edge_layers(x_a_edge)
     y_v_node = self.v_node_layers(x_v_node)
     y_v_edge = self.v_edge_layers(x_v_edge)
-    prod_a_node, prod_v_node = self.av_node_prod(x_a_node, x_v_node)
-    prod_a_edge, prod_v_edge = self.av_node_prod(x_a_edge, x_v_edge)
-    z_a_node, z_v_node = y_a_node + prod_a_node, y_v_node + prod_v_node
-    z_a_edge, z_v_edge = y_a_edge + prod_a_edge, y_v_edge + prod_v_edge
+    prod_a_node, prod_v_node = self.av_node_prod(x_a_node, x_v_node, vec_only)
+    prod_a_edge, prod_v_edge = self.av_node_prod(x_a_edge, x_v_edge, vec_only)
+    z_v_node, z_v_edge = y_v_node + prod_v_node, y_v_edge + prod_v_edge
     # post conv:
-    z_a_node = z_a_node + self.a_edges_write(z_a_edge, graph)
     z_v_node = z_v_node + self.v_edges_write(z_v_edge, graph)
-    z_a_node = self.a_nodes_conv_1(z_a_node, graph)
     z_v_node = self.v_nodes_conv_1(z_v_node, graph)
     # groupnorms:
-    z_a_node = self.gn_a_nodes(z_a_node)
     z_v_node = self.gn_v_nodes(z_v_node)
-    z_a_edge = self.gn_a_edges(z_a_edge)
     z_v_edge = self.gn_v_edges(z_v_edge)
     # residual-style result:
-    out_a_node = a_node + z_a_node
     out_v_node = v_node + z_v_node
-    out_a_edge = a_edge + z_a_edge
     out_v_edge = v_edge + z_v_edge
+    if vec_only: # the scalar outputs are not used, so skip the layers that only feed them
+      return (None, out_v_node, None, out_v_edge, graph)
+    # same for the scalars:
+    y_a_node = self.a_node_layers(x_a_node)
+    y_a_edge = self.a_edge_layers(x_a_edge)
+    z_a_node, z_a_edge = y_a_node + prod_a_node, y_a_edge + prod_a_edge
+    z_a_node = z_a_node + self.a_edges_write(z_a_edge, graph)
+    z_a_node = self.a_nodes_conv_1(z_a_node, graph)
+    z_a_node = self.gn_a_nodes(z_a_node)
+    z_a_edge = self.gn_a_edges(z_a_edge)
+    out_a_node = a_node + z_a_node
+    out_a_edge = a_edge + z_a_edge
     return (out_a_node, out_v_node, out_a_edge, out_v_edge, graph)
 
 
@@ -97,7 +101,7 @@ class Discriminator(nn.Module):
     adim, vdim = config["adim"], config["vdim"]
     self.node_enc = NodeRelativeEmbedMLP(adim, vdim)
     self.edge_enc = EdgeRelativeEmbedMLP(adim, vdim)
-    self.blocks = nn.Sequential(
+    self.blocks = BlockStack(config,
       Block(config),
       Block(config),
       Block(config),
@@ -112,7 +116,7 @@ class Discriminator(nn.Module):
     a_node, v_node, a_edge, v_edge, _ = self.blocks((a_node, v_node, a_edge, v_edge, graph))
     a_node = (a_node + self.a_edges_write(a_edge, graph))*INV_SQRT_2
     v_node = (v_node + self.v_edges_write(v_edge, graph))*INV_SQRT_2
-    v_norms = torch.linalg.vector_norm(v_node, dim=-1)
+    v_norms = vector_norm(v_node, dim=-2)
     return (self.lin_a_node(a_node) + self.lin_v_node(v_norms)).sum(2).mean(1)
 
 
@@ -122,15 +126,15 @@ class Generator(nn.Module):
     adim, vdim = config["adim"], config["vdim"]
     self.node_enc = NodeRelativeEmbedMLP(adim, vdim)
     self.edge_enc = EdgeRelativeEmbedMLP(adim, vdim)
-    self.blocks = nn.Sequential(
+    self.blocks = BlockStack(config,
       Block(config),
       Block(config),
-      Block(config))
-    self.blocks_tune = nn.Sequential(
+      Block(config), vec_only=True)
+    self.blocks_tune = BlockStack(config,
       Block(config),
       Block(config),
-      Block(config))
-    # some wastage of compute here, since the final sets of scalar values are not really used
+      Block(config), vec_only=True)
+    # the final sets of scalar values are not used, so the last blocks skip computing them (vec_only)
     self.v_edges_write = VecEdgesWrite(vdim, vdim)
     self.lin_v_node = VecLinear(vdim, 1)
     self.v_edges_write_tune = VecEdgesWrite(vdim, vdim)
@@ -141,7 +145,7 @@ class Generator(nn.Module):
     a_edge, v_edge = self.edge_enc(pos0, noised, graph)
     a_node, v_node, a_edge, v_edge, _ = self.blocks((a_node, v_node, a_edge, v_edge, graph))
     v_node = (v_node + self.v_edges_write(v_edge, graph))*INV_SQRT_2
-    return self.lin_v_node(v_node)[:, :, 0]*self.out_norm_coeff
+    return self.lin_v_node(v_node)[..., 0]*self.out_norm_coeff
   def _finetune(self, pos0, noised, z_a, z_v, graph):
     a_node, v_node = self.node_enc(pos0, noised, graph)
     a_edge, v_edge = self.edge_enc(pos0, noised, graph)
@@ -149,7 +153,7 @@ class Generator(nn.Module):
     v_node = v_node + z_v
     a_node, v_node, a_edge, v_edge, _ = self.blocks_tune((a_node, v_node, a_edge, v_edge, graph))
     v_node = (v_node + self.v_edges_write_tune(v_edge, graph))*INV_SQRT_2
-    return self.lin_v_node_tune(v_node)[:, :, 0]*self.out_norm_coeff
+    return self.lin_v_node_tune(v_node)[..., 0]*self.out_norm_coeff
   def forward(self, pos0, noise, z_a, z_v, graph):
     noised = pos0 + noise
     pred_noise = self._predict(pos0, noised, graph)
@@ -178,7 +182,7 @@ class WGAN3D:
     r = torch.arange(n_nodes - 1, device=self.config.device)
     src = torch.cat([r, r + 1])
     dst = torch.cat([r + 1, r])
-    self.graph = Graph(src, dst, n_nodes)
+    self.graph = Graph(src, dst, n_nodes, backend=self.config.graph_backend)
   @staticmethod
   def load_from_dict(states, config):
     disc, gen = Discriminator(config).to(config.device), Generator(config).to(config.device)
@@ -198,48 +202,39 @@ class WGAN3D:
       }
   def train_step(self, data, cond):
     data, cond = data.reshape(-1, self.graph.n_nodes, 3), cond.reshape(-1, self.graph.n_nodes, 3)
-    loss_d = self.disc_step(data, cond)
-    loss_g = self.gen_step(cond)
+    loss_d, loss_g = disc_and_gen_steps(self, data, cond)
     return loss_d, loss_g
-  def disc_step(self, data, cond):
+  def disc_step(self, data, cond, g_data=None):
     self.optim_d.zero_grad()
     # train on real data (with instance noise)
     instance_noise_r = self.config["inst_noise_str_r"]*torch.randn_like(data)
     r_data = data + instance_noise_r # instance noise
-    y_r = self.disc(cond, r_data, self.graph)
     # train on generated data (with instance noise)
-    g_data = self.generate(cond)
+    if g_data is None: g_data = self.generate(cond)
     instance_noise_g = self.config["inst_noise_str_g"]*torch.randn_like(g_data)
     g_data = g_data + instance_noise_g # instance noise
-    y_g = self.disc(cond, g_data, self.graph)
-    # endpoint penalty on interpolated data
-    mix_factors1 = torch.rand(cond.shape[0], 1, 1, device=self.config.device)
-    mixed_data1 = mix_factors1*g_data + (1 - mix_factors1)*r_data
-    y_mixed1 = self.disc(cond, mixed_data1, self.graph)
-    mix_factors2 = torch.rand(cond.shape[0], 1, 1, device=self.config.device)
-    mixed_data2 = mix_factors2*g_data + (1 - mix_factors2)*r_data
-    y_mixed2 = self.disc(cond, mixed_data2, self.graph)
-    ep_penalty = (self.endpoint_penalty(r_data, g_data, y_r, y_g)
-                + self.endpoint_penalty(mixed_data1, r_data, y_mixed1, y_r)
-                + self.endpoint_penalty(g_data, mixed_data1, y_g, y_mixed1)
-                + self.endpoint_penalty(mixed_data2, r_data, y_mixed2, y_r)
-                + self.endpoint_penalty(g_data, mixed_data2, y_g, y_mixed2)
-                + self.endpoint_penalty(mixed_data1, mixed_data2, y_mixed1, y_mixed2))
+    # evaluate discriminator on real data, generated data and interpolants between them, all in one batch
+    x = disc_points(r_data, g_data, n_disc_points(self.config))
+    y = fused_disc_eval(self.disc, cond, x, self.graph)
+    y_r, y_g = y[0], y[1]
+    # endpoint penalty between each pair of points
+    ep_penalty = pairwise_endpoint_penalty(self.endpoint_penalty, x, y)
     # loss, backprop, update
     loss = self.config["lpen_wt"]*ep_penalty.mean() + y_r.mean() - y_g.mean()
     loss.backward()
     self.optim_d.step()
-    return loss.item()
-  def gen_step(self, cond):
+    return loss.detach()
+  def gen_step(self, cond, g_data=None):
     self.optim_g.zero_grad()
-    g_data = self.generate(cond)
+    if g_data is None: g_data = self.generate(cond)
     instance_noise_g = self.config["inst_noise_str_g"]*torch.randn_like(g_data)
     g_data = g_data + instance_noise_g # instance noise
     y_g = self.disc(cond, g_data, self.graph)
     loss = y_g.mean()
     loss.backward()
     self.optim_g.step()
-    return loss.item()
+    return loss.detach()
+  @float32
   def endpoint_penalty(self, x1, x2, y1, y2):
     dist = torch.sqrt(((x1 - x2)**2).sum(2).mean(1)) # average across nodes to make scaling easier
     # one-sided L1 penalty:
@@ -254,7 +249,7 @@ class WGAN3D:
     """ sample latent space for generator """
     pos_noise = self.config["z_scale"]*torch.randn(batchsz, self.graph.n_nodes, 3, device=self.config.device)
     z_a = torch.randn(batchsz, self.graph.n_nodes, self.config["adim"], device=self.config.device)
-    z_v = torch.randn(batchsz, self.graph.n_nodes, self.config["vdim"], 3, device=self.config.device)
+    z_v = torch.randn(batchsz, self.graph.n_nodes, 3, self.config["vdim"], device=self.config.device)
     return pos_noise, z_a, z_v
   def set_eval(self, bool_eval):
     if bool_eval:
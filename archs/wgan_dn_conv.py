@@ -4,6 +4,7 @@ import torch.nn.functional as F
 
 from config import Config, Condition
 from gan_common import GANTrainer
+from precision import float32
 from layers_common import weights_init, ResidualConv1d, ToAtomCoords, FromAtomCoords
 
 
@@ -169,7 +170,7 @@ class GAN:
     loss = ep_penalty.mean() + y_r.mean() - y_g.mean()
     loss.backward()
     self.optim_d.step()
-    return loss.item()
+    return loss.detach()
   def gen_step(self, cond):
     self.optim_g.zero_grad()
     g_data = self.gen(self.get_latents(cond.shape[0]), cond)
@@ -179,7 +180,8 @@ class GAN:
     loss = y_g.mean()
     loss.backward()
     self.optim_g.step()
-    return loss.item()
+    return loss.detach()
+  @float32
   def endpoint_penalty(self, x1, x2, y1, y2):
     dist = torch.sqrt(((x1 - x2)**2).mean(1))
     # one-sided L1 penalty:
@@ -6,12 +6,7 @@ from config import Config, Condition
 from gan_common import GANTrainer
 from optimizers import FriendlyAverage34
 from utils import must_be
-
-# TODO: for debugging, remove along with associated function
-import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib
-#matplotlib.use('Agg')
+from diagnostics import WeightHistory, FrameRenderer, FRAME_EVERY
 
 from sims import get_poly_tc
 
@@ -108,14 +103,8 @@ class GAN:
       "weight_decay": None})
     self.optim_g = FriendlyAverage34(self.gen.parameters(),  self.config["lr_g"])
     self.step_count = 0
-    d_params = 0
-    for param in self.disc.parameters():
-      d_params += 1
-    g_params = 0
-    for param in self.gen.parameters():
-      g_params += 1
-    self.weight_histories_d = np.zeros((self.config.nsteps, d_params)) + np.nan
-    self.weight_histories_g = np.zeros((self.config.nsteps, g_params)) + np.nan
+    self.weight_history = WeightHistory([self.disc, self.gen], self.config.nsteps, self.config.device)
+    self.frame_renderer = FrameRenderer()
   @staticmethod
   def load_from_dict(states, config):
     disc, gen = Discriminator(config).to(config.device), Generator(config).to(config.device)
@@ -131,6 +120,9 @@ class GAN:
         "disc": self.disc.state_dict(),
         "gen": self.gen.state_dict(),
       }
+  def close(self):
+    """ called by train() at the end of training """
+    self.frame_renderer.close()
   def train_step(self, data, cond):
     # training steps
     if self.step_count % 3 == 0:
@@ -138,13 +130,10 @@ class GAN:
     else:
       loss_g = 0
     loss_d = self.disc_step(data, cond)
-    # save parameters and other data, maybe record a frame
-    if self.step_count % 3 == 0:
-      self.record_frame(self.step_count//3)
-    for j, param in enumerate(self.disc.parameters()):
-      self.weight_histories_d[self.step_count, j] = param.reshape(-1)[0].detach().item()
-    for j, param in enumerate(self.gen.parameters()):
-      self.weight_histories_g[self.step_count, j] = param.reshape(-1)[0].detach().item()
+    # save parameters, maybe record a frame
+    self.weight_history.record(self.step_count)
+    if self.step_count % FRAME_EVERY == 0:
+      self.record_frame(self.step_count//FRAME_EVERY)
     self.step_count += 1
     if self.step_count % 160 == 0:
       for group in self.optim_g.param_groups: # learning rate schedule
@@ -164,7 +153,7 @@ class GAN:
     loss = loss.mean()
     loss.backward()
     self.optim_d.step()
-    return loss.item()
+    return loss.detach()
   def gen_step(self, cond):
     self.optim_g.zero_grad()
     g_data = self.gen(self.get_latents(cond.shape[0]), cond)
@@ -172,7 +161,7 @@ class GAN:
     loss = y_g.mean()
     loss.backward()
     self.optim_g.step()
-    return loss.item()
+    return loss.detach()
   def get_latents(self, batchsz):
     """ sample latents for generator """
     return torch.randn(batchsz, 15*self.config.cond_dim, device=self.config.device)
@@ -190,29 +179,17 @@ class GAN:
     tau = self.config.sim.delta_t/get_poly_tc(self.config.sim, 1.)
     return (2.718281828**(-tau))*x0 + torch.randn_like(x0)/((1. - 2.718281828**(-2*tau))**0.5)
   def record_frame(self, i, hist_datas=1000):
+    """ snapshot the generated distribution, discriminator and weight history, and send it off to be drawn """
     with torch.no_grad():
-      # initialize plot
-      fig, (ax, ax_wts) = plt.subplots( nrows=2, ncols=1 )
-      # plot hists of generated points
       x0 = torch.tensor(2., device=self.config.device).reshape(1,1)
-      x1 = self.cond_sample(x0.expand(hist_datas, 1)).detach().cpu()
-      x1_hat = self.gen(self.get_latents(hist_datas), x0.expand(hist_datas, 1)).detach().cpu()
-      ax.hist(x1[:, 0], bins=20, alpha=0.4)
-      ax.hist(x1_hat[:, 0], bins=20, alpha=0.4)
-      # plot discriminator line
       x = torch.linspace(-8., 8., 600, device=self.config.device).reshape(600, 1)
-      y = self.disc(x0.expand(600, 1), x).detach().cpu()
-      ax_disc = ax.twinx()
-      ax_disc.plot(x.detach().cpu(), y.detach().cpu(), color="green")
-      # plot weight history:
-      for j in range(self.weight_histories_d.shape[1]):
-        ax_wts.plot(self.weight_histories_d[:, j])
-      for j in range(self.weight_histories_g.shape[1]):
-        ax_wts.plot(self.weight_histories_g[:, j])
-      # save to file
-      fig.savefig('slides/%d.png' % i)
-      plt.clf() # https://stackoverflow.com/a/72890978
-      plt.close(fig)
+      self.frame_renderer.submit(i, {
+        "x1": self.cond_sample(x0.expand(hist_datas, 1)),
+        "x1_hat": self.gen(self.get_latents(hist_datas), x0.expand(hist_datas, 1)),
+        "disc_x": x,
+        "disc_y": self.disc(x0.expand(600, 1), x),
+        "weights": self.weight_history.history,
+      })
 
 
 
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 
 from utils import must_be
+from precision import float32
 
 
 class ProbePoints(nn.Module):
@@ -18,34 +19,65 @@ class ProbePoints(nn.Module):
   def self_init(self):
     must_be[self.n_probe_pts], vdim = self.W.shape
     nn.init.normal_(self.W, std=(vdim**(-0.5)))
+  @float32 # probe points are absolute positions, so need full precision
   def forward(self, ax, vx, positions):
     """ ax: (batch, nodes, adim)
-        vx: (batch, nodes, vdim, 3)
+        vx: (batch, nodes, 3, vdim)
         positions: list of (batch, nodes, 3)
         ans: (n_probe_pts, batch, nodes, 3) """
     batch,          nodes,          adim = ax.shape
-    must_be[batch], must_be[nodes], vdim, must_be[3] = vx.shape
+    must_be[batch], must_be[nodes], must_be[3], vdim = vx.shape
     positions = torch.stack(positions, dim=2)
     must_be[batch], must_be[nodes], must_be[self.n_base_pts], must_be[3] = positions.shape
     mixture_factors = self.lin_mix(ax).reshape(batch, nodes, self.n_base_pts, self.n_probe_pts)
     mixture_factors = torch.softmax(mixture_factors, dim=2)
     probe_pts = torch.einsum("bnsv, bnsp -> pbnv", positions, mixture_factors) # (n_probe_pts, batch, nodes, 3)
-    delta_v = torch.einsum("pj, bnjv -> pbnv", self.W, vx) # (n_probe_pts, batch, nodes, 3)
+    delta_v = torch.einsum("pj, bnvj -> pbnv", self.W, vx) # (n_probe_pts, batch, nodes, 3)
     probe_pts = probe_pts + delta_v
     return probe_pts
 
 
+# Sparse attention for long chains. Dense ProximityAttention builds (batch, nodes, nodes, H) attention weights and
+# (batch, nodes, nodes, H, 3) displacement directions, so time and memory grow as nodes**2. But the attention
+# weights carry a factor r0**2/(r0**2 + r**2), so distant keys get little weight. With the "attn_topk" arch_specific
+# key set to k > 0, each query only attends to its k nearest keys, and the attention itself costs O(nodes*k). Finding
+# the nearest keys still compares all pairs of positions, KNN_CHUNK queries at a time: that's O(nodes**2) time but
+# only a few flops per pair, and O(nodes*KNN_CHUNK) memory. ProximityAttention.sparse_dropped_mass() measures how
+# much dense attention weight the sparse layer leaves out for given inputs, which bounds the difference of their
+# outputs, see benchmark_sparse_attention.py for those bounds, errors, and timings. The proximity factor only decays
+# as 1/r**2, so a lot of weight can be left out (for freshly initialised layers on random chains, over 40% even at
+# k=32 with r0 <= 2), and the sparse mode is an approximation to check with sparse_dropped_mass(), not a drop-in
+# replacement. Chains of at most k nodes are computed densely.
+KNN_CHUNK = 64
+
+def attention_topk(config):
+  """ number of nearest keys each query attends to, 0 for dense attention """
+  return config["attn_topk"] if "attn_topk" in config.arch_specific else 0
+
+
+def _gather_near(t, idx):
+  """ t: (batch, nodes, ...)
+      idx: (batch, nodes, topk), indices into nodes
+      return: (batch, nodes, topk, ...) """
+  batch, nodes, topk = idx.shape
+  idx = (idx + nodes*torch.arange(batch, device=idx.device)[:, None, None]).reshape(-1)
+  return t.reshape(batch*nodes, *t.shape[2:]).index_select(0, idx).reshape(batch, nodes, topk, *t.shape[2:])
+
+
 class ProximityAttention(nn.Module):
   """ A multiheaded attention module. The layer can be configured with the following parameters:
       r0_list: (H)        --> a python list of characteristic radii for each attention head
       kq_dim: (dim, dim)  --> tuple of adim and vdim for keys and queries
       chan: (dim, dim)    --> tuple of adim and vdim for input and output data
       kq_prescale: ()     --> k*q dot products are multiplied by this to make them smaller
+      topk: ()            --> if > 0, each query only attends to its topk nearest keys, see attention_topk()
       Attention is based both on vector dot products, and also on spatial proximity.
       This implementation does not allow masking. """
-  def __init__(self, r0_list, kq_dim, chan, kq_prescale=0.01, kq_scale=0.1):
+  def __init__(self, r0_list, kq_dim, chan, kq_prescale=0.01, kq_scale=0.1, topk=0):
     super().__init__()
     self.H = len(r0_list)
+    assert topk >= 0
+    self.topk = topk
     self.register_buffer("r0", torch.tensor(r0_list), persistent=False)
     kq_adim, kq_vdim = kq_dim
     achan, vchan = chan
@@ -76,32 +108,52 @@ class ProximityAttention(nn.Module):
     self._param_init_with_scale(self.W_vval)
     self._param_init_with_scale(self.W_a2vval)
     self._param_init_with_scale(self.W_v2aval)
-  def forward(self, x, pos_k, pos_q):
+  def forward(self, x, pos_k, pos_q, vec_only=False):
     """ performs a proximity attention operation.
         x is the input data vector
         pos_k, pos_q are the spatial locations of the key and query probe points
+        vec_only: skip the scalar output (aans is None), for callers that don't use it
         x: tuple(ax, vx)
           ax: (batch, nodes, achan)
-          vx: (batch, nodes, vchan, 3)
+          vx: (batch, nodes, 3, vchan)
         pos_k, pos_q: (batch, nodes, 3)
         Attention score is given by softmax(k*q)*(r0**2 / (r0**2 + r**2))
         Data about separations between probe points is mixed into the output.
         ans: tuple(aans, vans)
           aans: (batch, nodes, achan)
-          vans: (batch, nodes, vchan, 3) """
+          vans: (batch, nodes, 3, vchan) """
     ax, vx = x
     batch,          nodes,          achan = ax.shape
-    must_be[batch], must_be[nodes], vchan, must_be[3] = vx.shape
+    must_be[batch], must_be[nodes], must_be[3], vchan = vx.shape
     must_be[batch], must_be[nodes], must_be[3] = pos_k.shape
     must_be[batch], must_be[nodes], must_be[3] = pos_q.shape
+    if 0 < self.topk < nodes:
+      return self._sparse_forward(ax, vx, pos_k, pos_q, vec_only)
     # compute basic attention:
     ak = torch.einsum("hij, bnj -> bnhi",   self.W_ak, ax) # (batch, nodes, H, kq_adim)
-    vk = torch.einsum("hij, bnjv -> bnhiv", self.W_vk, vx) # (batch, nodes, H, kq_vdim, 3)
+    vk = torch.einsum("hij, bnvj -> bnhiv", self.W_vk, vx) # (batch, nodes, H, kq_vdim, 3)
     aq = torch.einsum("hij, bnj -> bnhi",   self.W_aq, ax) # (batch, nodes, H, kq_adim)
-    vq = torch.einsum("hij, bnjv -> bnhiv", self.W_vq, vx) # (batch, nodes, H, kq_vdim, 3)
+    vq = torch.einsum("hij, bnvj -> bnhiv", self.W_vq, vx) # (batch, nodes, H, kq_vdim, 3)
     akq_dot = torch.einsum("bnhi, bmhi -> bnmh",   ak, aq) # (batch, nodes, nodes, H)
     vkq_dot = torch.einsum("bnhiv, bmhiv -> bnmh", vk, vq) # (batch, nodes, nodes, H)
     dot = self.kq_scale*(akq_dot + vkq_dot) # (batch, nodes, nodes, H)
+    attention, directions = self._attention(dot, pos_k, pos_q)
+    vans = torch.einsum("bnmh, hij, bnvj -> bmvhi", attention, self.W_vval, vx) # (batch, nodes, 3, H, vvaldim)
+    # special value messages using spatial displacements:
+    vans = vans + torch.einsum("bnmh, hij, bnj, bnmhv -> bmvhi", attention, self.W_a2vval, ax, directions)
+    if vec_only:
+      return None, vans.reshape(batch, nodes, 3, vchan)
+    aans = torch.einsum("bnmh, hij, bnj -> bmhi",   attention, self.W_aval, ax) # (batch, nodes, H, avaldim)
+    aans = aans + torch.einsum("bnmh, hij, bnvj, bnmhv -> bmhi", attention, self.W_v2aval, vx, directions)
+    return aans.reshape(batch, nodes, achan), vans.reshape(batch, nodes, 3, vchan)
+  @float32
+  def _attention(self, dot, pos_k, pos_q):
+    """ combine dot products with proximity to get attention weights (always in float32)
+        dot: (batch, nodes, nodes, H)
+        pos_k, pos_q: (batch, nodes, 3)
+        return: tuple(attention, directions)
+          attention: (batch, nodes, nodes, H)
+          directions: (batch, nodes, nodes, H, 3) """
     # compute proximity:
     separation = pos_k[:, None, :] - pos_q[:, :, None] # (batch, nodes, nodes, 3)
     dist_sq = (separation**2).sum(3) # (batch, nodes, nodes) squared-distance matrix
@@ -111,13 +163,95 @@ class ProximityAttention(nn.Module):
     dot = dot + torch.log(proximity) # update attention pre-activations with proximity
     # attention operation
     attention = torch.softmax(dot, dim=1) # dim 1 corresponds to "which key?"
-    aans = torch.einsum("bnmh, hij, bnj -> bmhi",   attention, self.W_aval, ax) # (batch, nodes, H, avaldim)
-    vans = torch.einsum("bnmh, hij, bnjv -> bmhiv", attention, self.W_vval, vx) # (batch, nodes, H, vvaldim, 3)
+    return attention, directions
+  # Sparse mode: for query m, the key n is at pos_q[n] and the query is at pos_k[m] (same convention as the dense
+  # computation above). Keys are sorted by that distance, which is the same for all heads. Only the topk nearest
+  # keys are used, and the softmax is taken over them. Everything is then O(nodes*topk) instead of O(nodes**2),
+  # except for the search for the nearest keys, see _nearest_keys(). Keys and values are linear in the
+  # inputs, so the only thing we gather per pair is the input x = (ax, vx) of the key, which all heads share:
+  # k.q is computed as x.(W_k^T q), and the attention weighted sums of x are taken before the value weights.
+  def _sparse_forward(self, ax, vx, pos_k, pos_q, vec_only):
+    batch, nodes, achan = ax.shape
+    vchan = vx.shape[-1]
+    H, topk = self.H, self.topk
+    idx = self._nearest_keys(pos_k, pos_q) # (batch, nodes, topk)
+    x_near = _gather_near(torch.cat([ax, vx.flatten(2)], dim=2), idx) # (batch, nodes, topk, achan + 3*vchan)
+    aq = torch.einsum("hij, bnj -> bnhi",   self.W_aq, ax) # (batch, nodes, H, kq_adim)
+    vq = torch.einsum("hij, bnvj -> bnhiv", self.W_vq, vx) # (batch, nodes, H, kq_vdim, 3)
+    q_in = torch.cat([ # queries mapped back to input space, (batch, nodes, H, achan + 3*vchan)
+      torch.einsum("hij, bnhi -> bnhj", self.W_ak, aq),
+      torch.einsum("hij, bnhiv -> bnhvj", self.W_vk, vq).flatten(3)], dim=3)
+    dot = self.kq_scale*(x_near @ q_in.transpose(2, 3)) # (batch, nodes, topk, H)
+    attention, directions = self._sparse_attention(dot, pos_k, _gather_near(pos_q, idx))
+    weights = torch.cat([attention[..., None], attention[..., None]*directions], dim=4) # (batch, nodes, topk, H, 4)
+    x_sums = weights.flatten(3).transpose(2, 3) @ x_near # (batch, nodes, 4*H, achan + 3*vchan)
+    x_sums = x_sums.reshape(batch, nodes, H, 4, achan + 3*vchan)
+    ax_sum, vx_sum = x_sums[..., 0, :achan], x_sums[..., 0, achan:].reshape(batch, nodes, H, 3, vchan)
+    ax_dir_sum = x_sums[..., 1:, :achan] # (batch, nodes, H, 3, achan)
+    vx_dir_sum = x_sums[..., 1:, achan:].reshape(batch, nodes, H, 3, 3, vchan)
+    vans = torch.einsum("hij, bnhvj -> bnvhi", self.W_vval, vx_sum) # (batch, nodes, 3, H, vvaldim)
     # special value messages using spatial displacements:
-    aans = aans + torch.einsum("bnmh, hij, bnjv, bnmhv -> bmhi", attention, self.W_v2aval, vx, directions)
-    vans = vans + torch.einsum("bnmh, hij, bnj, bnmhv -> bmhiv", attention, self.W_a2vval, ax, directions)
-    return aans.reshape(batch, nodes, achan), vans.reshape(batch, nodes, vchan, 3)
-
+    vans = vans + torch.einsum("hij, bnhvj -> bnvhi", self.W_a2vval, ax_dir_sum)
+    if vec_only:
+      return None, vans.reshape(batch, nodes, 3, vchan)
+    aans = torch.einsum("hij, bnhj -> bnhi", self.W_aval, ax_sum) # (batch, nodes, H, avaldim)
+    aans = aans + torch.einsum("hij, bnhvvj -> bnhi", self.W_v2aval, vx_dir_sum)
+    return aans.reshape(batch, nodes, achan), vans.reshape(batch, nodes, 3, vchan)
+  @float32
+  def _nearest_keys(self, pos_k, pos_q):
+    """ pos_k, pos_q: (batch, nodes, 3)
+        return: (batch, nodes, topk) indices of the topk nearest keys of each query
+        distances are computed for KNN_CHUNK queries at a time, so we never hold the (batch, nodes, nodes) matrix """
+    nodes = pos_k.shape[1]
+    with torch.no_grad():
+      return torch.cat([
+          torch.cdist(pos_k[:, i:i + KNN_CHUNK], pos_q, compute_mode="donot_use_mm_for_euclid_dist" # (batch, chunk, nodes)
+            ).topk(self.topk, dim=2, largest=False, sorted=False).indices
+        for i in range(0, nodes, KNN_CHUNK)], dim=1)
+  @float32
+  def _sparse_attention(self, dot, pos_k, pos_q_near):
+    """ sparse version of _attention()
+        dot: (batch, nodes, topk, H)
+        pos_k: (batch, nodes, 3)
+        pos_q_near: (batch, nodes, topk, 3)
+        return: tuple(attention, directions)
+          attention: (batch, nodes, topk, H)
+          directions: (batch, nodes, topk, H, 3) """
+    separation = pos_k[:, :, None] - pos_q_near # (batch, nodes, topk, 3)
+    dist_sq = (separation**2).sum(3) # (batch, nodes, topk)
+    r0_sq = self.r0**2
+    proximity = r0_sq/(r0_sq + dist_sq[..., None]) # (batch, nodes, topk, H)
+    directions = separation[:, :, :, None]*torch.sqrt(proximity/r0_sq)[:, :, :, :, None] # (batch, nodes, topk, H, 3)
+    dot = dot + torch.log(proximity)
+    attention = torch.softmax(dot, dim=2) # dim 2 corresponds to "which key?"
+    return attention, directions
+  @float32
+  def sparse_dropped_mass(self, x, pos_k, pos_q):
+    """ dense attention weight on the keys that the sparse mode leaves out, maximised over queries, heads and batch,
+        for these inputs (0 if the layer is dense). The sparse attention weights are the dense ones restricted to
+        the topk nearest keys and renormalised, so the two differ by exactly 2*mass in total, and the outputs of the
+        sparse and dense layer differ by at most 2*mass times the largest value message. This computes the dense
+        attention weights (KNN_CHUNK queries at a time), so it costs about as much as a dense forward pass. """
+    ax, vx = x
+    batch, nodes, _ = ax.shape
+    if not (0 < self.topk < nodes):
+      return torch.zeros((), device=ax.device)
+    with torch.no_grad():
+      ak = torch.einsum("hij, bnj -> bnhi",   self.W_ak, ax) # (batch, nodes, H, kq_adim)
+      vk = torch.einsum("hij, bnvj -> bnhiv", self.W_vk, vx) # (batch, nodes, H, kq_vdim, 3)
+      aq = torch.einsum("hij, bnj -> bnhi",   self.W_aq, ax) # (batch, nodes, H, kq_adim)
+      vq = torch.einsum("hij, bnvj -> bnhiv", self.W_vq, vx) # (batch, nodes, H, kq_vdim, 3)
+      idx = self._nearest_keys(pos_k, pos_q) # (batch, nodes, topk)
+      ans = torch.zeros((), device=ax.device)
+      for i in range(0, nodes, KNN_CHUNK):
+        chunk = slice(i, i + KNN_CHUNK)
+        akq_dot = torch.einsum("bnhi, bmhi -> bnmh",   ak, aq[:, chunk]) # (batch, nodes, chunk, H)
+        vkq_dot = torch.einsum("bnhiv, bmhiv -> bnmh", vk, vq[:, chunk]) # (batch, nodes, chunk, H)
+        attention, _ = self._attention(self.kq_scale*(akq_dot + vkq_dot), pos_k[:, chunk], pos_q)
+        idx_near = idx[:, chunk].transpose(1, 2)[..., None].expand(-1, -1, -1, self.H) # (batch, topk, chunk, H)
+        mass_near = attention.gather(1, idx_near).sum(1) # (batch, chunk, H)
+        ans = torch.maximum(ans, (1. - mass_near).max())
+      return ans.clamp(min=0.)
 
 
 
@@ -134,7 +268,7 @@ if __name__ == "__main__":
   m.self_init()
   m.to(device)
   ax = torch.randn(batch, nodes, adim, device=device)
-  vx = torch.randn(batch, nodes, vdim, 3, device=device)*0.577
+  vx = torch.randn(batch, nodes, 3, vdim, device=device)*0.577
   pos_0 = torch.randn(batch, nodes, 3, device=device)*3.2
   pos_1 = torch.randn(batch, nodes, 3, device=device)*3.2
   print("calculating probe points...")
@@ -150,7 +284,7 @@ if __name__ == "__main__":
   aans, vans = m((ax, vx), pos_k, pos_q)
   aans_prime, vans_prime = m((ax, vx), pos_kq_prime[0], pos_kq_prime[1])
   print((aans**2).mean(), (vans**2).mean())
-  print(((aans - aans_prime)**2).max(), ((vans - vans_prime)**2).sum(-1).max())
+  print(((aans - aans_prime)**2).max(), ((vans - vans_prime)**2).sum(-2).max())
 
 
 
@@ -0,0 +1,112 @@
+import re
+import time
+
+import torch
+import numpy as np
+
+from config import Config, load_config
+
+
+# Memory/throughput trade-off of activation checkpointing of the Block stacks in the 3D archs (the "checkpoint_blocks"
+# arch_specific key, see BlockStack in layers_common). Starting from fresh models with the architecture and
+# hyperparameters of a saved model, we train on random polymer configurations for each polymer length in --lengths,
+# and each setting of checkpoint_blocks in --chunks (0 means no checkpointing). We report the time per train_step,
+# and the peak memory that autograd keeps for backward passes, which is what checkpointing reduces. This is counted
+# from the tensors autograd saves, so it works on any device, but it leaves out the activations of the one chunk
+# that is being recomputed during backward. On GPU, we also report the peak allocated memory, which includes those,
+# and the weights and optimizer states.
+#
+#   python benchmark_checkpointing.py models/my_model.pt --lengths 12 24 36 48 96 --chunks 0 1 2 --batch 16
+
+
+class SavedMemory:
+  """ context manager that tracks the bytes of tensor storage that autograd keeps for backward, and their peak """
+  def __init__(self):
+    self.refs = {} # storage pointer: [refcount, bytes]
+    self.current = 0
+    self.peak = 0
+  def __enter__(self):
+    self.hooks = torch.autograd.graph.saved_tensors_hooks(self._pack, self._unpack)
+    self.hooks.__enter__()
+    return self
+  def __exit__(self, *exc):
+    self.hooks.__exit__(*exc)
+  def _pack(self, t):
+    key = t.untyped_storage().data_ptr()
+    if key not in self.refs:
+      self.refs[key] = [0, t.untyped_storage().nbytes()]
+      self.current += self.refs[key][1]
+      self.peak = max(self.peak, self.current)
+    self.refs[key][0] += 1
+    return _Saved(self, key, t)
+  def _unpack(self, saved):
+    return saved.t
+  def _release(self, key):
+    self.refs[key][0] -= 1
+    if self.refs[key][0] == 0:
+      self.current -= self.refs.pop(key)[1]
+
+class _Saved:
+  """ a saved tensor, which tells its SavedMemory when autograd frees it """
+  def __init__(self, tracker, key, t):
+    self.tracker, self.key, self.t = tracker, key, t
+  def __del__(self):
+    self.tracker._release(self.key)
+
+
+def variant(config, poly_len, chunk, device, batch):
+  args, kwargs = config.get_args_and_kwargs()
+  args = [re.sub(r"_l\d+_", "_l%d_" % poly_len, args[0])] + args[1:]
+  kwargs = dict(kwargs, device=device, batch=batch,
+    arch_specific=dict(kwargs["arch_specific"], checkpoint_blocks=chunk))
+  return Config(*args, **kwargs)
+
+def random_batch(config):
+  """ random walk polymers, and the same polymers slightly moved """
+  assert config.x_only, "expected a model of polymer positions"
+  batch = config.batch*(config.simlen - 1)
+  x0 = torch.randn(batch, config.sim.poly_len, 3, device=config.device).cumsum(1).reshape(batch, -1)
+  x1 = x0 + 0.1*torch.randn_like(x0)
+  return x1, config.cond(x0)
+
+def run(config, steps, seed):
+  torch.manual_seed(seed)
+  model = config.modelclass.makenew(config)
+  data, cond = random_batch(config)
+  cuda = torch.device(config.device).type == "cuda"
+  if cuda:
+    torch.cuda.reset_peak_memory_stats()
+  times = []
+  with SavedMemory() as saved:
+    for i in range(steps):
+      t0 = time.perf_counter()
+      model.train_step(data, cond)
+      if cuda: torch.cuda.synchronize()
+      times.append(time.perf_counter() - t0)
+  t_step = np.median(times[1:]) if len(times) > 1 else times[0]
+  return t_step, saved.peak, torch.cuda.max_memory_allocated() if cuda else None
+
+def main(args):
+  base = load_config(args.fpath)
+  device = args.device if args.device is not None else base.device
+  batch = args.batch if args.batch is not None else base.batch
+  print("%s, batch %d x %d. times in ms/step, memory in MB" % (base.arch_name, batch, base.simlen - 1))
+  print("%8s %8s %10s %14s %14s" % ("length", "chunk", "time", "saved (peak)", "gpu (peak)"))
+  for poly_len in args.lengths:
+    for chunk in args.chunks:
+      t_step, saved_peak, gpu_peak = run(variant(base, poly_len, chunk, device, batch), args.steps, args.seed)
+      print("%8d %8d %10.1f %14.1f %14s" % (poly_len, chunk, 1000*t_step, saved_peak/2**20,
+        "-" if gpu_peak is None else "%.1f" % (gpu_peak/2**20)))
+
+
+if __name__ == "__main__":
+  from argparse import ArgumentParser
+  parser = ArgumentParser(prog="benchmark_checkpointing")
+  parser.add_argument("fpath")
+  parser.add_argument("--lengths", dest="lengths", type=int, nargs="+", default=[12, 24, 36, 48, 96])
+  parser.add_argument("--chunks", dest="chunks", type=int, nargs="+", default=[0, 1, 2])
+  parser.add_argument("--steps", dest="steps", type=int, default=5)
+  parser.add_argument("--batch", dest="batch", type=int, default=None)
+  parser.add_argument("--device", dest="device", default=None)
+  parser.add_argument("--seed", dest="seed", type=int, default=0)
+  main(parser.parse_args())
@@ -0,0 +1,70 @@
+import time
+import copy
+
+import torch
+import numpy as np
+
+from config import Config, load
+from sims import equilibrium_sample, get_dataset
+from test_model import get_continuation_dataset, get_sample_step, gaussian_kl_div
+
+
+# Compare GAN training with and without the "reuse_gen_sample" option (see gan_common.disc_and_gen_steps).
+# Both variants start from the same fresh model with the architecture and hyperparameters of a saved model,
+# and train on the same data. We report time per train_step, and the Gaussian KL divergence of the predicted
+# next states (like get_model_perf_estimates.py) after training for --steps steps.
+#
+#   python benchmark_gan_step.py models/my_model.pt --steps 2048
+
+
+def variant(config, reuse):
+  args, kwargs = config.get_args_and_kwargs()
+  kwargs = dict(kwargs, arch_specific=dict(kwargs["arch_specific"], reuse_gen_sample=reuse))
+  return Config(*args, **kwargs)
+
+def get_batches(config, steps):
+  trajs = get_dataset(config, equilibrium_sample(config, steps*config.batch), config.simlen).to(config.device, torch.float32)
+  N, L, state_dim = trajs.shape
+  for i in range(0, N, config.batch):
+    batch = trajs[i:i + config.batch]
+    n = batch.shape[0]
+    yield batch[:, 1:].reshape(n*(L - 1), state_dim), config.cond(batch[:, :-1].reshape(n*(L - 1), state_dim))
+
+def kl_div(model, x0, x1):
+  sample_step = get_sample_step(model)
+  samples, contins, state_dim = x1.shape
+  x1_hat = sample_step(x0.reshape(-1, state_dim).to(torch.float32)).reshape(samples, contins, state_dim)
+  divs = np.array([gaussian_kl_div(x1[i].to(torch.float32), x1_hat[i]) for i in range(samples)])
+  return divs.mean(), divs.std()/samples**0.5
+
+def main(args):
+  base = load(args.fpath).config
+  torch.manual_seed(args.seed)
+  batches = list(get_batches(base, args.steps))
+  x0, x1 = get_continuation_dataset(args.samples, args.contins, base)
+  torch.manual_seed(args.seed)
+  init = base.modelclass.makenew(base)
+  for reuse in [False, True]:
+    config = variant(base, reuse)
+    model = config.modelclass.load_from_dict(copy.deepcopy(init.save_to_dict()), config)
+    torch.manual_seed(args.seed + 1)
+    times = []
+    for data, cond in batches:
+      t0 = time.perf_counter()
+      model.train_step(data, cond)
+      if torch.device(config.device).type == "cuda": torch.cuda.synchronize()
+      times.append(time.perf_counter() - t0)
+    t_step = np.median(times[1:]) if len(times) > 1 else times[0]
+    div_μ, div_uμ = kl_div(model, x0, x1)
+    print("reuse_gen_sample=%s:  %.1f ms/step   KL = %f ± %f" % (reuse, 1000*t_step, div_μ, div_uμ))
+
+
+if __name__ == "__main__":
+  from argparse import ArgumentParser
+  parser = ArgumentParser(prog="benchmark_gan_step")
+  parser.add_argument("fpath")
+  parser.add_argument("--steps", dest="steps", type=int, default=1024)
+  parser.add_argument("--samples", dest="samples", type=int, default=8)
+  parser.add_argument("--contins", dest="contins", type=int, default=1024)
+  parser.add_argument("--seed", dest="seed", type=int, default=0)
+  main(parser.parse_args())
@@ -0,0 +1,106 @@
+import time
+
+import torch
+
+from layers_common import *
+
+
+# Compare the message passing implementations of the graph layers in layers_common: the backends in
+# GRAPH_BACKENDS on general graphs, and slicing on path graphs. We benchmark on a chain graph, like the one the
+# 3D archs build, and on a dense (complete) graph. For each layer, we run the same inputs through every
+# implementation, check that the outputs and input gradients are identical to those of the first one, and
+# report the time for a forward and backward pass. With more than 2 edges per node, sums can be done in a
+# different order (and the dense backend folds the normalisation into its matrix), so we also report the
+# largest difference. graph_backend="autotune" makes this choice automatically, per op and input shape.
+#
+#   python benchmark_graph_layers.py --nodes 12 --batch 64 --dim 64
+
+
+LAYERS = [ # (layer class, input is vector, input lives on edges)
+  (ScalNodesConv, False, False),
+  (VecNodesConv, True, False),
+  (ScalEdgesRead, False, False),
+  (VecEdgesRead, True, False),
+  (ScalEdgesWrite, False, True),
+  (VecEdgesWrite, True, True),
+]
+GRAPH_OPS = [ # (Graph method, input lives on edges), just the message passing part of the layers
+  ("normed_neighbour_sum", False),
+  ("gather_src", False),
+  ("scatter_src", True),
+]
+
+
+def dense_graph(n_nodes, device):
+  """ complete graph, edges i -> j for all i != j """
+  src, dst = torch.meshgrid(torch.arange(n_nodes, device=device), torch.arange(n_nodes, device=device), indexing="ij")
+  mask = (src != dst)
+  return src[mask], dst[mask]
+
+def get_graphs(kind, n_nodes, device):
+  """ dict of variant name: graph, for all the implementations that apply to this kind of graph """
+  if kind == "chain":
+    ref = path_graph(n_nodes, device)
+    src, dst = ref.src, ref.dst
+  else:
+    src, dst = dense_graph(n_nodes, device)
+  backends = [backend for backend in GRAPH_BACKENDS
+    if backend not in ["auto", "autotune"] and (backend != "torch_scatter" or scatter is not None)]
+  ans = {backend: Graph(src, dst, n_nodes, path=False, backend=backend) for backend in backends}
+  if kind == "chain":
+    ans["path"] = ref
+  return ans
+
+def time_fn(fn, x, reps, device):
+  """ time forward and backward pass of fn(x), return time, output and input gradient """
+  def run():
+    x.grad = None
+    y = fn(x)
+    y.backward(torch.ones_like(y))
+    return y
+  run() # warmup
+  if device.type == "cuda": torch.cuda.synchronize()
+  t0 = time.perf_counter()
+  for _ in range(reps):
+    y = run()
+  if device.type == "cuda": torch.cuda.synchronize()
+  return (time.perf_counter() - t0)/reps, y.detach(), x.grad.clone()
+
+def compare(name, fn, x, graphs, reps, device):
+  results = {variant: time_fn(lambda x: fn(x, graph), x, reps, device) for variant, graph in graphs.items()}
+  _, y_ref, grad_ref = results[next(iter(graphs))]
+  row = ["%-24s" % name]
+  for t, y, grad in results.values():
+    identical = torch.equal(y, y_ref) and torch.equal(grad, grad_ref)
+    diff = max((y - y_ref).abs().max().item(), (grad - grad_ref).abs().max().item())
+    row.append("%9.3f %5s" % (1000*t, "=" if identical else "~%.0e" % diff))
+  print(" ".join(row))
+
+def main(args):
+  device = torch.device(args.device)
+  torch.manual_seed(args.seed)
+  for kind in ["chain", "dense"]:
+    graphs = get_graphs(kind, args.nodes, device)
+    edges = next(iter(graphs.values())).src.shape[0]
+    print("\n%s graph, %d nodes, %d edges. times in ms, = means identical to %s" % (kind, args.nodes, edges, next(iter(graphs))))
+    print(" ".join(["%-24s" % "layer"] + ["%15s" % variant for variant in graphs]))
+    for layercls, vec, on_edges in LAYERS:
+      layer = layercls(args.dim, args.dim).to(device)
+      shape = (args.batch, edges if on_edges else args.nodes) + ((3,) if vec else ()) + (args.dim,)
+      compare(layercls.__name__, layer, torch.randn(*shape, device=device, requires_grad=True), graphs, args.reps, device)
+    for method, on_edges in GRAPH_OPS:
+      shape = (args.batch, edges if on_edges else args.nodes, 3, args.dim)
+      compare("Graph." + method, lambda x, graph: getattr(graph, method)(x),
+        torch.randn(*shape, device=device, requires_grad=True), graphs, args.reps, device)
+
+
+if __name__ == "__main__":
+  from argparse import ArgumentParser
+  parser = ArgumentParser(prog="benchmark_graph_layers")
+  parser.add_argument("--nodes", dest="nodes", type=int, default=12)
+  parser.add_argument("--batch", dest="batch", type=int, default=64)
+  parser.add_argument("--dim", dest="dim", type=int, default=64)
+  parser.add_argument("--reps", dest="reps", type=int, default=200)
+  parser.add_argument("--device", dest="device", default="cuda" if torch.cuda.is_available() else "cpu")
+  parser.add_argument("--seed", dest="seed", type=int, default=0)
+  main(parser.parse_args())
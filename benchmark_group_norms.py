@@ -0,0 +1,91 @@
+import time
+
+import torch
+
+from layers_common import ScalGroupNorm, VecGroupNorm
+
+
+# Compare the fused group norms in layers_common with the straightforward computation below (which is how they
+# used to be written). For each norm, we run the same inputs and weights through both, check that the outputs and
+# the gradients of the inputs and weights agree, and report the time for a forward and backward pass, and the
+# memory kept for the backward pass (all tensors saved by autograd, counting each storage once).
+#
+#   python benchmark_group_norms.py --batch 64 --nodes 24 --chan 128 --groups 8
+
+
+def scal_group_norm_reference(norm, x):
+  batch, nodes, chan = x.shape
+  x = x.reshape(batch, nodes, norm.groups, -1)
+  mean = x.mean([1, 3], keepdim=True)
+  x_shift = x - mean
+  var = ((x_shift)**2).mean([1, 3], keepdim=True)
+  ans = x_shift/torch.sqrt(norm.epsilon + var)
+  return norm.beta + norm.gamma*ans.reshape(batch, nodes, chan)
+
+def vec_group_norm_reference(norm, x):
+  batch, nodes, _, chan = x.shape
+  x = x.reshape(batch, nodes, 3, norm.groups, -1)
+  moment2 = (x**2).sum(2, keepdim=True).mean([1, 4], keepdim=True)
+  ans = x/torch.sqrt(norm.epsilon + moment2)
+  return norm.gamma[:, 0]*ans.reshape(batch, nodes, 3, chan)
+
+
+def saved_bytes(fn, x):
+  """ bytes of tensor storage that autograd keeps for the backward pass of fn(x) """
+  storages = {}
+  def pack(t):
+    storages[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+    return t
+  with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+    fn(x)
+  storages.pop(x.untyped_storage().data_ptr(), None) # the input is kept alive by the caller anyway
+  return sum(storages.values())
+
+def time_fn(fn, x, params, reps, device):
+  """ time forward and backward pass of fn(x), return time, output and gradients of x and params """
+  def run():
+    y = fn(x)
+    grads = torch.autograd.grad(y, [x] + params, torch.ones_like(y))
+    return y, grads
+  run() # warmup
+  if device.type == "cuda": torch.cuda.synchronize()
+  t0 = time.perf_counter()
+  for _ in range(reps):
+    y, grads = run()
+  if device.type == "cuda": torch.cuda.synchronize()
+  return (time.perf_counter() - t0)/reps, y.detach(), grads
+
+def compare(name, norm, reference, x, reps, device):
+  params = list(norm.parameters())
+  for param in params: # not the default init, so that the check covers gamma and beta
+    torch.nn.init.normal_(param.data, 1., 0.5)
+  print("%s %s" % (name, tuple(x.shape)))
+  results = {}
+  for variant, fn in [("reference", lambda x: reference(norm, x)), ("fused", norm)]:
+    results[variant] = time_fn(fn, x, params, reps, device)
+    print("  %-10s %9.3f ms %9.1f kB saved for backward" % (variant, 1000*results[variant][0], saved_bytes(fn, x)/1024))
+  (_, y_ref, grads_ref), (_, y, grads) = results["reference"], results["fused"]
+  for what, a, b in [("output", y, y_ref)] + list(zip(["grad x"] + ["grad " + k for k, _ in norm.named_parameters()], grads, grads_ref)):
+    print("  %-10s max rel diff %.1e" % (what, ((a - b).abs().max()/b.abs().max()).item()))
+
+
+def main(args):
+  device = torch.device(args.device)
+  torch.manual_seed(args.seed)
+  compare("ScalGroupNorm", ScalGroupNorm(args.chan, args.groups).to(device), scal_group_norm_reference,
+    (1. + 3*torch.randn(args.batch, args.nodes, args.chan, device=device)).requires_grad_(), args.reps, device)
+  compare("VecGroupNorm", VecGroupNorm(args.chan, args.groups).to(device), vec_group_norm_reference,
+    (3*torch.randn(args.batch, args.nodes, 3, args.chan, device=device)).requires_grad_(), args.reps, device)
+
+
+if __name__ == "__main__":
+  from argparse import ArgumentParser
+  parser = ArgumentParser(prog="benchmark_group_norms")
+  parser.add_argument("--batch", dest="batch", type=int, default=64)
+  parser.add_argument("--nodes", dest="nodes", type=int, default=24)
+  parser.add_argument("--chan", dest="chan", type=int, default=128)
+  parser.add_argument("--groups", dest="groups", type=int, default=8)
+  parser.add_argument("--reps", dest="reps", type=int, default=100)
+  parser.add_argument("--device", dest="device", default="cuda" if torch.cuda.is_available() else "cpu")
+  parser.add_argument("--seed", dest="seed", type=int, default=0)
+  main(parser.parse_args())
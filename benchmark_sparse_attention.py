@@ -0,0 +1,101 @@
+import time
+
+import torch
+
+from attention_layers import ProximityAttention
+
+
+# Compare sparse ProximityAttention (each query attends to its topk nearest keys, the "attn_topk" arch_specific key)
+# with the dense layer, on random polymers of increasing length: the positions are random walks with unit variance
+# steps, and the key and query probe points are near the beads. For each length and topk, we run the same inputs and
+# weights through both, and report the time for a forward and backward pass, the memory kept for backward, the
+# attention weight the sparse layer leaves out (from sparse_dropped_mass()), and the largest difference in outputs
+# with the bound on it that follows from that mass, both relative to the largest dense output. We check that the
+# error is within the bound. Heads with large r0 see far keys, so for a given accuracy topk has to grow with the
+# largest r0.
+#
+#   python benchmark_sparse_attention.py --nodes 24 48 96 192 384 --topk 8 16 32 --r0 2 3 4 6 8 12 16 24
+
+
+def saved_bytes(fn, x):
+  """ bytes of tensor storage that autograd keeps for the backward pass of fn(x) """
+  storages = {}
+  def pack(t):
+    storages[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+    return t
+  with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+    fn(x)
+  for t in x: # the inputs are kept alive by the caller anyway
+    storages.pop(t.untyped_storage().data_ptr(), None)
+  return sum(storages.values())
+
+def time_fn(fn, x, reps, device):
+  """ time forward and backward pass of fn(x), return time and output """
+  def run():
+    aans, vans = fn(x)
+    torch.autograd.backward([aans, vans], [torch.ones_like(aans), torch.ones_like(vans)])
+    return aans, vans
+  run() # warmup
+  if device.type == "cuda": torch.cuda.synchronize()
+  t0 = time.perf_counter()
+  for _ in range(reps):
+    aans, vans = run()
+  if device.type == "cuda": torch.cuda.synchronize()
+  return (time.perf_counter() - t0)/reps, aans.detach(), vans.detach()
+
+def max_message(attn, ax, vx):
+  """ largest possible entry of a value message (direction vectors have length at most 1) """
+  aval = torch.einsum("hij, bnj -> bnhi", attn.W_aval, ax).abs()
+  v2aval = torch.linalg.vector_norm(torch.einsum("hij, bnvj -> bnhiv", attn.W_v2aval, vx), dim=-1)
+  vval = torch.einsum("hij, bnvj -> bnvhi", attn.W_vval, vx).abs()
+  a2vval = torch.einsum("hij, bnj -> bnhi", attn.W_a2vval, ax).abs()
+  return max((aval + v2aval).max().item(), (vval + a2vval[:, :, None]).max().item())
+
+def random_inputs(args, nodes, device):
+  pos = torch.randn(args.batch, nodes, 3, device=device).cumsum(1)
+  pos_k = pos + 0.3*torch.randn_like(pos)
+  pos_q = pos + 0.3*torch.randn_like(pos)
+  ax = torch.randn(args.batch, nodes, args.adim, device=device, requires_grad=True)
+  vx = (0.577*torch.randn(args.batch, nodes, 3, args.vdim, device=device)).requires_grad_()
+  return (ax, vx), pos_k, pos_q
+
+def main(args):
+  device = torch.device(args.device)
+  torch.manual_seed(args.seed)
+  attn = ProximityAttention(args.r0, (args.kq_dim, args.kq_dim), (args.adim, args.vdim)).to(device)
+  attn.self_init()
+  print("times in ms, memory in MB, error and bound are relative to the largest dense output")
+  print("%8s %8s %10s %10s %12s %12s %12s" % ("nodes", "topk", "time", "saved", "dropped", "error", "bound"))
+  for nodes in args.nodes:
+    x, pos_k, pos_q = random_inputs(args, nodes, device)
+    fn = lambda x: attn(x, pos_k, pos_q)
+    attn.topk = 0
+    t, aans_ref, vans_ref = time_fn(fn, x, args.reps, device)
+    print("%8d %8s %10.2f %10.2f" % (nodes, "dense", 1000*t, saved_bytes(fn, x)/2**20))
+    for topk in args.topk:
+      if topk >= nodes: continue
+      attn.topk = topk
+      t, aans, vans = time_fn(fn, x, args.reps, device)
+      scale = max(aans_ref.abs().max().item(), vans_ref.abs().max().item())
+      error = max((aans - aans_ref).abs().max().item(), (vans - vans_ref).abs().max().item())/scale
+      dropped = attn.sparse_dropped_mass(x, pos_k, pos_q).item()
+      bound = 2*dropped*max_message(attn, *x)/scale
+      print("%8d %8d %10.2f %10.2f %12.2e %12.2e %12.2e" % (nodes, topk, 1000*t, saved_bytes(fn, x)/2**20,
+        dropped, error, bound))
+      assert error <= bound + 1e-5, "sparse attention error is larger than its bound"
+
+
+if __name__ == "__main__":
+  from argparse import ArgumentParser
+  parser = ArgumentParser(prog="benchmark_sparse_attention")
+  parser.add_argument("--nodes", dest="nodes", type=int, nargs="+", default=[24, 48, 96, 192, 384])
+  parser.add_argument("--topk", dest="topk", type=int, nargs="+", default=[8, 16, 32])
+  parser.add_argument("--r0", dest="r0", type=float, nargs="+", default=[2., 3., 4., 6., 8., 12., 16., 24.])
+  parser.add_argument("--batch", dest="batch", type=int, default=8)
+  parser.add_argument("--adim", dest="adim", type=int, default=64)
+  parser.add_argument("--vdim", dest="vdim", type=int, default=32)
+  parser.add_argument("--kq_dim", dest="kq_dim", type=int, default=8)
+  parser.add_argument("--reps", dest="reps", type=int, default=10)
+  parser.add_argument("--device", dest="device", default="cuda" if torch.cuda.is_available() else "cpu")
+  parser.add_argument("--seed", dest="seed", type=int, default=0)
+  main(parser.parse_args())
@@ -0,0 +1,233 @@
+import os
+import sys
+import copy
+import random
+import shutil
+import tempfile
+from collections import OrderedDict
+from threading import Thread, Condition
+
+import torch
+
+from config import Config, checkpoint_dict
+
+
+def host_snapshot(obj):
+  """ copy a checkpoint dictionary so that later training steps can't modify it.
+      tensors in module state dicts (OrderedDicts) are copied to host memory, other
+      objects (eg. Koopman transforms) are deep-copied as-is so they load back onto
+      the device they came from. """
+  if isinstance(obj, OrderedDict):
+    return OrderedDict((key, to_host(val)) for key, val in obj.items())
+  if isinstance(obj, dict):
+    return {key: host_snapshot(val) for key, val in obj.items()}
+  if isinstance(obj, (list, tuple)):
+    return type(obj)(host_snapshot(val) for val in obj)
+  return copy.deepcopy(obj)
+
+def to_host(obj):
+  """ recursively copy all tensors in obj to host memory """
+  if isinstance(obj, torch.Tensor):
+    return obj.detach().to("cpu", copy=True)
+  if isinstance(obj, dict):
+    return type(obj)((key, to_host(val)) for key, val in obj.items())
+  if isinstance(obj, (list, tuple)):
+    return type(obj)(to_host(val) for val in obj)
+  return copy.deepcopy(obj)
+
+
+def _get_umask():
+  umask = os.umask(0)
+  os.umask(umask)
+  return umask
+# read once at import, since os.umask can only be read by setting it, which would race with the writer thread
+_FILE_MODE = 0o666 & ~_get_umask()
+
+def atomic_save(data, path):
+  """ torch.save data to a temp file in the same directory, then rename it over path.
+      readers of path will either see the old checkpoint or the new one, never half of one. """
+  dirname = os.path.dirname(os.path.abspath(path))
+  fd, tmp_path = tempfile.mkstemp(prefix=".tmp_", suffix=".pt", dir=dirname)
+  try:
+    with os.fdopen(fd, "wb") as f:
+      torch.save(data, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.chmod(tmp_path, _FILE_MODE) # mkstemp makes the file owner-only, give it the mode torch.save would have
+    os.replace(tmp_path, path)
+  except BaseException:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+    raise
+
+def atomic_alias(src_path, path):
+  """ make path refer to the checkpoint currently at src_path without serializing it again.
+      we hardlink where possible (later atomic_save's to src_path replace the directory entry,
+      so the alias keeps the old contents), and fall back to copying the file. Either way the
+      alias gets the same permissions as a file written by atomic_save. """
+  dirname = os.path.dirname(os.path.abspath(path))
+  fd, tmp_path = tempfile.mkstemp(prefix=".tmp_", suffix=".pt", dir=dirname)
+  os.close(fd)
+  os.remove(tmp_path)
+  try:
+    try:
+      os.link(src_path, tmp_path)
+    except OSError:
+      shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, path)
+  except BaseException:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+    raise
+
+
+class _Job:
+  def __init__(self, data, path, aliases, on_written):
+    self.data = data
+    self.path = path
+    self.aliases = aliases
+    self.on_written = on_written
+
+
+class CheckpointWriter:
+  """ writes checkpoints on a background thread.
+      submit() snapshots the model to host memory and returns immediately, the writer
+      thread then does the torch.save to disk. At most max_in_flight snapshots are held
+      in memory: if the writer falls behind, a pending snapshot that would just be
+      overwritten by the new one (same path, no aliases) is dropped instead of making the
+      training loop wait. Only if all pending snapshots have aliases do we block. """
+  def __init__(self, max_in_flight=2):
+    assert max_in_flight >= 1
+    self.max_in_flight = max_in_flight
+    self.pending = []
+    self.writing = False
+    self.closed = False
+    self.error = None
+    self.cond = Condition()
+    self.thread = Thread(target=self._thread_main, daemon=True)
+    self.thread.start()
+  def submit(self, model, path, aliases=(), extra=None, on_written=None):
+    """ queue a checkpoint of model to be written to path.
+        aliases: further paths that should get a copy of this checkpoint
+        extra: dict of additional entries to be stored in the checkpoint
+        on_written: called with path from the writer thread once the checkpoint is on disk """
+    self._check_error()
+    data = host_snapshot(checkpoint_dict(model))
+    if extra is not None:
+      data.update(to_host(extra))
+    job = _Job(data, path, list(aliases), on_written)
+    with self.cond:
+      assert not self.closed, "writer was closed"
+      if len(self.pending) >= self.max_in_flight:
+        self.pending = [old for old in self.pending if old.aliases or old.path != path]
+      while len(self.pending) >= self.max_in_flight and self.error is None:
+        self.cond.wait()
+      self.pending.append(job)
+      self.cond.notify_all()
+    self._check_error()
+  def flush(self):
+    """ block until all queued checkpoints are on disk """
+    with self.cond:
+      while (self.pending or self.writing) and self.error is None:
+        self.cond.wait()
+    self._check_error()
+  def close(self):
+    """ flush and stop the writer thread """
+    with self.cond:
+      self.closed = True
+      self.cond.notify_all()
+    self.thread.join()
+    self._check_error()
+  def _check_error(self):
+    if self.error is not None:
+      error, self.error = self.error, None
+      raise RuntimeError("checkpoint writer failed") from error
+  def _thread_main(self):
+    while True:
+      with self.cond:
+        while not self.pending and not self.closed:
+          self.cond.wait()
+        if not self.pending: # closed, and nothing left to write
+          return
+        job = self.pending.pop(0)
+        self.writing = True
+        self.cond.notify_all()
+      try:
+        atomic_save(job.data, job.path)
+        for alias in job.aliases:
+          atomic_alias(job.path, alias)
+        if job.on_written is not None:
+          job.on_written(job.path)
+      except BaseException as e:
+        with self.cond:
+          self.error = e
+          self.pending = []
+      finally:
+        with self.cond:
+          self.writing = False
+          self.cond.notify_all()
+
+
+
+# full training state, so that an interrupted run can resume where it left off:
+
+COUNTER_ATTRS = ["step_count"] # integer counters that models use for lr schedules etc.
+
+def get_optimizers(model):
+  """ find all optimizers belonging to a model, as a dict from attribute name to optimizer """
+  return {name: val for name, val in vars(model).items() if isinstance(val, torch.optim.Optimizer)}
+
+def get_rng_states():
+  ans = {
+      "torch": torch.get_rng_state(),
+      "python": random.getstate(),
+    }
+  if torch.cuda.is_available():
+    ans["cuda"] = torch.cuda.get_rng_state_all()
+  if "numpy" in sys.modules: # only bother with numpy if someone is using it
+    ans["numpy"] = sys.modules["numpy"].random.get_state()
+  return ans
+
+def set_rng_states(states):
+  torch.set_rng_state(states["torch"])
+  random.setstate(states["python"])
+  if "cuda" in states and torch.cuda.is_available():
+    torch.cuda.set_rng_state_all(states["cuda"])
+  if "numpy" in states:
+    import numpy as np
+    np.random.set_state(states["numpy"])
+
+def training_state(model, trainer, step):
+  """ everything besides the model weights that we need to continue training exactly where we
+      left off. step is the number of training steps that have been completed.
+      note: the dataset generator thread shares the torch RNG with the training loop, so
+      the data sequence after a resume is statistically but not bitwise identical. """
+  ans = {
+      "step": step,
+      "optimizers": {name: optim.state_dict() for name, optim in get_optimizers(model).items()},
+      "counters": {attr: getattr(model, attr) for attr in COUNTER_ATTRS if hasattr(model, attr)},
+      "rng": get_rng_states(),
+    }
+  if hasattr(trainer, "save_to_dict"):
+    ans["trainer"] = trainer.save_to_dict()
+  return ans
+
+def restore_training_state(model, trainer, state):
+  """ inverse of training_state(), returns the step to continue from """
+  optimizers = get_optimizers(model)
+  assert set(optimizers) == set(state["optimizers"]), "checkpoint optimizers don't match model"
+  for name, optim in optimizers.items():
+    optim.load_state_dict(state["optimizers"][name])
+  for attr, val in state["counters"].items():
+    setattr(model, attr, val)
+  if "trainer" in state:
+    trainer.load_from_dict(state["trainer"])
+  set_rng_states(state["rng"])
+  return state["step"]
+
+def load_training(path):
+  """ like config.load(), but also returns the training state saved with the model """
+  data = torch.load(path, weights_only=False)
+  assert "training" in data, "checkpoint %s has no training state, can't resume from it" % path
+  config = Config(*data["args"], **data["kwargs"])
+  return config.modelclass.load_from_dict(data["states"], config), data["training"]
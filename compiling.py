@@ -0,0 +1,110 @@
+import os
+
+import torch
+import torch.nn as nn
+
+
+# torch.compile support. With Config(..., compile_mode="modules"), train.train() compiles every nn.Module
+# belonging to the model (generator, discriminator, diffusion model, VAMPNet, ...) with static shapes.
+# compile_mode="train_step" additionally compiles the model's whole train_step method. For an ensemble (see
+# ensemble.py), these are the StackedModule's and train_step of its lead model.
+# If compiling something fails on its first call (eg. because of an op that dynamo can't trace), we print a warning,
+# undo whatever that call had already changed (weights, buffers, optimizer states, RNG states), and fall back to
+# running it eagerly, so training continues either way. Other errors, and errors on later calls, are raised.
+# Compiled kernels are cached in COMPILE_CACHE_DIR, which is shared between all runs, so in a sweep of
+# many runs with the same architecture the compilation cost is only paid once.
+
+
+COMPILE_MODES = ["none", "modules", "train_step"]
+COMPILE_CACHE_DIR = "compile_cache"
+
+
+def _default_cache_dir():
+  try:
+    from torch._inductor.runtime.cache_dir_utils import default_cache_dir
+    return os.path.abspath(default_cache_dir())
+  except ImportError: # older pytorch
+    return None
+
+def setup_cache():
+  """ make sure that caching of compiled code is switched on, and that it goes to COMPILE_CACHE_DIR unless
+      TORCHINDUCTOR_CACHE_DIR was set by the user. (importing torch._dynamo sets it to pytorch's default, so we
+      override that value too.) inductor reads the variable whenever it looks something up in its cache """
+  cache_dir = os.environ.get("TORCHINDUCTOR_CACHE_DIR")
+  if cache_dir is None or os.path.abspath(cache_dir) == _default_cache_dir():
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(COMPILE_CACHE_DIR)
+  import torch._inductor.config as inductor_config
+  inductor_config.fx_graph_cache = True
+  if hasattr(inductor_config, "autotune_local_cache"):
+    inductor_config.autotune_local_cache = True
+
+
+def compile_errors():
+  """ the exceptions that torch.compile raises when it can't compile something """
+  from torch._dynamo import exc
+  return tuple(getattr(exc, name) for name in ["BackendCompilerFailed", "Unsupported", "InternalTorchDynamoError"]
+    if hasattr(exc, name))
+
+def snapshot(modules, model=None):
+  """ copy the state that a call might change: weights and buffers of modules, RNG states, and if model is given,
+      its optimizer states and counters. returns a function that restores it """
+  from checkpointing import host_snapshot, training_state, restore_training_state, get_rng_states, set_rng_states
+  module_states = [host_snapshot(module.state_dict()) for module in modules]
+  rng_states = get_rng_states()
+  train_state = None if model is None else host_snapshot(training_state(model, None, 0))
+  def restore():
+    for module, state in zip(modules, module_states):
+      module.load_state_dict(state)
+    if train_state is not None:
+      restore_training_state(model, None, train_state)
+    set_rng_states(rng_states)
+  return restore
+
+
+class _FallbackToEager:
+  """ calls the compiled function. if compiling fails on the first call, restores the state from before that call
+      (see snapshot()) and calls the eager function from then on """
+  def __init__(self, compiled, eager, name, get_snapshot):
+    self.compiled = compiled
+    self.eager = eager
+    self.name = name
+    self.get_snapshot = get_snapshot
+    self.first_call = True
+    self.failed = False
+  def __call__(self, *args, **kwargs):
+    if self.failed or torch.compiler.is_compiling(): # when tracing eg. train_step, trace through the eager function
+      return self.eager(*args, **kwargs)
+    if not self.first_call:
+      return self.compiled(*args, **kwargs)
+    self.first_call = False
+    restore = self.get_snapshot()
+    try:
+      return self.compiled(*args, **kwargs)
+    except compile_errors() as e:
+      print("warning: compiling %s failed, running it eagerly instead. %s: %s" % (
+        self.name, type(e).__name__, (str(e).splitlines() or [""])[0]))
+      self.failed = True
+    restore()
+    return self.eager(*args, **kwargs)
+
+
+def compile_module(module, name):
+  """ compile module's forward in place, so its state_dict() keys don't change (hooks still run eagerly) """
+  eager = module.forward
+  module.forward = _FallbackToEager(torch.compile(eager, dynamic=False), eager, name, lambda: snapshot([module]))
+
+
+def compile_model(model, compile_mode):
+  """ compile the parts of model that compile_mode asks for """
+  assert compile_mode in COMPILE_MODES, "unknown compile mode %s" % compile_mode
+  if compile_mode == "none":
+    return
+  model = getattr(model, "lead", model) # ensembles keep their (stacked) modules and train_step in the lead model
+  setup_cache()
+  for name, val in vars(model).items():
+    if isinstance(val, nn.Module):
+      compile_module(val, name)
+  if compile_mode == "train_step":
+    modules = [val for val in vars(model).values() if isinstance(val, nn.Module)]
+    model.train_step = _FallbackToEager(torch.compile(model.train_step, dynamic=False), model.train_step, "train_step",
+      lambda: snapshot(modules, model))
@@ -3,6 +3,11 @@ import importlib
 
 from sims import sims
 from polymer_util import rouse_block
+from precision import PRECISIONS
+from compiling import COMPILE_MODES
+from profiling import PROFILE_MODES
+from early_stopping import EARLY_STOPPING
+from layers_common import GRAPH_BACKENDS
 
 
 ARCH_PREFIX = "archs."
@@ -18,8 +23,8 @@ class Condition:
 class Config:
   """ configuration class for training runs """
   def __init__(self, sim_name, arch_name,
-               cond=Condition.COORDS, x_only=False, subtract_mean=False, device="cuda",
-               batch=16, simlen=16, t_eql=0, nsteps=65536, save_every=512,
+               cond=Condition.COORDS, x_only=False, subtract_mean=False, device="cuda", precision="fp32",
+               compile_mode="none", profile="none", early_stopping="none", graph_backend="auto", batch=16, simlen=16, t_eql=0, nsteps=65536, save_every=512,
                koopman_model_path=None, n_rouse_modes=None, vae_model_path=None,
                arch_specific=None):
     self.sim_name = sim_name
@@ -29,6 +34,16 @@ class Config:
     self.x_only = x_only
     self.subtract_mean = subtract_mean
     self.device = device
+    assert precision in PRECISIONS, "precision should be one of %s, see precision.py" % str(PRECISIONS)
+    self.precision = precision
+    assert compile_mode in COMPILE_MODES, "compile_mode should be one of %s, see compiling.py" % str(COMPILE_MODES)
+    self.compile_mode = compile_mode
+    assert profile in PROFILE_MODES, "profile should be one of %s, see profiling.py" % str(PROFILE_MODES)
+    self.profile = profile
+    assert early_stopping in EARLY_STOPPING, "early_stopping should be one of %s, see early_stopping.py" % str(EARLY_STOPPING)
+    self.early_stopping = early_stopping
+    assert graph_backend in GRAPH_BACKENDS, "graph_backend should be one of %s, see layers_common.py" % str(GRAPH_BACKENDS)
+    self.graph_backend = graph_backend
     self.batch = batch
     self.simlen = simlen
     self.t_eql = t_eql
@@ -106,6 +121,11 @@ class Config:
         "x_only": self.x_only,
         "subtract_mean": self.subtract_mean,
         "device": self.device,
+        "precision": self.precision,
+        "compile_mode": self.compile_mode,
+        "profile": self.profile,
+        "early_stopping": self.early_stopping,
+        "graph_backend": self.graph_backend,
         "batch": self.batch,
         "simlen": self.simlen,
         "t_eql": self.t_eql,
@@ -145,22 +165,25 @@ class Config:
 # * @staticmethod .makenew()        creates a new instance of the model
 
 def load_config(path):
-  data = torch.load(path)
+  data = torch.load(path, weights_only=False) # checkpoints hold non-tensor objects (transforms, training state)
   return Config(*data["args"], **data["kwargs"])
 
 def load(path):
-  data = torch.load(path)
+  data = torch.load(path, weights_only=False) # checkpoints hold non-tensor objects (transforms, training state)
   config = Config(*data["args"], **data["kwargs"])
   return config.modelclass.load_from_dict(data["states"], config)
 
-def save(model, path):
+def checkpoint_dict(model):
+  """ the dictionary that save() writes to disk for a model """
   config_args, config_kwargs = model.config.get_args_and_kwargs()
-  states = model.save_to_dict()
-  torch.save({
+  return {
       "args": config_args,
       "kwargs": config_kwargs,
-      "states": states,
-    }, path)
+      "states": model.save_to_dict(),
+    }
+
+def save(model, path):
+  torch.save(checkpoint_dict(model), path)
 
 def makenew(config):
   return config.modelclass.makenew(config)
@@ -0,0 +1,93 @@
+import os
+import queue
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+
+# Training diagnostics for the small wgan_nochain* GANs: a history of the weights, and frames showing the
+# generated distribution, the discriminator and the weight history, saved as slides/<frame>.png.
+# To keep the cost of this a small fixed fraction of the training time, the weights are only sampled every
+# WEIGHTS_EVERY steps, with a single gather that stays on the device (no sync), and frames are only recorded
+# every FRAME_EVERY steps. Recording a frame copies all the data to the host in one go, and the figure is
+# drawn and saved by a background process. If that process falls behind, frames are dropped. At the end of
+# training, train() calls the model's close(), which waits for the frames that are still queued to be saved.
+
+
+WEIGHTS_EVERY = 3
+FRAME_EVERY = 30
+SLIDES_DIR = "slides"
+MAX_QUEUED_FRAMES = 4
+
+
+class WeightHistory:
+  """ first element of each parameter of some modules, recorded every WEIGHTS_EVERY steps on the device """
+  def __init__(self, modules, nsteps, device):
+    self.params = [param for module in modules for param in module.parameters()]
+    self.history = torch.full((nsteps//WEIGHTS_EVERY + 1, len(self.params)), float("nan"), device=device)
+  def record(self, step):
+    if step % WEIGHTS_EVERY == 0 and step//WEIGHTS_EVERY < self.history.shape[0]:
+      with torch.no_grad():
+        self.history[step//WEIGHTS_EVERY] = torch.cat([param.detach().reshape(-1)[:1] for param in self.params])
+
+
+def _render_frame(path, frame):
+  import matplotlib
+  matplotlib.use("Agg")
+  import matplotlib.pyplot as plt
+  fig, (ax, ax_wts) = plt.subplots(nrows=2, ncols=1)
+  # hists of simulated and generated points
+  ax.hist(frame["x1"][:, 0], bins=20, alpha=0.4)
+  ax.hist(frame["x1_hat"][:, 0], bins=20, alpha=0.4)
+  if "points" in frame:
+    ax.scatter(frame["points"].ravel(), np.zeros(frame["points"].size))
+  # discriminator line
+  ax_disc = ax.twinx()
+  ax_disc.plot(frame["disc_x"], frame["disc_y"], color="green")
+  # weight history
+  steps = WEIGHTS_EVERY*np.arange(frame["weights"].shape[0])
+  for j in range(frame["weights"].shape[1]):
+    ax_wts.plot(steps, frame["weights"][:, j])
+  fig.savefig(path)
+  plt.close(fig)
+
+def _renderer_main(frames):
+  """ runs in the renderer process """
+  torch.set_num_threads(1)
+  while True:
+    job = frames.get()
+    if job is None:
+      return
+    _render_frame(*job)
+
+
+class FrameRenderer:
+  """ draws and saves frames in a background process, which is started when the first frame comes in """
+  def __init__(self):
+    self.process = None
+  def submit(self, i, frame):
+    """ frame: dict of tensors, see _render_frame() """
+    if self.process is None:
+      os.makedirs(SLIDES_DIR, exist_ok=True)
+      ctx = mp.get_context("spawn")
+      self.frames = ctx.Queue(maxsize=MAX_QUEUED_FRAMES)
+      self.process = ctx.Process(target=_renderer_main, args=(self.frames,), daemon=True)
+      self.process.start()
+    with torch.no_grad(): # copy everything to the host in one go
+      flat = torch.cat([val.detach().reshape(-1).to(torch.float32) for val in frame.values()]).cpu().numpy()
+    sizes = np.cumsum([val.numel() for val in frame.values()])[:-1]
+    frame = {key: arr.reshape(val.shape) for (key, val), arr in zip(frame.items(), np.split(flat, sizes))}
+    assert self.process.is_alive(), "frame renderer process died"
+    try:
+      self.frames.put_nowait((os.path.join(SLIDES_DIR, "%d.png" % i), frame))
+    except queue.Full: # renderer has fallen behind, drop this frame
+      pass
+  def close(self):
+    """ wait for the queued frames to be saved, and stop the background process """
+    if self.process is None:
+      return
+    if self.process.is_alive():
+      self.frames.put(None)
+    self.process.join()
+    self.process = None
@@ -0,0 +1,155 @@
+import os
+import sys
+import random
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+from config import Config
+from checkpointing import get_optimizers
+from utils import available_cores, split_cores, pin_to_cores
+
+
+# Data-parallel training of one model using several processes ("ranks") on a single machine.
+# Uses the gloo backend, so no GPU is needed. Usage (the __main__ guard is required, since ranks re-import the script):
+#
+#   if __name__ == "__main__":
+#     distributed_training_run("models/my_run.pt", Config(..., device="cpu"), world_size=4)
+#
+# Each rank has its own data pipeline, seeded differently, and trains on config.batch // world_size trajectories
+# per step, so the total batch size is the same as for single-process training. Gradients are averaged across
+# ranks right before each optimizer step. We do this with optimizer hooks rather than by wrapping modules in
+# DistributedDataParallel: DDP assumes one forward and one backward per step, while the GAN disc_step calls the
+# discriminator several times and backprops into both disc and gen, with separate optimizers for each. Hooking the
+# optimizers means that each of optim_d and optim_g reduces exactly the gradients it is about to apply.
+# Buffers aren't touched by the optimizers, so batch norm running stats drift apart between ranks. They are
+# averaged before each checkpoint, so that the checkpoint rank 0 writes represents all ranks.
+# Rank 0 does all logging and checkpointing, console output from other ranks is discarded.
+# Note: losses that aren't means over samples (eg. the VAMP score) are computed on each rank's share of the batch.
+
+
+def is_distributed():
+  return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+  return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+  return dist.get_world_size() if is_distributed() else 1
+
+def local_batch(config):
+  """ batch size that this rank should train on """
+  world_size = get_world_size()
+  assert config.batch % world_size == 0, "batch size %d not divisible by world size %d" % (config.batch, world_size)
+  return config.batch // world_size
+
+
+def any_rank(flag):
+  """ True on all ranks if flag is True on any rank """
+  if get_world_size() == 1:
+    return flag
+  tens = torch.tensor(int(flag))
+  dist.all_reduce(tens, op=dist.ReduceOp.MAX)
+  return bool(tens.item())
+
+
+def split_rng():
+  """ starting from the same RNG state on all ranks, give each rank its own RNG state """
+  seed = torch.randint(2**62, ()).item() + get_rank()
+  torch.manual_seed(seed)
+  random.seed(seed)
+  if "numpy" in sys.modules:
+    sys.modules["numpy"].random.seed(seed % 2**32)
+
+
+def get_modules(model):
+  return [val for val in vars(model).values() if isinstance(val, nn.Module)]
+
+def broadcast_model(model):
+  """ copy all weights and buffers of model from rank 0 to the other ranks """
+  for module in get_modules(model):
+    for tensor in list(module.parameters()) + list(module.buffers()):
+      dist.broadcast(tensor.data, 0)
+
+
+def average_buffers(model):
+  """ average floating point buffers of model (eg. batch norm running stats) across ranks, other buffers
+      (eg. batch norm batch counts) are copied from rank 0. call on all ranks """
+  if get_world_size() == 1: return
+  buffers = [buf for module in get_modules(model) for buf in module.buffers()]
+  floats = [buf for buf in buffers if buf.is_floating_point()]
+  if len(floats) > 0:
+    flat = _flatten_dense_tensors(floats)
+    dist.all_reduce(flat)
+    flat /= get_world_size()
+    for buf, avg in zip(floats, _unflatten_dense_tensors(flat, floats)):
+      buf.copy_(avg)
+  for buf in buffers:
+    if not buf.is_floating_point():
+      dist.broadcast(buf, 0)
+
+
+def _average_grads(optimizer, args, kwargs):
+  """ optimizer step pre-hook: replace each gradient by its average across ranks """
+  grads = [param.grad for group in optimizer.param_groups for param in group["params"] if param.grad is not None]
+  if len(grads) == 0: return
+  flat = _flatten_dense_tensors(grads) # one all_reduce for all of the gradients
+  dist.all_reduce(flat)
+  flat /= get_world_size()
+  for grad, avg in zip(grads, _unflatten_dense_tensors(flat, grads)):
+    grad.copy_(avg)
+
+def average_grads(model):
+  """ make all optimizers of model average their gradients across ranks before stepping """
+  for optim in get_optimizers(model).values():
+    optim.register_step_pre_hook(_average_grads)
+
+
+def _rank_main(rank, world_size, save_path, src, resume, seed, port, core_sets, threads_per_rank):
+  """ runs in each rank's process """
+  from train import train, load_source # import here, since train imports this module
+  if core_sets is not None:
+    pin_to_cores(core_sets[rank])
+  torch.set_num_threads(threads_per_rank)
+  os.environ["MASTER_ADDR"] = "127.0.0.1"
+  os.environ["MASTER_PORT"] = str(port)
+  dist.init_process_group("gloo", rank=rank, world_size=world_size)
+  if rank != 0:
+    sys.stdout = open(os.devnull, "w")
+  try:
+    torch.manual_seed(seed) # same seed everywhere, split_rng() is called once training starts
+    random.seed(seed)
+    if isinstance(src, tuple): # args and kwargs of a Config
+      src = Config(*src[0], **src[1])
+    model, resume_state = load_source(src, resume)
+    broadcast_model(model)
+    average_grads(model)
+    train(model, save_path, resume_state)
+  finally:
+    dist.destroy_process_group()
+
+
+def distributed_training_run(save_path, src, world_size=None, threads_per_rank=None, resume=False, seed=None, port=29500):
+  """ like train.training_run(), but data-parallel with world_size processes.
+      world_size: number of ranks (default: as many as fit on the available cores with threads_per_rank each)
+      threads_per_rank: torch threads per rank, each rank is pinned to this many cores
+      seed: random seed for model initialization and data, default is a random seed
+      port: TCP port on localhost used to set up communication between ranks """
+  n_cores = len(available_cores())
+  if world_size is None:
+    world_size = max(1, n_cores // (threads_per_rank or 1))
+  if threads_per_rank is None:
+    threads_per_rank = max(1, n_cores // world_size)
+  if isinstance(src, Config): # Config holds lambdas, so can't be pickled for the child processes
+    src = tuple(src.get_args_and_kwargs())
+  if seed is None:
+    seed = random.randrange(2**31)
+  core_sets = None # if the ranks don't fit on the cores, we don't pin them
+  if world_size*threads_per_rank <= n_cores:
+    core_sets = split_cores(world_size, threads_per_rank)
+  mp.spawn(_rank_main,
+    args=(world_size, save_path, src, resume, seed, port, core_sets, threads_per_rank),
+    nprocs=world_size, join=True)
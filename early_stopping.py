@@ -0,0 +1,41 @@
+import numpy as np
+
+
+# Rules for stopping training early, based on the history of an evaluation metric (lower is better, see
+# evaluation.py for how it's computed). Checked every time a checkpoint is saved:
+#   patience   stop if the metric hasn't improved on its best value by MIN_IMPROVEMENT (relative) for PATIENCE evals
+#   slope      stop if a straight line fit to the last SLOPE_WINDOW evals changes by less than SLOPE_THRESHOLD
+#              (relative) per eval, ie. the metric has flattened out, whether or not it's still noisy
+
+
+EARLY_STOPPING = ["none", "patience", "slope"]
+PATIENCE = 8
+MIN_IMPROVEMENT = 0.01
+SLOPE_WINDOW = 8
+SLOPE_THRESHOLD = 0.002
+
+
+class StoppingRule:
+  """ decides when to stop based on the history of the evaluation metric """
+  def __init__(self, rule):
+    assert rule in EARLY_STOPPING, "unknown early stopping rule %s" % rule
+    self.rule = rule
+    self.history = []
+    self.best = None
+    self.since_best = 0
+  def update(self, val):
+    """ add val to the history, return True if we should stop """
+    self.history.append(val)
+    if self.best is None or val < self.best - MIN_IMPROVEMENT*abs(self.best):
+      self.best, self.since_best = val, 0
+    else:
+      self.since_best += 1
+    if self.rule == "patience":
+      return self.since_best >= PATIENCE
+    if self.rule == "slope":
+      if len(self.history) < SLOPE_WINDOW:
+        return False
+      recent = np.array(self.history[-SLOPE_WINDOW:])
+      slope = np.polyfit(np.arange(SLOPE_WINDOW), recent, 1)[0]
+      return abs(slope) < SLOPE_THRESHOLD*abs(recent.mean())
+    return False
@@ -0,0 +1,160 @@
+import copy
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.func import stack_module_state, functional_call, vmap
+from torch.utils._pytree import tree_map
+
+from config import Config
+
+
+# Train K replicas of a model (same config, different random initialization) as one batched computation.
+# Each replica gets its own slice of every training batch, and is saved to its own checkpoint in the usual
+# format, so replicas can be loaded with config.load() like any other model. Usage:
+#
+#   ensemble_training_run("models/my_run.pt", Config(...), 8) # saves models/my_run.r0.pt ... models/my_run.r7.pt
+#
+# To check that an arch can be trained as an ensemble:  python ensemble.py models/my_model.pt
+
+
+def set_tensor(module, name, val):
+  """ replace the parameter or buffer of module at the dotted path name """
+  *path, leaf = name.split(".")
+  for attr in path:
+    module = getattr(module, attr)
+  if leaf in module._parameters:
+    module._parameters[leaf] = val
+  else:
+    module._buffers[leaf] = val
+
+
+class StackedModule(nn.Module):
+  """ K copies of an nn.Module with identical architecture, evaluated with vmap as one batched computation.
+      Parameters and buffers of the copies are stacked along a new leading dimension and stored on
+      self.module, so .parameters(), .modules(), .train(), .eval() work as usual.
+      All tensor arguments to forward() are split evenly along dim 0 between the copies, the first
+      copy getting the first chunk and so on. Other arguments (eg. a Graph) are shared. """
+  def __init__(self, modules):
+    super().__init__()
+    self.n_replicas = len(modules)
+    params, buffers = stack_module_state(modules)
+    self.module = copy.deepcopy(modules[0])
+    for name, val in params.items():
+      set_tensor(self.module, name, nn.Parameter(val.detach()))
+    for name, val in buffers.items():
+      set_tensor(self.module, name, val)
+  def forward(self, *args):
+    K = self.n_replicas
+    params = dict(self.module.named_parameters())
+    buffers = dict(self.module.named_buffers())
+    in_dims = tuple(0 if isinstance(arg, torch.Tensor) else None for arg in args)
+    args = tuple(arg.reshape(K, -1, *arg.shape[1:]) if isinstance(arg, torch.Tensor) else arg for arg in args)
+    def call(params, buffers, *args):
+      return functional_call(self.module, (params, buffers), args)
+    ans = vmap(call, in_dims=(0, 0) + in_dims, randomness="different")(params, buffers, *args)
+    return tree_map(lambda y: y.reshape(K*y.shape[1], *y.shape[2:]), ans)
+  def replica_state_dict(self, k):
+    """ the state dict of copy k, as it would be for an unstacked module """
+    return OrderedDict((key, val[k].clone()) for key, val in self.module.state_dict().items())
+
+
+class Ensemble:
+  """ K replicas of a model, trained together. Acts like a single model with batch size K*config.batch:
+      train_step() etc. are those of a "lead" model whose nn.Module attributes have been replaced by
+      StackedModule's, and whose optimizers step all replicas at once.
+      Losses are computed by the lead model as means over the combined batch, which would scale the
+      gradient of each replica by 1/K. We undo this with a gradient hook, so each replica sees exactly
+      the gradients it would see if trained alone (this needs loss terms that sum over parameters,
+      like weight decay, to be divided by model.ensemble_size, see vampnet1).
+      Limitation: optimizers that keep statistics across parameter elements (eg. FriendlyAverage34's
+      base_var) will share those statistics between replicas. """
+  def __init__(self, replicas):
+    self.n_replicas = len(replicas)
+    self._replicas = replicas
+    replica_config = replicas[0].config
+    args, kwargs = replica_config.get_args_and_kwargs()
+    kwargs["batch"] = self.n_replicas*replica_config.batch
+    self.config = Config(*args, **kwargs)
+    self.lead = replica_config.modelclass.makenew(replica_config)
+    self.stacked = {}
+    for name, val in vars(self.lead).items():
+      if isinstance(val, nn.Module):
+        self.stacked[name] = StackedModule([getattr(replica, name) for replica in replicas])
+    for name, stacked in self.stacked.items():
+      setattr(self.lead, name, stacked)
+      for param in stacked.parameters(): # under torch.compile, unused params get a None grad
+        param.register_hook(lambda grad: None if grad is None else grad*self.n_replicas)
+    self.lead.ensemble_size = self.n_replicas
+    self.lead.init_optim()
+  @staticmethod
+  def makenew(config, n_replicas):
+    return Ensemble([config.modelclass.makenew(config) for _ in range(n_replicas)])
+  def __getattr__(self, name):
+    # only called for attributes not found on the Ensemble itself, these come from the lead model
+    if name == "lead": # not yet set, avoid infinite recursion
+      raise AttributeError(name)
+    return getattr(self.lead, name)
+  def replicas(self):
+    """ the individual models, with their weights brought up to date with the stacked weights """
+    for name, stacked in self.stacked.items():
+      for k, replica in enumerate(self._replicas):
+        getattr(replica, name).load_state_dict(stacked.replica_state_dict(k))
+    return self._replicas
+  def replica_paths(self, save_path):
+    assert save_path.split(".")[-1] == "pt", "expected pytorch .pt file suffix"
+    return [save_path[:-3] + ".r%d.pt" % k for k in range(self.n_replicas)]
+  def calculate_transforms(self, dataset):
+    """ for Koopman models: each replica fits its own transforms, using the full dataset """
+    for replica in self.replicas():
+      replica.calculate_transforms(dataset)
+
+
+def ensemble_training_run(save_path, config, n_replicas):
+  """ train n_replicas replicas of a new model from config, see Ensemble """
+  from train import train
+  train(Ensemble.makenew(config, n_replicas), save_path)
+
+
+
+# SMOKE TEST:
+
+class _LossBoard:
+  """ board that keeps the last value of each scalar that is logged to it """
+  def __init__(self):
+    self.scalars = {}
+  def img_grid(self, label, images):
+    pass
+  def scalar(self, label, i, val):
+    self.scalars[label] = float(val)
+  def close(self):
+    pass
+
+def smoke_test(config, n_replicas=2, steps=2):
+  """ train an ensemble of new models from config for a few steps on simulated data, check that the losses are
+      finite and that the replicas can be extracted. returns True if ok """
+  from sims import equilibrium_sample, get_dataset
+  ens = Ensemble.makenew(config, n_replicas)
+  trajs = get_dataset(ens.config, equilibrium_sample(ens.config, ens.config.batch), ens.config.simlen)
+  trajs = trajs.to(ens.config.device, torch.float32)
+  board = _LossBoard()
+  trainer = config.trainerclass(ens, board)
+  for i in range(steps):
+    trainer.step(i, trajs)
+  replicas = ens.replicas()
+  print(", ".join("%s: %f" % (label, val) for label, val in board.scalars.items()))
+  ok = len(replicas) == n_replicas and all(np.isfinite(val) for val in board.scalars.values())
+  print("PASS" if ok else "FAIL")
+  return ok
+
+
+if __name__ == "__main__":
+  from argparse import ArgumentParser
+  from config import load_config
+  parser = ArgumentParser(prog="ensemble")
+  parser.add_argument("fpath", help="a saved model, an ensemble of new models with its config is trained")
+  parser.add_argument("--replicas", dest="replicas", type=int, default=2)
+  parser.add_argument("--steps", dest="steps", type=int, default=2)
+  args = parser.parse_args()
+  smoke_test(load_config(args.fpath), args.replicas, args.steps)
@@ -0,0 +1,170 @@
+import os
+import queue
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from config import Config, load
+from sims import get_dataset
+from checkpointing import atomic_save, atomic_alias
+from precision import autocast
+from test_model import is_gan, get_continuation_dataset, gaussian_kl_div
+from early_stopping import StoppingRule
+
+
+# Held-out evaluation of checkpoints during training, and early stopping. With Config(..., early_stopping="patience")
+# or early_stopping="slope", train.train() starts an evaluator process, which evaluates every checkpoint after it
+# has been written to disk. The metric depends on the kind of model (lower is better for all of them):
+#   kl     for GANs: Gaussian KL divergence between predicted and simulated next states, averaged over initial states
+#   vamp   for Koopman models: minus the sum of the singular values found by the VAMP procedure on held-out data
+#   loss   for models with an eval_loss() method (eg. diffusion models): loss on held-out data, without training
+# Reference data is generated once per simulation and cached in EVAL_CACHE_DIR, so runs in a sweep share it.
+# Each evaluation reseeds the RNG, so evaluations of different checkpoints use the same noise. Each checkpoint is
+# aliased to its own file (<save_path>.eval_<step>.pt) until the evaluator has loaded it, since training keeps
+# overwriting the checkpoint at save_path. If the evaluator falls behind it skips to the latest checkpoint, but the
+# last checkpoint of a run is always evaluated.
+# Metrics are logged to tensorboard as eval/<metric>, the stopping rules are in early_stopping.py.
+
+
+EVAL_CACHE_DIR = "eval_cache"
+EVAL_SEED = 0x5EED
+EVAL_INIT_STATES = 8   # for kl: number of initial states
+EVAL_CONTINS = 512     # for kl: number of continuations of each initial state
+EVAL_TRAJS = 512       # for vamp and loss: number of reference trajectories
+EVAL_THREADS = 1       # torch threads for the evaluator process
+
+
+def metric_kind(model):
+  """ the kind of evaluation metric for model, see above """
+  if hasattr(model, "eval_score"):
+    return "vamp"
+  if hasattr(model, "eval_loss"):
+    return "loss"
+  if is_gan(model):
+    return "kl"
+  assert False, "no evaluation metric for arch %s" % model.config.arch_name
+
+
+def reference_data(config, kind):
+  """ get the reference data for metric kind, from the cache if possible """
+  name = "%s_%s_x%d_m%d_t%d.pt" % (config.sim_name, kind, config.x_only, config.subtract_mean, config.simlen)
+  path = os.path.join(EVAL_CACHE_DIR, name)
+  if os.path.exists(path):
+    return [tens.to(config.device) for tens in torch.load(path)]
+  print("generating reference data for evaluation...")
+  torch.manual_seed(EVAL_SEED)
+  if kind == "kl":
+    ans = get_continuation_dataset(EVAL_INIT_STATES, EVAL_CONTINS, config)
+  else:
+    ans = (get_dataset(config, config.sim.sample_equilibrium(EVAL_TRAJS, config.t_eql), config.simlen),)
+  ans = [tens.to(torch.float32) for tens in ans] # simulations run in float64
+  os.makedirs(EVAL_CACHE_DIR, exist_ok=True)
+  atomic_save([tens.cpu() for tens in ans], path)
+  return ans
+
+
+def evaluate(model, kind, data):
+  """ compute metric kind for model on reference data """
+  torch.manual_seed(EVAL_SEED)
+  config = model.config
+  model.set_eval(True)
+  with torch.no_grad(), autocast(config):
+    if kind == "kl":
+      init_states, fin_states = data
+      kls = []
+      for init_state, fin_state in zip(init_states, fin_states): # just compare the x part, like test_model
+        pred_fin_state = model.predict(config.cond(init_state)).to(torch.float32)
+        kls.append(gaussian_kl_div(fin_state[:, :config.sim.dim], pred_fin_state[:, :config.sim.dim]))
+      return float(np.mean(kls))
+    if kind == "vamp":
+      trajs, = data
+      N = trajs.shape[0]//2
+      model.calculate_transforms(trajs[:N]) # fit transforms on one half, score on the other
+      return -model.eval_score(trajs[N:]).sum().item()
+    if kind == "loss":
+      trajs, = data
+      N, L, state_dim = trajs.shape
+      cond = config.cond(trajs[:, :-1].reshape(N*(L - 1), state_dim))
+      return model.eval_loss(trajs[:, 1:].reshape(N*(L - 1), state_dim), cond).item()
+
+
+def _remove(path):
+  if os.path.exists(path):
+    os.remove(path)
+
+def _evaluator_main(config_args, config_kwargs, kind, checkpoints, results):
+  """ runs in the evaluator process """
+  torch.set_num_threads(EVAL_THREADS)
+  config = Config(*config_args, **config_kwargs)
+  data = None
+  done = False
+  while not done:
+    job = checkpoints.get()
+    try: # if we've fallen behind, skip straight to the latest checkpoint
+      while not done:
+        next_job = checkpoints.get_nowait()
+        if next_job is None:
+          done = True # still evaluate job, the last checkpoint of the run
+        else:
+          if job is not None:
+            _remove(job[1])
+          job = next_job
+    except queue.Empty:
+      pass
+    if job is None:
+      return
+    step, path = job
+    model = load(path)
+    _remove(path)
+    if data is None:
+      data = reference_data(config, kind)
+    results.put((step, kind, evaluate(model, kind, data)))
+
+
+class Evaluator:
+  """ evaluates checkpoints of model in a separate process, and applies a stopping rule to the results """
+  def __init__(self, model):
+    config = model.config
+    kind = metric_kind(model) # fails here, before training starts, if there's no metric for this arch
+    ctx = mp.get_context("spawn")
+    self.checkpoints = ctx.Queue()
+    self.results = ctx.Queue()
+    self.stopping_rule = StoppingRule(config.early_stopping)
+    self.stop = False
+    self.eval_paths = []
+    args, kwargs = config.get_args_and_kwargs()
+    self.process = ctx.Process(target=_evaluator_main, args=(args, kwargs, kind, self.checkpoints, self.results),
+      daemon=True)
+    self.process.start()
+  def submit(self, step):
+    """ returns an on_written callback for CheckpointWriter.submit(), which queues the checkpoint for evaluation.
+        Later checkpoints are written to the same path, so we alias it to a file of its own, which the evaluator
+        deletes once it has loaded it. """
+    def on_written(path):
+      eval_path = path[:-3] + ".eval_" + str(step) + ".pt"
+      atomic_alias(path, eval_path)
+      self.eval_paths.append(eval_path)
+      self.checkpoints.put((step, eval_path))
+    return on_written
+  def should_stop(self, board):
+    """ log any new results to board, and return True if the stopping rule says we should stop """
+    assert self.process.is_alive() or not self.results.empty(), "evaluator process died"
+    while not self.results.empty():
+      self._log(board, *self.results.get())
+    return self.stop
+  def _log(self, board, step, kind, val):
+    print("evaluation of step %d: %s = %f" % (step, kind, val))
+    board.scalar("eval/" + kind, step, val)
+    self.stop = self.stop or self.stopping_rule.update(val)
+  def close(self, board):
+    """ wait for the evaluation of the last checkpoint, and log the remaining results to board """
+    self.checkpoints.put(None)
+    while self.process.is_alive() or not self.results.empty():
+      try:
+        self._log(board, *self.results.get(timeout=1.))
+      except queue.Empty:
+        pass
+    self.process.join()
+    for path in self.eval_paths: # if the evaluator died, it may have left some behind
+      _remove(path)
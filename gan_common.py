@@ -1,3 +1,26 @@
+import torch
+
+
+DISC_POINTS = 4 # default number of points the discriminator is evaluated at in disc_step, see disc_points()
+
+
+def reuse_gen_sample(config):
+  """ whether to use one generator sample for both the disc_step and the gen_step of a train_step, can be set
+      with the "reuse_gen_sample" arch_specific key """
+  return "reuse_gen_sample" in config.arch_specific and config["reuse_gen_sample"]
+
+def disc_and_gen_steps(model, data, cond):
+  """ one disc_step and one gen_step. By default each step draws its own generator sample, so the generator runs
+      twice per train_step. With reuse_gen_sample, the generator runs once: the disc_step gets the sample detached,
+      and the gen_step backprops through the same sample, but evaluated by the updated discriminator. The generator
+      gradient is still the exact gradient for the current generator weights, since those haven't changed between
+      the two steps. What changes is that the generator is scored on the same latents the discriminator was just
+      trained on, rather than on fresh ones, so the two updates are correlated. See benchmark_gan_step.py. """
+  if reuse_gen_sample(model.config):
+    g_data = model.generate(cond)
+    return model.disc_step(data, cond, g_data.detach()), model.gen_step(cond, g_data)
+  return model.disc_step(data, cond), model.gen_step(cond)
+
 
 class GANTrainer:
   def __init__(self, model, board):
@@ -9,9 +32,52 @@ class GANTrainer:
     cond = config.cond(trajs[:, :-1].reshape(N*(L - 1), state_dim))
     data = trajs[:, 1:].reshape(N*(L - 1), state_dim)
     loss_d, loss_g = self.model.train_step(data, cond)
-    print(f"{i}\t ℒᴰ = {loss_d:05.6f}   \t ℒᴳ = {loss_g:05.6f}")
     self.board.scalar("loss_d", i, loss_d)
     self.board.scalar("loss_g", i, loss_g)
 
 
+# Fused discriminator evaluation for disc_step. Rather than calling the discriminator separately on real data,
+# generated data and each interpolant, and then adding up endpoint penalties pair by pair, we stack all K points
+# into one batch for a single discriminator forward pass, and compute the endpoint penalties for all K(K-1)/2
+# pairs with one call of the arch's endpoint_penalty. This only works for discriminators that treat each sample
+# in the batch independently (so not for ones with batch norm). The stacked batch is ordered sample by sample,
+# keeping the K points of each sample together, so that when the discriminator is a StackedModule (ensemble.py),
+# which splits the batch into contiguous chunks, one per replica, each replica only sees its own samples.
+
+def n_disc_points(config, default=DISC_POINTS):
+  """ number of points K to evaluate the discriminator at, can be set with the "disc_points" arch_specific key """
+  return config["disc_points"] if "disc_points" in config.arch_specific else default
+
+def disc_points(r_data, g_data, n_points):
+  """ the points at which to evaluate the discriminator: real data, generated data, and n_points - 2 random
+      interpolants between them
+      r_data, g_data: (batch, ...)
+      return: (n_points, batch, ...) """
+  assert n_points >= 2
+  batch, *rest = r_data.shape
+  mix_factors = torch.rand(n_points - 2, batch, *[1]*len(rest), device=r_data.device)
+  mixed_data = mix_factors*g_data + (1 - mix_factors)*r_data
+  return torch.cat([r_data[None], g_data[None], mixed_data], dim=0)
+
+def fused_disc_eval(disc, cond, x, *args):
+  """ evaluate disc(cond, x[k], *args) for all k in one batched call
+      cond: (batch, ...)
+      x: (K, batch, ...)
+      return: (K, batch, ...) """
+  K, batch, *rest = x.shape
+  cond_k = cond.repeat_interleave(K, dim=0)
+  y = disc(cond_k, x.transpose(0, 1).reshape(batch*K, *rest), *args)
+  return y.reshape(batch, K, *y.shape[1:]).transpose(0, 1)
 
+def pairwise_endpoint_penalty(endpoint_penalty, x, y):
+  """ sum of endpoint_penalty(x[i], x[j], y[i], y[j]) over all pairs i < j, computed with one call
+      x: (K, batch, ...)
+      y: (K, batch, ...)
+      return: penalty for each sample in the batch """
+  K, batch, *_ = x.shape
+  i, j = torch.triu_indices(K, K, 1, device=x.device)
+  n_pairs = i.shape[0]
+  penalty = endpoint_penalty(
+    x[i].reshape(n_pairs*batch, *x.shape[2:]), x[j].reshape(n_pairs*batch, *x.shape[2:]),
+    y[i].reshape(n_pairs*batch, *y.shape[2:]), y[j].reshape(n_pairs*batch, *y.shape[2:]))
+  return penalty.reshape(n_pairs, batch, *penalty.shape[1:]).sum(0)
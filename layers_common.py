@@ -1,13 +1,39 @@
+import time
+
 import torch
 import torch.nn as nn
-from torch_scatter import scatter
+import torch.nn.functional as F
+import torch.utils.checkpoint
+try:
+  from torch_scatter import scatter
+except ImportError: # optional, see GRAPH_BACKENDS
+  scatter = None
 
 from utils import must_be
+from precision import float32, vector_norm
 
 
 # constants:
 INV_SQRT_2 = 0.5**0.5
 
+# Implementations of message passing, selected with Config(..., graph_backend=...), see Graph below. The first
+# three are for the scatter (sum over edges) part of message passing, and path graphs use slicing instead of them.
+#   torch_scatter  torch_scatter.scatter, with the edges in their original order
+#   index_add      native pytorch index_add
+#   csr            native pytorch segment_reduce, with the edges sorted by node once, when the graph is created
+#   auto           torch_scatter if it's installed, otherwise csr on GPU (no atomics) and index_add on CPU (where
+#                  segment_reduce is slow, particularly its backward pass)
+#   dense          matmul with dense (nodes x nodes, or edges x nodes) matrices, eg. the normalised adjacency
+#                  matrix. Can be faster for small graphs, since it's a single batched matmul.
+#   autotune       the first time each message passing op sees a new input shape, benchmark all of the above
+#                  (and slicing, for path graphs) and use the fastest from then on. Under torch.compile or
+#                  vmap we can't benchmark, so ops use the choice for that shape if there is one, else auto.
+# The sparse implementations give the same outputs and gradients, see benchmark_graph_layers.py. Matmuls can
+# sum in a different order, and run in bfloat16 under autocast, so dense is only equal up to rounding.
+GRAPH_BACKENDS = ["auto", "torch_scatter", "index_add", "csr", "dense", "autotune"]
+AUTOTUNE_REPS = 8
+AUTOTUNE_VERBOSE = False # print the timings and choice of the autotuner for each new input shape
+
 
 def weights_init(m):
   """ custom weights initialization """
@@ -78,20 +104,27 @@ class FromAtomCoords(nn.Module):
 
 
 # SO3 symmetric layers for 3D graph networks:
+# Vector features are stored channel-last, as (..., 3, chan), so that VecLinear is a plain matmul over the last
+# axis (like nn.Linear), and VecConv1d can run without copying its input. Parameter shapes don't depend on the
+# layout, so checkpoints saved with the older (..., chan, 3) layout load as before. Positions are (..., 3) as
+# always, the embeddings below stack them into vector features, and outputs read out with VecLinear(vdim, 1)
+# become positions again with [..., 0].
 
 class VecLinear(nn.Module):
   def __init__(self, dim_in, dim_out):
     super().__init__()
     self.W = nn.Parameter(torch.randn(dim_out, dim_in))
   def forward(self, v):
-    return torch.einsum("oi, ...ik -> ...ok", self.W, v)
+    """ v: (..., 3, dim_in)
+        return: (..., 3, dim_out) """
+    return F.linear(v, self.W)
 
 class VecRootS(nn.Module):
   """ an activation function for vectors that is S-shaped along any given direction """
   def __init__(self):
     super().__init__()
   def forward(self, v):
-    v_sq = (v**2).sum(-1, keepdim=True)
+    v_sq = (v**2).sum(-2, keepdim=True)
     scale = (1. + v_sq)**(-0.25)
     return v*scale
 
@@ -109,14 +142,254 @@ class VecResidual(nn.Module):
 
 
 class Graph:
-  def __init__(self, src, dst, n_nodes):
-    device = src.device
-    edges, = src.shape
+  """ graph with edges src -> dst. Nodes are dim 1 of node tensors, and edges are dim 1 of edge tensors.
+      Graph layers should pass messages with the gather/scatter methods below, so that graphs can use faster
+      implementations for particular topologies: for a path graph (the chain graph that the 3D archs build, see
+      path_graph()), we pass messages by slicing the node and edge tensors, rather than with index tensors.
+      path: whether the graph is a path graph with the edges in the order of path_graph(). If None, detect this.
+      backend: one of GRAPH_BACKENDS """
+  def __init__(self, src, dst, n_nodes, path=None, backend="auto"):
     self.src = src
     self.dst = dst
     self.n_nodes = n_nodes
-    self.deg = scatter(torch.ones(edges, device=device), src, dim=0, dim_size=n_nodes)
+    self.is_path = is_path_graph(src, dst, n_nodes) if path is None else path
+    self.backend = resolve_graph_backend(backend, src.device)
+    self.src_csr = _CSR(src, n_nodes)
+    self.dst_csr = _CSR(dst, n_nodes)
+    self.src_by_dst = src[self.dst_csr.perm] # for csr neighbour sums: gather straight into dst order
+    self.deg = torch.bincount(src, minlength=n_nodes).to(torch.float32)
     self.norm_coeff = (1. + self.deg)**(-0.5)
+    self.dense_mats = {}
+    self.autotuned = {}
+  def gather_src(self, x):
+    """ x: (batch, nodes, ...)
+        return: (batch, edges, ...), x at the source node of each edge """
+    return self._op("gather_src", x)
+  def gather_dst(self, x):
+    """ x: (batch, nodes, ...)
+        return: (batch, edges, ...), x at the destination node of each edge """
+    return self._op("gather_dst", x)
+  def scatter_src(self, y):
+    """ y: (batch, edges, ...)
+        return: (batch, nodes, ...), sum of y over the edges leaving each node """
+    return self._op("scatter_src", y)
+  def scatter_dst(self, y):
+    """ y: (batch, edges, ...)
+        return: (batch, nodes, ...), sum of y over the edges arriving at each node """
+    return self._op("scatter_dst", y)
+  def neighbour_sum(self, x):
+    """ x: (batch, nodes, ...)
+        return: (batch, nodes, ...), sum of x over the neighbours of each node, ie. the source nodes
+        of the edges arriving at it """
+    return self._op("neighbour_sum", x)
+  def normed_neighbour_sum(self, x):
+    """ x: (batch, nodes, ...)
+        return: (batch, nodes, ...), neighbour_sum(x) multiplied by norm_coeff """
+    return self._op("normed_neighbour_sum", x)
+  def _op(self, op, x):
+    impl = self.backend
+    if impl == "autotune":
+      impl = self._autotuned_impl(op, x)
+    elif impl != "dense" and self.is_path:
+      impl = "path"
+    return self._run(impl, op, x)
+  def _run(self, impl, op, x):
+    if impl == "path":
+      return _path_op(op, x, self.norm_coeff)
+    if impl == "dense":
+      return self._dense_op(op, x)
+    return self._sparse_op(impl, op, x)
+  def _sparse_op(self, impl, op, x):
+    if op == "gather_src":
+      return x[:, self.src]
+    if op == "gather_dst":
+      return x[:, self.dst]
+    if op == "scatter_src":
+      return self._scatter(impl, x, self.src, self.src_csr)
+    if op == "scatter_dst":
+      return self._scatter(impl, x, self.dst, self.dst_csr)
+    if impl == "csr":
+      ans = self.dst_csr.segment_sum(x[:, self.src_by_dst])
+    else:
+      ans = self._scatter(impl, x[:, self.src], self.dst, self.dst_csr)
+    if op == "normed_neighbour_sum":
+      return _node_coeff(self.norm_coeff, ans)*ans
+    return ans
+  def _scatter(self, impl, y, index, csr):
+    if impl == "torch_scatter":
+      return scatter(y, index, dim=1, dim_size=self.n_nodes)
+    if impl == "index_add":
+      batch, edges, *rest = y.shape
+      return torch.index_add(y.new_zeros(batch, self.n_nodes, *rest), 1, index, y)
+    return csr.segment_sum(y[:, csr.perm])
+  def _dense_op(self, op, x):
+    if op not in self.dense_mats:
+      self.dense_mats[op] = self._dense_mat(op)
+    mat = self.dense_mats[op]
+    batch, n_in, *rest = x.shape
+    y = torch.matmul(mat.to(x.dtype), x.reshape(batch, n_in, -1))
+    return y.reshape(batch, mat.shape[0], *rest)
+  def _dense_mat(self, op):
+    """ matrix M such that op(x) = M @ x along the nodes (or edges) dimension """
+    edges, = self.src.shape
+    incidence_src = torch.zeros(edges, self.n_nodes, device=self.src.device)
+    incidence_src[torch.arange(edges, device=self.src.device), self.src] = 1.
+    incidence_dst = torch.zeros(edges, self.n_nodes, device=self.src.device)
+    incidence_dst[torch.arange(edges, device=self.src.device), self.dst] = 1.
+    mats = {
+      "gather_src": incidence_src,
+      "gather_dst": incidence_dst,
+      "scatter_src": incidence_src.T,
+      "scatter_dst": incidence_dst.T,
+      "neighbour_sum": incidence_dst.T @ incidence_src,
+      "normed_neighbour_sum": self.norm_coeff[:, None]*(incidence_dst.T @ incidence_src),
+    }
+    return mats[op].contiguous()
+  def _autotuned_impl(self, op, x):
+    """ fastest implementation of op for inputs like x, benchmarked the first time we see their shape """
+    key = (op, x.shape, x.dtype, x.requires_grad)
+    if torch.compiler.is_compiling() or _is_functorch_wrapped(x): # can't benchmark while tracing or under vmap
+      return self.autotuned.get(key, "path" if self.is_path else resolve_graph_backend("auto", x.device))
+    if key not in self.autotuned:
+      impls = (["path"] if self.is_path else []) + ["dense", "index_add"]
+      if not op.startswith("gather"): # sparse gathers are the same for all backends
+        impls += ["csr"] + (["torch_scatter"] if scatter is not None else [])
+      times = {impl: self._time_impl(impl, op, x) for impl in impls}
+      self.autotuned[key] = min(times, key=times.get)
+      if AUTOTUNE_VERBOSE:
+        print("graph autotune: %s %s %s -> %s (%s)" % (op, tuple(x.shape), str(x.dtype), self.autotuned[key],
+          ", ".join("%s %.3g ms" % (impl, 1000*t) for impl, t in times.items())))
+    return self.autotuned[key]
+  def _time_impl(self, impl, op, x):
+    """ time forward (and backward, if x requires grad) pass of op on x, using implementation impl """
+    x = x.detach().requires_grad_(x.requires_grad)
+    def run():
+      y = self._run(impl, op, x)
+      if x.requires_grad:
+        torch.autograd.grad(y, x, torch.ones_like(y))
+    run() # warmup
+    if x.device.type == "cuda": torch.cuda.synchronize(x.device)
+    t0 = time.perf_counter()
+    for _ in range(AUTOTUNE_REPS):
+      run()
+    if x.device.type == "cuda": torch.cuda.synchronize(x.device)
+    return (time.perf_counter() - t0)/AUTOTUNE_REPS
+
+def resolve_graph_backend(backend, device):
+  assert backend in GRAPH_BACKENDS, "unknown graph backend %s" % backend
+  if backend == "auto":
+    if scatter is not None:
+      return "torch_scatter"
+    return "csr" if device.type == "cuda" else "index_add"
+  assert backend != "torch_scatter" or scatter is not None, "graph backend torch_scatter, but torch_scatter is not installed"
+  return backend
+
+def _is_functorch_wrapped(x):
+  """ whether x is a tensor inside a torch.func transform (eg. vmap in ensemble.py), where we can't call
+      requires_grad_ or autograd.grad on it """
+  return torch._C._functorch.is_functorch_wrapped_tensor(x)
+
+def _node_coeff(coeff, x):
+  """ reshape coeff: (nodes,) to broadcast against x: (batch, nodes, ...) """
+  return coeff.reshape(-1, *[1]*(x.dim() - 2))
+
+class _CSR:
+  """ sorted order of the edges by one of their end nodes, so that sums over the edges at each node become
+      sums over contiguous segments """
+  def __init__(self, index, n_nodes):
+    self.perm = torch.argsort(index, stable=True)
+    self.lengths = torch.bincount(index, minlength=n_nodes)
+  def segment_sum(self, y_sorted):
+    """ y_sorted: (batch, edges, ...), in sorted order
+        return: (batch, nodes, ...) """
+    batch = y_sorted.shape[0]
+    return torch.segment_reduce(y_sorted, "sum", lengths=self.lengths.expand(batch, -1), axis=1, unsafe=True)
+
+def path_graph(n_nodes, device):
+  """ path graph 0 - 1 - ... - (n_nodes - 1): edges i -> i + 1, followed by edges i + 1 -> i """
+  r = torch.arange(n_nodes - 1, device=device)
+  return Graph(torch.cat([r, r + 1]), torch.cat([r + 1, r]), n_nodes, path=True)
+
+def is_path_graph(src, dst, n_nodes):
+  """ whether src, dst are the edges of path_graph(n_nodes) """
+  if n_nodes < 2 or src.shape != (2*(n_nodes - 1),) or dst.shape != src.shape:
+    return False
+  r = torch.arange(n_nodes - 1, device=src.device)
+  return torch.equal(src, torch.cat([r, r + 1])) and torch.equal(dst, torch.cat([r + 1, r]))
+
+
+# Message passing on path graphs by slicing. Each node has a left and a right neighbour (except at the ends),
+# and edge tensors are the forward edges (i -> i + 1) followed by the backward edges (i + 1 -> i). Gathering and
+# scattering are adjoint to each other, and neighbour sums are self-adjoint, so we give each of them a custom
+# backward pass in terms of the other, rather than letting autograd differentiate through the slices (which
+# would allocate a zero-padded gradient for every slice). Sums have at most 2 terms, so results are exactly the
+# same as with the general gather/scatter implementation. The Functions have vmap rules generated by pytorch, so
+# they also work in ensembles (StackedModule in ensemble.py runs its replicas under torch.func.vmap).
+
+def _path_sum(y_left, y_right):
+  """ y_left: (batch, nodes - 1, ...), message from the right end of each edge to its left end
+      y_right: (batch, nodes - 1, ...), message from the left end of each edge to its right end
+      return: (batch, nodes, ...), sum of the messages arriving at each node """
+  return torch.cat([y_left[:, :1], y_right[:, :-1] + y_left[:, 1:], y_right[:, -1:]], dim=1)
+
+class _PathGather(torch.autograd.Function):
+  """ x: (batch, nodes, ...) -> (batch, edges, ...), x at the source (or destination) node of each edge """
+  generate_vmap_rule = True
+  @staticmethod
+  def forward(x, to_dst):
+    if to_dst:
+      return torch.cat([x[:, 1:], x[:, :-1]], dim=1)
+    return torch.cat([x[:, :-1], x[:, 1:]], dim=1)
+  @staticmethod
+  def setup_context(ctx, inputs, output):
+    ctx.to_dst = inputs[1]
+  @staticmethod
+  def backward(ctx, grad):
+    return _PathScatter.apply(grad, ctx.to_dst), None
+
+class _PathScatter(torch.autograd.Function):
+  """ y: (batch, edges, ...) -> (batch, nodes, ...), sum of y over the edges leaving (or arriving at) each node """
+  generate_vmap_rule = True
+  @staticmethod
+  def forward(y, to_dst):
+    n_fwd = y.shape[1]//2
+    y_fwd, y_bwd = y[:, :n_fwd], y[:, n_fwd:]
+    if to_dst:
+      return _path_sum(y_bwd, y_fwd)
+    return _path_sum(y_fwd, y_bwd)
+  @staticmethod
+  def setup_context(ctx, inputs, output):
+    ctx.to_dst = inputs[1]
+  @staticmethod
+  def backward(ctx, grad):
+    return _PathGather.apply(grad, ctx.to_dst), None
+
+class _PathNeighbourSum(torch.autograd.Function):
+  """ x: (batch, nodes, ...) -> (batch, nodes, ...), sum of x over the neighbours of each node """
+  generate_vmap_rule = True
+  @staticmethod
+  def forward(x):
+    return _path_sum(x[:, 1:], x[:, :-1])
+  @staticmethod
+  def setup_context(ctx, inputs, output):
+    pass
+  @staticmethod
+  def backward(ctx, grad):
+    return _PathNeighbourSum.apply(grad)
+
+def _path_op(op, x, norm_coeff):
+  if op == "gather_src":
+    return _PathGather.apply(x, False)
+  if op == "gather_dst":
+    return _PathGather.apply(x, True)
+  if op == "scatter_src":
+    return _PathScatter.apply(x, False)
+  if op == "scatter_dst":
+    return _PathScatter.apply(x, True)
+  ans = _PathNeighbourSum.apply(x)
+  if op == "normed_neighbour_sum":
+    return _node_coeff(norm_coeff, ans)*ans
+  return ans
 
 
 class VecNodesConv(nn.Module):
@@ -127,12 +400,12 @@ class VecNodesConv(nn.Module):
     self.linear_node = VecLinear(dim_in, dim_out)
     self.linear_edge = VecLinear(dim_in, dim_out)
   def forward(self, x, graph):
-    """ x: (batch, nodes, dim_in, 3)
-        return: (batch, nodes, dim_out, 3) """
+    """ x: (batch, nodes, 3, dim_in)
+        return: (batch, nodes, 3, dim_out) """
     y_node = self.linear_node(x)
     y_edge = self.linear_edge(x) # compute transformed values before doing graph convolution
-    y_edge = scatter(y_edge[:, graph.src], graph.dst, dim=1, dim_size=graph.n_nodes) # pass information along edges
-    ans = y_node + graph.norm_coeff[:, None, None]*y_edge
+    y_edge = graph.normed_neighbour_sum(y_edge) # pass information along edges
+    ans = y_node + y_edge
     return ans*INV_SQRT_2
 
 class VecEdgesRead(nn.Module):
@@ -143,9 +416,9 @@ class VecEdgesRead(nn.Module):
     self.linear_src = VecLinear(dim_in, dim_out)
     self.linear_dst = VecLinear(dim_in, dim_out)
   def forward(self, x, graph):
-    """ x: (batch, nodes, dim_in, 3)
-        return: (batch, edges, dim_out, 3) """
-    ans = (self.linear_src(x[:, graph.src]) + self.linear_dst(x[:, graph.dst]))
+    """ x: (batch, nodes, 3, dim_in)
+        return: (batch, edges, 3, dim_out) """
+    ans = graph.gather_src(self.linear_src(x)) + graph.gather_dst(self.linear_dst(x)) # project on nodes, then gather
     return ans*INV_SQRT_2
 
 class VecEdgesWrite(nn.Module):
@@ -156,10 +429,10 @@ class VecEdgesWrite(nn.Module):
     self.linear_src = VecLinear(dim_in, dim_out)
     self.linear_dst = VecLinear(dim_in, dim_out)
   def forward(self, x, graph):
-    """ x: (batch, edges, dim_in, 3)
-        return: (batch, nodes, dim_out, 3) """
-    ans = (scatter(self.linear_src(x), graph.src, dim=1, dim_size=graph.n_nodes)
-         + scatter(self.linear_dst(x), graph.dst, dim=1, dim_size=graph.n_nodes))
+    """ x: (batch, edges, 3, dim_in)
+        return: (batch, nodes, 3, dim_out) """
+    ans = (graph.scatter_src(self.linear_src(x))
+         + graph.scatter_dst(self.linear_dst(x)))
     return ans*INV_SQRT_2*graph.norm_coeff[:, None, None]
 
 class ScalNodesConv(nn.Module):
@@ -174,8 +447,8 @@ class ScalNodesConv(nn.Module):
         return: (batch, nodes, dim_out) """
     y_node = self.linear_node(x)
     y_edge = self.linear_edge(x) # compute transformed values before doing graph convolution
-    y_edge = scatter(y_edge[:, graph.src], graph.dst, dim=1, dim_size=graph.n_nodes) # pass information along edges
-    ans = y_node + graph.norm_coeff[:, None]*y_edge
+    y_edge = graph.normed_neighbour_sum(y_edge) # pass information along edges
+    ans = y_node + y_edge
     return ans*INV_SQRT_2
 
 class ScalEdgesRead(nn.Module):
@@ -188,7 +461,7 @@ class ScalEdgesRead(nn.Module):
   def forward(self, x, graph):
     """ x: (batch, nodes, dim_in)
         return: (batch, edges, dim_out) """
-    ans = (self.linear_src(x[:, graph.src]) + self.linear_dst(x[:, graph.dst]))
+    ans = graph.gather_src(self.linear_src(x)) + graph.gather_dst(self.linear_dst(x)) # project on nodes, then gather
     return ans*INV_SQRT_2
 
 class ScalEdgesWrite(nn.Module):
@@ -201,41 +474,85 @@ class ScalEdgesWrite(nn.Module):
   def forward(self, x, graph):
     """ x: (batch, edges, dim_in)
         return: (batch, nodes, dim_out) """
-    ans = (scatter(self.linear_src(x), graph.src, dim=1, dim_size=graph.n_nodes)
-         + scatter(self.linear_dst(x), graph.dst, dim=1, dim_size=graph.n_nodes))
+    ans = (graph.scatter_src(self.linear_src(x))
+         + graph.scatter_dst(self.linear_dst(x)))
     return ans*INV_SQRT_2*graph.norm_coeff[:, None]
 
 class ScalVecProducts(nn.Module):
   """ computes dot, cross, and scalar products, respects SO3 symmetry
       product has a reduced rank, and is divided by a normalization
-      factor of sqrt(1 + x**2 + y**2) """
+      factor of sqrt(1 + x**2 + y**2)
+      The left and right input projections are fused into one linear layer each for scalars and vectors,
+      and so are the output projections, see _load_from_state_dict() for weights saved before that.
+      The elementwise part in between is left for torch.compile to fuse (see compiling.py). """
   def __init__(self, adim, vdim, rank):
     super().__init__()
-    self.left_lin_a  = nn.Linear(adim, rank)
-    self.right_lin_a = nn.Linear(adim, rank)
-    self.left_lin_v  = VecLinear(vdim, rank)
-    self.right_lin_v = VecLinear(vdim, rank)
-    self.aa_lin_a = nn.Linear(rank, adim)
-    self.vv_lin_a = nn.Linear(rank, adim)
-    self.av_lin_v = VecLinear(rank, vdim)
-    self.vv_lin_v = VecLinear(rank, vdim)
-  def forward(self, a, v):
+    self.rank = rank
+    self.lin_a_in = nn.Linear(adim, 2*rank)  # (left, right)
+    self.lin_v_in = VecLinear(vdim, 2*rank)  # (left, right)
+    self.lin_a_out = nn.Linear(2*rank, adim) # (aa, vv)
+    self.lin_v_out = VecLinear(2*rank, vdim) # (av, vv)
+    # same init scale as the separate (rank -> adim) layers this replaces
+    nn.init.uniform_(self.lin_a_out.weight, -rank**(-0.5), rank**(-0.5))
+  def forward(self, a, v, vec_only=False):
     """ a: (..., adim)
-        v: (..., vdim, 3)
+        v: (..., 3, vdim)
+        vec_only: skip the scalar output, for callers that don't use it
         return: tuple(a_out, v_out)
-        a_out: (..., adim)
-        v_out: (..., vdim, 3) """
-    a_left, a_right = self.left_lin_a(a), self.right_lin_a(a)
-    v_left, v_right = self.left_lin_v(v), self.right_lin_v(v)
+        a_out: (..., adim), None if vec_only
+        v_out: (..., 3, vdim) """
+    a_left, a_right = self.lin_a_in(a).chunk(2, dim=-1)
+    v_left, v_right = self.lin_v_in(v).chunk(2, dim=-1)
     a_left_sq, a_right_sq = a_left**2, a_right**2
-    v_left_sq, v_right_sq = (v_left**2).sum(-1), (v_right**2).sum(-1)
-    aa_a = (a_left*a_right)                    / torch.sqrt(1. + a_left_sq + a_right_sq)
-    vv_a = (v_left*v_right).sum(-1)            / torch.sqrt(1. + v_left_sq + v_right_sq)
-    av_v = (a_left[..., None]*v_right)         / torch.sqrt(1. + a_left_sq + v_right_sq)[..., None]
-    vv_v = torch.linalg.cross(v_left, v_right) / torch.sqrt(1. + v_left_sq + v_right_sq)[..., None]
-    a_out = self.aa_lin_a(aa_a) + self.vv_lin_a(vv_a)
-    v_out = self.av_lin_v(av_v) + self.vv_lin_v(vv_v)
-    return a_out, v_out
+    v_left_sq, v_right_sq = (v_left**2).sum(-2), (v_right**2).sum(-2)
+    inv_norm_vv = torch.rsqrt(1. + v_left_sq + v_right_sq) # shared by both vv products
+    av_v = (a_left[..., None, :]*v_right)              * torch.rsqrt(1. + a_left_sq + v_right_sq)[..., None, :]
+    vv_v = torch.linalg.cross(v_left, v_right, dim=-2) * inv_norm_vv[..., None, :]
+    prod_v = torch.cat([av_v, vv_v], dim=-1)
+    if vec_only:
+      return None, self.lin_v_out(prod_v)
+    aa_a = (a_left*a_right)                            * torch.rsqrt(1. + a_left_sq + a_right_sq)
+    vv_a = (v_left*v_right).sum(-2)                    * inv_norm_vv
+    prod_a = torch.cat([aa_a, vv_a], dim=-1)
+    return self.lin_a_out(prod_a), self.lin_v_out(prod_v)
+  def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+    """ remap weights saved with separate left/right and aa/vv/av linear layers """
+    if prefix + "left_lin_a.weight" in state_dict:
+      old = {key: state_dict.pop(prefix + key) for key in [
+        "left_lin_a.weight", "left_lin_a.bias", "right_lin_a.weight", "right_lin_a.bias", "left_lin_v.W", "right_lin_v.W",
+        "aa_lin_a.weight", "aa_lin_a.bias", "vv_lin_a.weight", "vv_lin_a.bias", "av_lin_v.W", "vv_lin_v.W"]}
+      state_dict[prefix + "lin_a_in.weight"] = torch.cat([old["left_lin_a.weight"], old["right_lin_a.weight"]], dim=0)
+      state_dict[prefix + "lin_a_in.bias"] = torch.cat([old["left_lin_a.bias"], old["right_lin_a.bias"]], dim=0)
+      state_dict[prefix + "lin_v_in.W"] = torch.cat([old["left_lin_v.W"], old["right_lin_v.W"]], dim=0)
+      state_dict[prefix + "lin_a_out.weight"] = torch.cat([old["aa_lin_a.weight"], old["vv_lin_a.weight"]], dim=1)
+      state_dict[prefix + "lin_a_out.bias"] = old["aa_lin_a.bias"] + old["vv_lin_a.bias"]
+      state_dict[prefix + "lin_v_out.W"] = torch.cat([old["av_lin_v.W"], old["vv_lin_v.W"]], dim=1)
+    super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+# the 6 = (4 choose 2) relative vectors between the ends of an edge, as coefficients of the 4 positions
+# (pos_0_src, pos_1_src, pos_0_dst, pos_1_dst), see edge_relative_vecs()
+EDGE_VECS_COEFFS = torch.tensor([
+  # 0dst-0src 1dst-1src 1src-0src 1dst-0dst 1src-0dst 1dst-0src
+  [-1.,       0.,       -1.,       0.,       0.,       -1.], # pos_0_src
+  [ 0.,      -1.,        1.,       0.,       1.,        0.], # pos_1_src
+  [ 1.,       0.,        0.,      -1.,      -1.,        0.], # pos_0_dst
+  [ 0.,       1.,        0.,       1.,       0.,        1.], # pos_1_dst
+])
+_edge_vecs_coeffs = {} # EDGE_VECS_COEFFS by device
+
+@float32 # relative vectors are differences of absolute positions, so need full precision
+def edge_relative_vecs(pos_0, pos_1, graph):
+  """ the 6 relative vectors between the 2 positions at the source and destination nodes of each edge.
+      Both positions are gathered together, and in float32 multiplying by +-1 and adding 0 is exact, so
+      this is exactly the same as taking the differences one by one.
+      pos_0, pos_1: (batch, nodes, 3)
+      return: (batch, edges, 3, 6) """
+  if pos_0.device not in _edge_vecs_coeffs:
+    _edge_vecs_coeffs[pos_0.device] = EDGE_VECS_COEFFS.to(pos_0.device)
+  pos = torch.stack([pos_0, pos_1], dim=3) # (batch, nodes, 3, 2)
+  ends = torch.cat([graph.gather_src(pos), graph.gather_dst(pos)], dim=3) # (batch, edges, 3, 4)
+  return ends @ _edge_vecs_coeffs[pos_0.device]
 
 
 class EdgeRelativeEmbed(nn.Module):
@@ -249,16 +566,9 @@ class EdgeRelativeEmbed(nn.Module):
         pos1: (batch, node, 3)
         return: tuple(a_out, v_out)
         a_out: (batch, edge, adim)
-        v_out: (batch, edge, vdim, 3) """
-    vecs = torch.stack([ # 6 = (4 choose 2) relative vectors
-        pos_0[:, graph.dst] - pos_0[:, graph.src],
-        pos_1[:, graph.dst] - pos_1[:, graph.src],
-        pos_1[:, graph.src] - pos_0[:, graph.src],
-        pos_1[:, graph.dst] - pos_0[:, graph.dst],
-        pos_1[:, graph.src] - pos_0[:, graph.dst],
-        pos_1[:, graph.dst] - pos_0[:, graph.src],
-      ], dim=2) # (batch, edges, 6, 3)
-    norms = torch.linalg.vector_norm(vecs, dim=-1) # (batch, edges, 6)
+        v_out: (batch, edge, 3, vdim) """
+    vecs = edge_relative_vecs(pos_0, pos_1, graph) # (batch, edges, 3, 6)
+    norms = vector_norm(vecs, dim=2) # (batch, edges, 6)
     a_out = self.lin_a(norms)
     v_out = self.lin_v(vecs)/3 # fudge factor of 1/3
     return a_out, v_out
@@ -275,11 +585,11 @@ class NodeRelativeEmbed(nn.Module):
         pos1: (batch, node, 3)
         return: tuple(a_out, v_out)
         a_out: (batch, edge, adim)
-        v_out: (batch, edge, vdim, 3) """
+        v_out: (batch, edge, 3, vdim) """
     vecs = torch.stack([ # 1 = (2 choose 2) relative vectors
         pos_1 - pos_0,
-      ], dim=2) # (batch, edges, 1, 3)
-    norms = torch.linalg.vector_norm(vecs, dim=-1) # (batch, edges, 1)
+      ], dim=3) # (batch, edges, 3, 1)
+    norms = vector_norm(vecs, dim=2) # (batch, edges, 1)
     a_out = self.lin_a(norms)
     v_out = self.lin_v(vecs)/3 # fudge factor of 1/3
     return a_out, v_out
@@ -301,16 +611,9 @@ class EdgeRelativeEmbedMLP(nn.Module):
         pos1: (batch, node, 3)
         return: tuple(a_out, v_out)
         a_out: (batch, edge, adim)
-        v_out: (batch, edge, vdim, 3) """
-    vecs = torch.stack([ # 6 = (4 choose 2) relative vectors
-        pos_0[:, graph.dst] - pos_0[:, graph.src],
-        pos_1[:, graph.dst] - pos_1[:, graph.src],
-        pos_1[:, graph.src] - pos_0[:, graph.src],
-        pos_1[:, graph.dst] - pos_0[:, graph.dst],
-        pos_1[:, graph.src] - pos_0[:, graph.dst],
-        pos_1[:, graph.dst] - pos_0[:, graph.src],
-      ], dim=2) # (batch, edges, 6, 3)
-    norms = torch.linalg.vector_norm(vecs, dim=-1) # (batch, edges, 6)
+        v_out: (batch, edge, 3, vdim) """
+    vecs = edge_relative_vecs(pos_0, pos_1, graph) # (batch, edges, 3, 6)
+    norms = vector_norm(vecs, dim=2) # (batch, edges, 6)
     a_out = self.scalar_layers(norms)
     v_out = self.lin_v(vecs)/3 # fudge factor of 1/3
     return a_out, v_out
@@ -332,16 +635,76 @@ class NodeRelativeEmbedMLP(nn.Module):
         pos1: (batch, node, 3)
         return: tuple(a_out, v_out)
         a_out: (batch, edge, adim)
-        v_out: (batch, edge, vdim, 3) """
+        v_out: (batch, edge, 3, vdim) """
     vecs = torch.stack([ # 1 = (2 choose 2) relative vectors
         pos_1 - pos_0,
-      ], dim=2) # (batch, edges, 1, 3)
-    norms = torch.linalg.vector_norm(vecs, dim=-1) # (batch, edges, 1)
+      ], dim=3) # (batch, edges, 3, 1)
+    norms = vector_norm(vecs, dim=2) # (batch, edges, 1)
     a_out = self.scalar_layers(norms)
     v_out = self.lin_v(vecs)/3 # fudge factor of 1/3
     return a_out, v_out
 
 
+# Group norms: fused versions of the straightforward computation (see benchmark_group_norms.py for that, and a check
+# that these give the same outputs and gradients). The statistics are computed in one pass, the normalisation is a
+# single elementwise op with per-group scale and shift, and the backward pass recomputes the normalised values from
+# the input rather than keeping them, so only the input and the (tiny) per-group statistics are saved for backward.
+# The statistics are passed from forward to setup_context as extra outputs without gradients. The Functions have
+# vmap rules generated by pytorch, so they also work in ensembles (see ensemble.py).
+
+class _ScalGroupNormFn(torch.autograd.Function):
+  """ x: (batch, nodes, groups, chan//groups), gamma, beta: (groups, chan//groups)
+      returns the normalised x, and the statistics mean and rstd """
+  generate_vmap_rule = True
+  @staticmethod
+  def forward(x, gamma, beta, epsilon):
+    var, mean = torch.var_mean(x, dim=(1, 3), correction=0, keepdim=True) # (batch, 1, groups, 1)
+    rstd = torch.rsqrt(epsilon + var)
+    scale = gamma*rstd # (batch, 1, groups, chan//groups)
+    return torch.addcmul(beta - mean*scale, x, scale), mean, rstd
+  @staticmethod
+  def setup_context(ctx, inputs, output):
+    x, gamma, beta, epsilon = inputs
+    ans, mean, rstd = output
+    ctx.mark_non_differentiable(mean, rstd)
+    ctx.save_for_backward(x, mean, rstd, gamma)
+  @staticmethod
+  def backward(ctx, grad, grad_mean, grad_rstd):
+    x, mean, rstd, gamma = ctx.saved_tensors
+    x_norm = (x - mean)*rstd
+    grad_x_norm = grad*gamma
+    grad_x = rstd*(grad_x_norm
+      - grad_x_norm.mean((1, 3), keepdim=True)
+      - x_norm*(grad_x_norm*x_norm).mean((1, 3), keepdim=True))
+    return grad_x, (grad*x_norm).sum((0, 1)), grad.sum((0, 1)), None
+
+class _VecGroupNormFn(torch.autograd.Function):
+  """ x: (batch, nodes, 3, groups, chan//groups), gamma: (groups, chan//groups)
+      returns the normalised x, and the statistic rnorm """
+  generate_vmap_rule = True
+  @staticmethod
+  def forward(x, gamma, epsilon):
+    batch, nodes, must_be[3], groups, chan_per_group = x.shape
+    count = nodes*chan_per_group # moment2 sums over the 3 components, and averages over the rest
+    moment2 = torch.linalg.vector_norm(x, dim=(1, 2, 4), keepdim=True)**2/count # (batch, 1, 1, groups, 1)
+    rnorm = torch.rsqrt(epsilon + moment2)
+    return x*(gamma*rnorm), rnorm
+  @staticmethod
+  def setup_context(ctx, inputs, output):
+    x, gamma, epsilon = inputs
+    ans, rnorm = output
+    batch, nodes, must_be[3], groups, chan_per_group = x.shape
+    ctx.count = nodes*chan_per_group
+    ctx.mark_non_differentiable(rnorm)
+    ctx.save_for_backward(x, rnorm, gamma)
+  @staticmethod
+  def backward(ctx, grad, grad_rnorm):
+    x, rnorm, gamma = ctx.saved_tensors
+    grad_x_gamma = grad*x
+    dot = (grad_x_gamma*gamma).sum((1, 2, 4), keepdim=True) # (batch, 1, 1, groups, 1)
+    grad_x = grad*(gamma*rnorm) - x*(dot*rnorm**3/ctx.count)
+    return grad_x, (grad_x_gamma*rnorm).sum((0, 1, 2)), None
+
 class ScalGroupNorm(nn.Module):
   """ Scalar group norm, should be a fairly standard group norm as found eg here:
       https://pytorch.org/docs/stable/generated/torch.nn.GroupNorm.html
@@ -354,17 +717,15 @@ class ScalGroupNorm(nn.Module):
     self.epsilon = epsilon
     self.gamma = nn.Parameter(torch.ones(chan))
     self.beta = nn.Parameter(torch.zeros(chan))
+  @float32 # norm statistics are sensitive to rounding
   def forward(self, x):
     """ note: where we write "nodes" here, we could also write "edges"
         x: (batch, nodes, chan)
         return: (batch, nodes, chan) """
     batch, nodes, must_be[self.chan] = x.shape
-    x = x.reshape(batch, nodes, self.groups, -1)
-    mean = x.mean([1, 3], keepdim=True)
-    x_shift = x - mean
-    var = ((x_shift)**2).mean([1, 3], keepdim=True)
-    ans = x_shift/torch.sqrt(self.epsilon + var)
-    return self.beta + self.gamma*ans.reshape(batch, nodes, self.chan)
+    ans, _, _ = _ScalGroupNormFn.apply(x.reshape(batch, nodes, self.groups, -1),
+      self.gamma.reshape(self.groups, -1), self.beta.reshape(self.groups, -1), self.epsilon)
+    return ans.reshape(batch, nodes, self.chan)
 
 class VecGroupNorm(nn.Module):
   def __init__(self, chan, groups, epsilon=1e-5):
@@ -373,16 +734,16 @@ class VecGroupNorm(nn.Module):
     self.chan = chan
     self.groups = groups
     self.epsilon = epsilon
-    self.gamma = nn.Parameter(torch.ones(chan, 1))
+    self.gamma = nn.Parameter(torch.ones(chan, 1)) # keeps its old (chan, 1) shape, for checkpoints
+  @float32 # norm statistics are sensitive to rounding
   def forward(self, x):
     """ note: where we write "nodes" here, we could also write "edges"
-        x: (batch, nodes, chan, 3)
-        return: (batch, nodes, chan, 3) """
-    batch, nodes, must_be[self.chan], must_be[3] = x.shape
-    x = x.reshape(batch, nodes, self.groups, -1, 3)
-    moment2 = (x**2).sum(4, keepdim=True).mean([1, 3], keepdim=True) # (batch, 1, groups, 1, 1)
-    ans = x/torch.sqrt(self.epsilon + moment2)
-    return self.gamma*ans.reshape(batch, nodes, self.chan, 3)
+        x: (batch, nodes, 3, chan)
+        return: (batch, nodes, 3, chan) """
+    batch, nodes, must_be[3], must_be[self.chan] = x.shape
+    ans, _ = _VecGroupNormFn.apply(x.reshape(batch, nodes, 3, self.groups, -1), self.gamma.reshape(self.groups, -1),
+      self.epsilon)
+    return ans.reshape(batch, nodes, 3, self.chan)
 
 
 
@@ -408,17 +769,18 @@ class VecConv1d(nn.Module):
     if edges_to_nodes:
       assert kernsz % 2 == 0
       self.conv = nn.Conv1d(chan, chan, kernsz, padding=(kernsz//2), bias=False)
+      self.padding = (kernsz//2, 0)
     else:
       assert kernsz % 2 == 1
       self.conv = nn.Conv1d(chan, chan, kernsz, padding="same", bias=False)
+      self.padding = "same"
   def forward(self, x):
-    """ x: (batch, length, chan, 3) """
-    batch, length, chan, must_be[3] = x.shape
-    x = x.permute(0, 3, 2, 1).reshape(3*batch, chan, length) # (batch*3, chan, length)
-    y = self.conv(x)
-    must_be[batch*3], must_be[chan], newlength = y.shape # length might have changed!
-    y = y.reshape(batch, 3, chan, newlength).permute(0, 3, 2, 1) # (batch, newlength, chan, 3)
-    return y
+    """ x: (batch, length, 3, chan) """
+    batch, length, must_be[3], chan = x.shape
+    # (batch, chan, length, 3) view of x is channels_last, so conv2d with a (kernsz, 1) kernel needs no copy
+    y = F.conv2d(x.permute(0, 3, 1, 2), self.conv.weight[..., None], padding=self.padding)
+    must_be[batch], must_be[chan], newlength, must_be[3] = y.shape # length might have changed!
+    return y.permute(0, 2, 3, 1) # (batch, newlength, 3, chan)
 
 
 class EdgeRelativeEmbedMLPPath(nn.Module):
@@ -438,7 +800,7 @@ class EdgeRelativeEmbedMLPPath(nn.Module):
         pos1: (batch, nodes, 3)
         return: tuple(a_out, v_out)
         a_out: (batch, nodes, adim)
-        v_out: (batch, nodes, vdim, 3) """
+        v_out: (batch, nodes, 3, vdim) """
     batch,          nodes,          must_be[3] = pos_0.shape
     must_be[batch], must_be[nodes], must_be[3] = pos_1.shape
     vecs = torch.stack([ # 4 relative vectors
@@ -446,8 +808,8 @@ class EdgeRelativeEmbedMLPPath(nn.Module):
         pos_1[:,  1:] - pos_1[:, :-1],
         pos_1[:, :-1] - pos_0[:,  1:],
         pos_1[:,  1:] - pos_0[:, :-1],
-      ], dim=2) # (batch, nodes - 1, 4, 3)
-    norms = torch.linalg.vector_norm(vecs, dim=-1) # (batch, nodes - 1, 4)
+      ], dim=3) # (batch, nodes - 1, 3, 4)
+    norms = vector_norm(vecs, dim=2) # (batch, nodes - 1, 4)
     y_a = self.scalar_layers(norms)
     y_v = self.lin_v(vecs)
     a_out = self.conv_a(y_a)
@@ -457,3 +819,60 @@ class EdgeRelativeEmbedMLPPath(nn.Module):
 
 
 
+
+
+# Activation checkpointing for the stacks of Blocks in the 3D archs. With the "checkpoint_blocks" arch_specific key
+# set to k > 0, a BlockStack runs its blocks in chunks of k under torch.utils.checkpoint: only the inputs of each
+# chunk are kept for the backward pass, and the activations inside a chunk are recomputed when backward gets to it.
+# This trades roughly one extra forward pass of the stack for activation memory, which otherwise grows with the
+# number of blocks times batch*nodes (or batch*nodes**2 for ProximityAttention), see benchmark_checkpointing.py.
+# The RNG state is saved and restored for the recomputation, so stochastic layers see the same random numbers
+# both times. Buffers (batch norm running statistics) are also restored after the recomputation, so that they
+# are only updated once per forward pass.
+# Stacks whose final scalar features are never read (most generator heads only read out vectors) can be made with
+# vec_only=True. Their last block is then called as block(tup, vec_only=True), and skips the layers that only feed
+# its scalar outputs, which it returns as None. This changes no parameters, so checkpoints load as before.
+
+def checkpoint_blocks(config):
+  """ number of blocks per checkpointed chunk of a BlockStack, 0 for no checkpointing """
+  return config["checkpoint_blocks"] if "checkpoint_blocks" in config.arch_specific else 0
+
+class BlockStack(nn.Sequential):
+  """ nn.Sequential of blocks, with activation checkpointing every checkpoint_blocks(config) blocks while
+      gradients are enabled. Has the same state_dict keys as the nn.Sequential it replaces.
+      vec_only: the last block only computes vector outputs, its scalar outputs are None """
+  def __init__(self, config, *blocks, vec_only=False):
+    super().__init__(*blocks)
+    self.chunk = checkpoint_blocks(config)
+    assert self.chunk >= 0
+    self.vec_only = vec_only
+  def forward(self, x):
+    blocks = list(self)
+    if self.chunk == 0 or not torch.is_grad_enabled():
+      return _BlocksChunk(blocks, self.vec_only)(x)
+    for i in range(0, len(blocks), self.chunk):
+      last = (i + self.chunk >= len(blocks))
+      x = torch.utils.checkpoint.checkpoint(_BlocksChunk(blocks[i:i + self.chunk], self.vec_only and last), x,
+        use_reentrant=False, preserve_rng_state=True)
+    return x
+
+class _BlocksChunk:
+  """ runs a chunk of blocks. calls after the first are recomputations, which leave the buffers unchanged """
+  def __init__(self, blocks, vec_only):
+    self.blocks = blocks
+    self.vec_only = vec_only
+    self.calls = 0
+  def __call__(self, x):
+    self.calls += 1
+    recompute = self.calls > 1
+    if recompute:
+      buffers = [buf for block in self.blocks for buf in block.buffers()]
+      saved = [buf.clone() for buf in buffers]
+    for block in self.blocks[:-1]:
+      x = block(x)
+    x = self.blocks[-1](x, vec_only=True) if self.vec_only else self.blocks[-1](x)
+    if recompute:
+      with torch.no_grad():
+        for buf, buf_saved in zip(buffers, saved):
+          buf.copy_(buf_saved)
+    return x
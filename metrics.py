@@ -0,0 +1,120 @@
+import os
+import time
+from threading import Thread
+from queue import Queue
+
+import numpy as np
+import torch
+
+from run_visualization import LOG_DIR, TensorBoard
+
+
+# Training metrics, logged without slowing down the training loop. Metrics has the same scalar() method as
+# TensorBoard, but values can be passed as (device) tensors, eg. loss.detach(): they are copied into a buffer
+# on the device, and only brought to the host by a background thread. Every FLUSH_EVERY steps, the thread
+# writes the mean / min / max of each metric over those steps to TensorBoard, and appends the per-step values
+# to a columnar log: runs/<run name>/metrics/<label>.f32 (values) and <label>.i64 (steps), see read_metric().
+# A summary line is printed to the console at most once every PRINT_INTERVAL seconds.
+
+
+FLUSH_EVERY = 64     # steps per window
+PRINT_INTERVAL = 10. # seconds
+
+
+class _Window:
+  """ buffer holding the values of one metric during the current window. stored on the device that the
+      values come from, so that adding a value never has to wait for the device """
+  def __init__(self, size, device):
+    self.steps = np.zeros(size, dtype=np.int64)
+    self.vals = torch.zeros(size, device=device)
+    self.n = 0
+  def add(self, i, val):
+    self.steps[self.n] = i
+    self.vals[self.n] = val
+    self.n += 1
+  def take(self):
+    """ returns the contents of the buffer and empties it """
+    ans = self.steps[:self.n].copy(), self.vals[:self.n].clone()
+    self.n = 0
+    return ans
+
+
+class Metrics:
+  """ drop-in replacement for TensorBoard that trainers can log to every step, see above """
+  def __init__(self, name, flush_every=FLUSH_EVERY, print_interval=PRINT_INTERVAL):
+    self.name = name
+    self.flush_every = flush_every
+    self.print_interval = print_interval
+    self.board = TensorBoard(name)
+    self.dir = os.path.join(LOG_DIR, name, "metrics")
+    os.makedirs(self.dir, exist_ok=True)
+    self.windows = {}
+    self.window_end = None # first step of the next window
+    self.queue = Queue(maxsize=8)
+    self.error = None
+    self.thread = Thread(target=self._thread_main, daemon=True)
+    self.thread.start()
+  def scalar(self, label, i, val):
+    self._check_error()
+    if self.window_end is None:
+      self.window_end = i - (i % self.flush_every) + self.flush_every
+    if i >= self.window_end:
+      self.flush()
+      self.window_end = i - (i % self.flush_every) + self.flush_every
+    if isinstance(val, torch.Tensor):
+      val = val.detach()
+    if label not in self.windows:
+      device = val.device if isinstance(val, torch.Tensor) else "cpu"
+      self.windows[label] = _Window(self.flush_every, device)
+    self.windows[label].add(i, val)
+  def img_grid(self, label, images):
+    self.board.img_grid(label, images)
+  def flush(self):
+    """ hand the values logged so far over to the background thread """
+    batch = [(label, *window.take()) for label, window in self.windows.items() if window.n > 0]
+    if len(batch) > 0:
+      self.queue.put(batch)
+  def close(self):
+    """ flush, wait for everything to be written, and stop the background thread """
+    self.flush()
+    self.queue.put(None)
+    self.thread.join()
+    self.board.close()
+    self._check_error()
+  def _check_error(self):
+    if self.error is not None:
+      error, self.error = self.error, None
+      raise RuntimeError("metrics thread failed") from error
+  def _thread_main(self):
+    last_print = None
+    while True:
+      batch = self.queue.get()
+      if batch is None:
+        return
+      try:
+        summary = []
+        for label, steps, vals in batch:
+          vals = vals.to("cpu", torch.float32).numpy()
+          step = int(steps[-1])
+          self.board.scalar(label, step, vals.mean())
+          self.board.scalar(label + "/min", step, vals.min())
+          self.board.scalar(label + "/max", step, vals.max())
+          path = os.path.join(self.dir, label) # labels like "time/data" go in subdirectories
+          os.makedirs(os.path.dirname(path), exist_ok=True)
+          with open(path + ".f32", "ab") as f:
+            f.write(vals.tobytes())
+          with open(path + ".i64", "ab") as f:
+            f.write(steps.tobytes())
+          summary.append("%s = %05.6f" % (label, vals.mean()))
+        now = time.time()
+        if last_print is None or now - last_print >= self.print_interval:
+          print("%d\t %s" % (step, "   ".join(summary)))
+          last_print = now
+      except BaseException as e:
+        self.error = e
+
+
+def read_metric(name, label):
+  """ read the per-step log of a metric from run name. returns steps, values as numpy arrays """
+  path = os.path.join(LOG_DIR, name, "metrics", label)
+  return np.fromfile(path + ".i64", dtype=np.int64), np.fromfile(path + ".f32", dtype=np.float32)
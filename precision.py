@@ -0,0 +1,203 @@
+import time
+import copy
+import functools
+from contextlib import redirect_stdout
+from io import StringIO
+
+import torch
+from torch.overrides import TorchFunctionMode
+from torch.utils._pytree import tree_map
+
+
+# Reduced precision training and inference. With Config(..., precision="bf16"), train.train() and
+# test_model.get_sample_step() run models under torch.autocast with dtype bfloat16 (works on CPU and GPU).
+# Weights and optimizer states stay in float32, only the matmuls / convs / einsums run in bfloat16.
+# Numerically sensitive functions are marked with the @float32 decorator so that they run in float32
+# even inside an autocast region: group norm statistics, vector norms, attention softmaxes, endpoint penalties.
+# bfloat16 has the same exponent range as float32, so gradients don't underflow and no loss scaling is
+# needed (float16 would need a GradScaler, which is why we don't offer it).
+#
+# To check a trained model at reduced precision:  python precision.py models/my_model.pt
+# To check a new model of a 3D GAN arch (this includes the equivariance check, which checks that the vector
+# features are laid out the way RotatedNoise expects):  python precision.py --arch wgan_3d_simple4
+
+
+PRECISIONS = ["fp32", "bf16"]
+
+
+def autocast(config, precision=None):
+  """ context manager that runs code at the precision given by config (or precision, if specified) """
+  if precision is None: precision = config.precision
+  assert precision in PRECISIONS, "unknown precision %s" % precision
+  return torch.autocast(torch.device(config.device).type, dtype=torch.bfloat16, enabled=(precision == "bf16"))
+
+
+def _autocast_device_types():
+  """ device types for which autocast is currently enabled """
+  try:
+    return [device_type for device_type in ["cpu", "cuda"] if torch.is_autocast_enabled(device_type)]
+  except TypeError: # older pytorch, is_autocast_enabled() takes no arguments and refers to cuda
+    return ["cpu"]*torch.is_autocast_cpu_enabled() + ["cuda"]*torch.is_autocast_enabled()
+
+def _to_float32(x):
+  if isinstance(x, torch.Tensor) and x.is_floating_point():
+    return x.to(torch.float32)
+  return x
+
+def float32(fn):
+  """ decorator: fn runs in float32 even inside an autocast region, floating point tensor arguments
+      (also those inside lists and tuples) are cast to float32 """
+  @functools.wraps(fn)
+  def wrapped(*args, **kwargs):
+    device_types = _autocast_device_types()
+    if len(device_types) == 0:
+      return fn(*args, **kwargs)
+    args, kwargs = tree_map(_to_float32, (args, kwargs))
+    with torch.autocast(device_types[0], enabled=False):
+      if len(device_types) > 1:
+        with torch.autocast(device_types[1], enabled=False):
+          return fn(*args, **kwargs)
+      return fn(*args, **kwargs)
+  return wrapped
+
+
+@float32
+def vector_norm(x, dim=-1):
+  """ torch.linalg.vector_norm, always in float32 """
+  return torch.linalg.vector_norm(x, dim=dim)
+
+
+
+# VALIDATION:
+
+EQUIV_TOL = 0.03 # max relative equivariance error
+STAT_TOL = 0.05  # max change in mean or std of predicted displacements, relative to std
+NEW_GAN_3D = { # small hyperparameters for checking new models of the 3D GAN archs
+  "lr_d": 1e-3, "lr_g": 1e-3, "beta_1": 0.5, "beta_2": 0.99, "weight_decay": 0.,
+  "adim": 32, "vdim": 16, "agroups": 4, "vgroups": 4, "rank": 8,
+  "inst_noise_str_r": 0.1, "inst_noise_str_g": 0.1, "lpen_wt": 1., "z_scale": 1.,
+  "r0_list": [2., 4., 8., 16.], "kq_dim": (4, 4), "lr_d_fac": 1., "lr_g_fac": 1., # archs with attention
+}
+
+
+class RotatedNoise(TorchFunctionMode):
+  """ rotates all gaussian noise that is made of 3D vectors: vector features (batch, nodes, 3, chan) are rotated
+      along dim -2, and other noise with a trailing dimension of size 3 (eg. positions) along dim -1. Since the
+      gaussian is isotropic, this doesn't change its distribution, but it lets us compare f(R x) with R f(x) sample
+      by sample for generative models. (Assumes that scalar latents don't happen to have a dimension of size 3 in
+      those places.) """
+  def __init__(self, R):
+    super().__init__()
+    self.R = R
+  def __torch_function__(self, func, types, args=(), kwargs=None):
+    if kwargs is None: kwargs = {}
+    ans = func(*args, **kwargs)
+    if func in [torch.randn, torch.randn_like]:
+      if ans.dim() >= 4 and ans.shape[-2] == 3: # vector features
+        ans = self.R.to(ans.dtype) @ ans
+      elif ans.shape[-1] == 3:
+        ans = ans @ self.R.T.to(ans.dtype)
+    return ans
+
+def random_rotation(device):
+  Q, _ = torch.linalg.qr(torch.randn(3, 3, device=device))
+  if torch.linalg.det(Q) < 0:
+    Q = -Q
+  return Q
+
+def rotate(states, R):
+  batch, dim = states.shape
+  return (states.reshape(batch, dim // 3, 3) @ R.T).reshape(batch, dim)
+
+
+def get_states(config, batch):
+  from sims import equilibrium_sample, get_dataset
+  return get_dataset(config, equilibrium_sample(config, batch), 1)[:, 0].to(config.device, torch.float32)
+
+def predict(model, states, precision, seed):
+  torch.manual_seed(seed)
+  with torch.no_grad(), autocast(model.config, precision):
+    return model.predict(model.config.cond(states)).to(torch.float32)
+
+def equivariance_error(model, states, precision, seed=0):
+  """ relative error between f(R x) and R f(x) """
+  R = random_rotation(states.device)
+  y = predict(model, states, precision, seed)
+  with RotatedNoise(R):
+    y_rot = predict(model, rotate(states, R), precision, seed)
+  return (torch.linalg.vector_norm(y_rot - rotate(y, R))/torch.linalg.vector_norm(y)).item()
+
+def statistics_error(model, states, seed=0):
+  """ changes in the mean and std of predicted displacements going from fp32 to bf16, relative to their std """
+  delta_32 = predict(model, states, "fp32", seed) - states
+  delta_16 = predict(model, states, "bf16", seed) - states
+  std_32 = delta_32.std(0)
+  mean_err = ((delta_16.mean(0) - delta_32.mean(0)).abs()/std_32).max().item()
+  std_err = ((delta_16.std(0) - std_32).abs()/std_32).max().item()
+  return mean_err, std_err
+
+def throughput(model, states, precision, reps=8):
+  """ training steps per second and predictions per second """
+  from run_visualization import DummyTensorBoard
+  from train import generate_chunk
+  config = model.config
+  model = copy.deepcopy(model) # so that we don't train the model under test
+  trainer = config.trainerclass(model, DummyTensorBoard())
+  trajs = generate_chunk(config)[:config.batch]
+  with redirect_stdout(StringIO()), autocast(config, precision):
+    trainer.step(0, trajs) # warmup
+    t0 = time.perf_counter()
+    for i in range(reps):
+      trainer.step(i + 1, trajs)
+    train_rate = reps/(time.perf_counter() - t0)
+  predict(model, states, precision, 0) # warmup
+  t0 = time.perf_counter()
+  for i in range(reps):
+    predict(model, states, precision, 0)
+  predict_rate = reps*states.shape[0]/(time.perf_counter() - t0)
+  return train_rate, predict_rate
+
+
+def validate(model, batch=512):
+  """ check that model behaves the same at bf16 as it does at fp32. returns True if within tolerance """
+  config = model.config
+  model.set_eval(True)
+  states = get_states(config, batch)
+  ok = True
+  if config.x_only and getattr(config.sim, "space_dim", None) == 3 and config.cond(states) is states:
+    for precision in PRECISIONS:
+      err = equivariance_error(model, states, precision)
+      print("equivariance error (%s): %.5f" % (precision, err))
+      ok = ok and err < EQUIV_TOL
+  mean_err, std_err = statistics_error(model, states)
+  print("displacement mean error: %.5f    std error: %.5f" % (mean_err, std_err))
+  ok = ok and mean_err < STAT_TOL and std_err < STAT_TOL
+  for precision in PRECISIONS:
+    train_rate, predict_rate = throughput(model, states, precision)
+    print("%s: %.2f train steps/s, %.1f predictions/s" % (precision, train_rate, predict_rate))
+  print("PASS" if ok else "FAIL")
+  return ok
+
+def new_gan_3d(arch_name, device):
+  """ new model of a 3D GAN arch, with small hyperparameters """
+  from config import Config, Condition, makenew
+  return makenew(Config("3d_ou_poly_l12_t30", arch_name, cond=Condition.COORDS, x_only=True, device=device,
+    batch=8, simlen=3, arch_specific=NEW_GAN_3D))
+
+
+
+if __name__ == "__main__":
+  from argparse import ArgumentParser
+  from config import load
+  parser = ArgumentParser(prog="precision")
+  parser.add_argument("fpath", nargs="?", default=None)
+  parser.add_argument("--arch", dest="arch", default=None, help="check a new model of this 3D GAN arch instead")
+  parser.add_argument("--device", dest="device", default="cuda" if torch.cuda.is_available() else "cpu")
+  parser.add_argument("--batch", dest="batch", type=int, default=512)
+  args = parser.parse_args()
+  assert (args.fpath is None) != (args.arch is None), "expected either a model path or --arch"
+  if args.arch is not None:
+    torch.manual_seed(0)
+    validate(new_gan_3d(args.arch, args.device), args.batch)
+  else:
+    validate(load(args.fpath), args.batch)
@@ -0,0 +1,87 @@
+import os
+import functools
+
+import torch
+from torch.profiler import profile, record_function, schedule, ProfilerActivity
+
+
+# Profiling of training runs. With Config(..., profile="time"), train.train() runs the torch profiler on a
+# few windows of training steps: after skipping the first PROFILE_SKIP_FIRST steps (compilation, warming up
+# the allocator...), it repeatedly waits PROFILE_WAIT steps, warms up for PROFILE_WARMUP steps and then
+# records PROFILE_ACTIVE steps, PROFILE_REPEAT times in total. profile="memory" additionally records
+# memory allocations and tensor shapes.
+# For each window, we write to runs/<run name>/profile/:
+#   trace_<step>.json   chrome trace, open in chrome://tracing or https://ui.perfetto.dev
+#   ops_<step>.txt      table of operators, sorted by time (and by memory, for profile="memory")
+# The main phases of training are labelled in the trace: "data" (waiting for the simulation thread),
+# "simulation" (generating a chunk of data, on the simulation thread), "train_step" and its parts
+# ("disc_step", "gen_step", ... whichever the model has), and "checkpoint".
+
+
+PROFILE_MODES = ["none", "time", "memory"]
+PROFILE_SKIP_FIRST = 16
+PROFILE_WAIT = 8
+PROFILE_WARMUP = 2
+PROFILE_ACTIVE = 4
+PROFILE_REPEAT = 3
+PROFILE_ROW_LIMIT = 40
+LABELLED_METHODS = ["train_step", "disc_step", "gen_step"]
+
+
+def label_method(obj, name):
+  """ replace method name of obj with a version whose calls are labelled in the profiler trace """
+  method = getattr(obj, name)
+  @functools.wraps(method)
+  def wrapped(*args, **kwargs):
+    with record_function(name):
+      return method(*args, **kwargs)
+  setattr(obj, name, wrapped)
+
+
+def _trace_handler(log_dir, profile_mode, device):
+  def on_trace_ready(prof):
+    os.makedirs(log_dir, exist_ok=True)
+    step = prof.step_num
+    prof.export_chrome_trace(os.path.join(log_dir, "trace_%d.json" % step))
+    averages = prof.key_averages()
+    tables = [averages.table(sort_by="self_%s_time_total" % device, row_limit=PROFILE_ROW_LIMIT)]
+    if profile_mode == "memory":
+      tables.append(averages.table(sort_by="self_%s_memory_usage" % device, row_limit=PROFILE_ROW_LIMIT))
+    with open(os.path.join(log_dir, "ops_%d.txt" % step), "w") as f:
+      f.write("\n\n".join(tables))
+    print("wrote profile of steps up to %d to %s" % (step, log_dir))
+  return on_trace_ready
+
+
+def profiler(model, run_name, rank=0):
+  """ returns a context manager for the training loop, which is a torch profiler if model.config asks for
+      profiling (see above). the training loop should call its step() method after every training step """
+  profile_mode = model.config.profile
+  assert profile_mode in PROFILE_MODES, "unknown profile mode %s" % profile_mode
+  if profile_mode == "none":
+    return _NoProfiler()
+  for name in LABELLED_METHODS:
+    if hasattr(model, name):
+      label_method(model, name)
+  from run_visualization import LOG_DIR # import here, since config imports this module and shouldn't need tensorboard
+  log_dir = os.path.join(LOG_DIR, run_name, "profile" if rank == 0 else "profile_rank%d" % rank)
+  device = torch.device(model.config.device).type
+  activities = [ProfilerActivity.CPU]
+  if device == "cuda":
+    activities.append(ProfilerActivity.CUDA)
+  return profile(
+    activities=activities,
+    schedule=schedule(skip_first=PROFILE_SKIP_FIRST, wait=PROFILE_WAIT, warmup=PROFILE_WARMUP,
+      active=PROFILE_ACTIVE, repeat=PROFILE_REPEAT),
+    on_trace_ready=_trace_handler(log_dir, profile_mode, device),
+    profile_memory=(profile_mode == "memory"),
+    record_shapes=(profile_mode == "memory"))
+
+
+class _NoProfiler:
+  def __enter__(self):
+    return self
+  def __exit__(self, *exc):
+    return False
+  def step(self):
+    pass
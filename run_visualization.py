@@ -19,6 +19,8 @@ class DummyTensorBoard:
     pass
   def scalar(self, label, i, val):
     pass
+  def close(self):
+    pass
 
 class TensorBoard:
   """ logs various kinds of data to a tensor board """
@@ -31,6 +33,8 @@ class TensorBoard:
     self.writer.add_image(label, grid)
   def scalar(self, label, i, val):
     self.writer.add_scalar(label, val, i)
+  def close(self):
+    self.writer.close()
 
 
 
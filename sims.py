@@ -1,10 +1,13 @@
 import torch
 
 from utils import must_be
+from timers import TIMERS
 
 
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu" # device that simulations run on
 
-def vvel_lng_batch(x, v, a, drag, T, dt, nsteps, device="cuda"):
+
+def vvel_lng_batch(x, v, a, drag, T, dt, nsteps, device=None):
     """ Langevin dynamics with Velocity-Verlet.
     Batched version: compute multiple trajectories in parallel
     This function mutates the position (x) and velocity(v) arrays.
@@ -19,8 +22,11 @@ def vvel_lng_batch(x, v, a, drag, T, dt, nsteps, device="cuda"):
     v: (batch, coorddim)                  [L/T]
     drag: (coorddim,)                     [/T]
     a: (-1, coorddim) -> (-1, coorddim)   [L/TT]
+    device defaults to the device of x.
     return = x:(batch, coorddim), v:(batch, coorddim)"""
     assert nsteps >= 1
+    if device is None:
+        device = x.device
     assert x.shape == v.shape and drag.shape == x.shape[1:]
     assert x.dtype == torch.float64 and v.dtype == torch.float64
     sqrt_hlf = 0.5**0.5
@@ -46,7 +52,7 @@ class TrajectorySim:
         t_res : time resolution, number of individual simulation steps per delta_t
         metadata: dict of additional useful information about the simulation """
         self.acc_fn = acc_fn
-        self.drag = drag.to("cuda")
+        self.drag = drag.to(DEVICE)
         self.T = T
         self.delta_t = delta_t
         self.t_res = t_res
@@ -64,12 +70,13 @@ class TrajectorySim:
             v_traj: (batch, time, self.dim) """
         batch,          must_be[self.dim] = x.shape
         must_be[batch], must_be[self.dim] = v.shape
-        x_traj = torch.zeros((batch, time, self.dim), device="cuda", dtype=torch.float64)
-        v_traj = torch.zeros((batch, time, self.dim), device="cuda", dtype=torch.float64)
-        for i in range(time):
-            vvel_lng_batch(x, v, self.acc_fn, self.drag, self.T, self.dt, self.t_res)
-            x_traj[:, i] = x
-            v_traj[:, i] = v
+        x_traj = torch.zeros((batch, time, self.dim), device=x.device, dtype=torch.float64)
+        v_traj = torch.zeros((batch, time, self.dim), device=x.device, dtype=torch.float64)
+        with TIMERS.phase("simulation", batch*time*self.t_res): # count simulation steps for each trajectory
+            for i in range(time):
+                vvel_lng_batch(x, v, self.acc_fn, self.drag, self.T, self.dt, self.t_res)
+                x_traj[:, i] = x
+                v_traj[:, i] = v
         return x_traj, v_traj
     def sample_equilibrium(self, batch, iterations, t_noise=None, t_ballistic=None,
             drag_const=20.): # TODO: come up with a better way to pick the drag constant?
@@ -81,8 +88,8 @@ class TrajectorySim:
         high_drag = torch.zeros_like(self.drag) + drag_const
         zero_drag = torch.zeros_like(self.drag)
         # start from 0:
-        x = torch.zeros((batch,) + self.drag.shape, dtype=torch.float64, device="cuda")
-        v = torch.zeros((batch,) + self.drag.shape, dtype=torch.float64, device="cuda")
+        x = torch.zeros((batch,) + self.drag.shape, dtype=torch.float64, device=self.drag.device)
+        v = torch.zeros((batch,) + self.drag.shape, dtype=torch.float64, device=self.drag.device)
         # do several iterations:
         for i in range(iterations):
             vvel_lng_batch(x, v, self.acc_fn, high_drag, self.T, self.dt, int(t_noise/self.dt))
@@ -165,7 +172,7 @@ for t in [3, 10, 30, 100, 300]:
       torch.tensor([10.], dtype=torch.float64), 1.0,
       float(t), 32*t,
     )
-  for l in [2, 5, 12, 24, 36, 48]:
+  for l in [2, 5, 12, 24, 36, 48, 96]:
     sims["ou_poly_l%d_t%d" % (l, t)] = TrajectorySim(
         get_polymer_a(1.0, l, dim=1),
         torch.tensor([10.]*l, dtype=torch.float64), 1.0,
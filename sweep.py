@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import time
+import queue
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import torch
+
+from config import Config, makenew
+from checkpointing import atomic_save, load_training
+from utils import available_cores, split_cores, pin_to_cores
+
+
+# Run a grid of training runs in parallel, one process per run.
+# Usage from a training script (the __main__ guard is required, since worker processes re-import the script):
+#
+#   if __name__ == "__main__":
+#     run_sweep([(save_path, Config(...)), ...], "models/my_sweep.sweep.json")
+
+
+QUEUED  = "queued"
+RUNNING = "running"
+DONE    = "done"
+FAILED  = "failed"
+
+
+def data_cache_path(save_path):
+  return save_path[:-3] + ".data_cache.pt"
+
+
+def job_cost(config):
+  """ rough estimate of how expensive a training run is, used to start the slowest runs first """
+  nsteps = max(config.nsteps) if isinstance(config.nsteps, list) else config.nsteps
+  return nsteps*config.batch*config.simlen*config.sim.dim
+
+
+_started_queue = None # worker processes report the jobs they start on this queue
+
+def _worker_init(core_queue, started_queue, threads_per_job):
+  """ runs once in each worker process: pin it to its own cores and set its thread budget """
+  global _started_queue
+  _started_queue = started_queue
+  pin_to_cores(core_queue.get())
+  torch.set_num_threads(threads_per_job)
+
+
+def _prefetch_init():
+  torch.set_num_threads(1)
+
+
+def _run_job(save_path, config_args, config_kwargs, resume):
+  """ worker process: train a single model, console output goes to a log file next to the model """
+  from train import train # import here so that the pool's children don't all import tensorboard up front
+  if _started_queue is not None:
+    _started_queue.put(save_path)
+  stdout = sys.stdout
+  with open(save_path[:-3] + ".log", "a") as log:
+    sys.stdout = log
+    try:
+      if resume:
+        model, resume_state = load_training(save_path)
+      else:
+        model, resume_state = makenew(Config(*config_args, **config_kwargs)), None
+      initial_chunks = []
+      cache_path = data_cache_path(save_path)
+      if os.path.exists(cache_path):
+        initial_chunks = torch.load(cache_path)
+        os.remove(cache_path)
+      train(model, save_path, resume_state, initial_chunks)
+    finally:
+      sys.stdout = stdout
+  return save_path
+
+
+def can_resume(save_path, config_args, config_kwargs):
+  """ is there a checkpoint at save_path with training state, from a run with this config? """
+  if not os.path.exists(save_path):
+    return False
+  data = torch.load(save_path, weights_only=False)
+  return "training" in data and data["args"] == config_args and data["kwargs"] == config_kwargs
+
+
+def _prefetch_job(save_path, config_args, config_kwargs, n_chunks):
+  """ prefetch process: generate the first few chunks of training data for a queued job """
+  from train import generate_chunk
+  config = Config(*config_args, **config_kwargs)
+  chunks = [generate_chunk(config) for _ in range(n_chunks)]
+  atomic_save(chunks, data_cache_path(save_path))
+  return save_path
+
+
+class SweepState:
+  """ records the status of each job in a json file, so an interrupted sweep can be restarted """
+  def __init__(self, path, save_paths):
+    self.path = path
+    self.status = {save_path: QUEUED for save_path in save_paths}
+    if os.path.exists(path):
+      with open(path) as f:
+        old_status = json.load(f)
+      for save_path in self.status:
+        if save_path in old_status:
+          self.status[save_path] = old_status[save_path]
+  def set(self, save_path, status):
+    self.status[save_path] = status
+    tmp_path = self.path + ".tmp"
+    with open(tmp_path, "w") as f:
+      json.dump(self.status, f, indent=2)
+    os.replace(tmp_path, self.path)
+  def count(self, status):
+    return sum(1 for val in self.status.values() if val == status)
+
+
+def run_sweep(jobs, state_path, n_procs=None, threads_per_job=None, prefetch_chunks=2):
+  """ run many training runs concurrently on a process pool.
+      jobs: list of (save_path, Config) pairs
+      state_path: json file tracking progress. if the sweep is interrupted, calling run_sweep
+        again with the same arguments skips finished jobs and resumes interrupted ones from
+        their last checkpoint.
+      n_procs: number of runs to train at once (default: as many as there are cores, up to len(jobs))
+      threads_per_job: torch threads per run, each worker is pinned to this many cores
+      prefetch_chunks: chunks of training data (see train.generate_chunk) to generate in
+        advance for each queued job, while the other jobs train. 0 to disable. """
+  n_cores = len(available_cores())
+  if n_procs is None:
+    n_procs = max(1, min(len(jobs), n_cores // (threads_per_job or 1)))
+  if threads_per_job is None:
+    threads_per_job = max(1, n_cores // n_procs)
+  if n_procs*threads_per_job > n_cores: # each worker gets its own cores, so we can't run more than fit
+    threads_per_job = min(threads_per_job, n_cores)
+    print("sweep: only %d cores, running %d processes instead of %d" % (n_cores, n_cores // threads_per_job, n_procs))
+    n_procs = n_cores // threads_per_job
+  jobs = sorted(jobs, key=(lambda job: job_cost(job[1])), reverse=True) # start the slowest runs first
+  state = SweepState(state_path, [save_path for save_path, _ in jobs])
+  todo = []
+  for save_path, config in jobs:
+    if state.status[save_path] == DONE and os.path.exists(save_path):
+      continue
+    args, kwargs = config.get_args_and_kwargs()
+    todo.append((save_path, args, kwargs, can_resume(save_path, args, kwargs)))
+    state.set(save_path, QUEUED)
+  print("sweep: %d jobs, %d already done, %d processes x %d threads" % (
+    len(jobs), len(jobs) - len(todo), n_procs, threads_per_job))
+  ctx = multiprocessing.get_context("spawn") # fork is not safe once CUDA has been initialized
+  core_queue = ctx.Queue()
+  started_queue = ctx.Queue()
+  for cores in split_cores(n_procs, threads_per_job):
+    core_queue.put(cores)
+  t_start = time.time()
+  with ProcessPoolExecutor(n_procs, mp_context=ctx, initializer=_worker_init,
+                           initargs=(core_queue, started_queue, threads_per_job)) as pool, \
+       ProcessPoolExecutor(1, mp_context=ctx, initializer=_prefetch_init) as prefetch_pool:
+    # jobs that won't start right away get their data generated in advance:
+    if prefetch_chunks > 0:
+      for save_path, args, kwargs, resume in todo[n_procs:]:
+        if not resume:
+          prefetch_pool.submit(_prefetch_job, save_path, args, kwargs, prefetch_chunks)
+    futures = {}
+    for save_path, args, kwargs, resume in todo:
+      futures[pool.submit(_run_job, save_path, args, kwargs, resume)] = save_path
+    running = set(futures)
+    while running:
+      finished, running = wait(running, timeout=1., return_when=FIRST_COMPLETED)
+      while True: # jobs that workers have started (the pool may hand out jobs before a worker is free for them)
+        try:
+          save_path = started_queue.get_nowait()
+        except queue.Empty:
+          break
+        if state.status[save_path] == QUEUED:
+          state.set(save_path, RUNNING)
+      if len(finished) == 0:
+        continue
+      for future in finished:
+        save_path = futures[future]
+        if future.exception() is None:
+          state.set(save_path, DONE)
+        else:
+          state.set(save_path, FAILED)
+          print("sweep: job %s failed: %r" % (save_path, future.exception()))
+      print("sweep: %d/%d done, %d failed, %.0f s elapsed" % (
+        state.count(DONE), len(jobs), state.count(FAILED), time.time() - t_start))
+    prefetch_pool.shutdown(cancel_futures=True)
+  for save_path, *_ in todo: # prefetched data for a job that had already started by the time it was ready
+    if os.path.exists(data_cache_path(save_path)):
+      os.remove(data_cache_path(save_path))
@@ -5,6 +5,7 @@ import matplotlib.pyplot as plt
 from utils import must_be
 from config import load
 from sims import equilibrium_sample, get_dataset
+from precision import autocast
 from plotting_common import Plotter, basis_transform_coords, basis_transform_rouse, basis_transform_neighbours, basis_transform_neighbours2, basis_transform_neighbours4
 
 
@@ -53,9 +54,9 @@ def get_sample_step(model):
   """ given a model and current state, predict the next state """
   model.set_eval(True)
   def sample_step(state):
-    with torch.no_grad():
+    with torch.no_grad(), autocast(model.config):
       state_fin = model.predict(model.config.cond(state))
-    return state_fin
+    return state_fin.to(torch.float32)
   return sample_step
 
 
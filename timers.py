@@ -0,0 +1,151 @@
+import os
+import time
+import resource
+from threading import Lock, local
+from contextlib import contextmanager
+
+import torch
+
+
+# Cheap, always-on timers for the phases of training. Code in the hot paths records how long it spent in
+# each phase with TIMERS.phase(name), which only costs a couple of calls to time.perf_counter(). train.train()
+# logs the timings to the run's tensorboard every TIMER_LOG_EVERY steps (time/<phase>, in seconds per
+# training step), together with the simulation speed and memory usage, and prints a summary at the end.
+# Phases:
+#   data        main thread waiting for the simulation thread to provide a batch
+#   simulation  generating trajectories (on the simulation thread, so this overlaps with the others)
+#   train_step  the whole of model.train_step()
+#   forward     forward passes of the model's modules
+#   optim       optimizer steps (including gradient averaging for data-parallel training)
+#   backward    rest of train_step: backward passes and computing losses from module outputs
+#   checkpoint  main thread's part of saving a checkpoint
+# Timings are host wall clock times. On GPU, this means they measure how long the host waits rather than
+# how long the kernels take, but the data phase still tells us whether a run is limited by simulation speed.
+# forward and optim are only timed for uncompiled models, for compiled ones they're counted as backward.
+
+
+TIMER_LOG_EVERY = 64 # steps
+DATA_BOUND_FRACTION = 0.1 # runs that wait for data more than this fraction of the time are simulation-bound
+
+
+class PhaseTimers:
+  """ accumulates total time spent in each phase, both for the whole run and for the current logging window """
+  def __init__(self):
+    self.lock = Lock()
+    self.starts = local() # start times of forward passes, per thread
+    self.reset()
+  def reset(self):
+    with self.lock:
+      self.totals, self.counts = {}, {}
+      self.window_totals, self.window_counts = {}, {}
+      self.start_time = self.window_start_time = time.perf_counter()
+      self.steps = self.window_steps = 0
+  @contextmanager
+  def phase(self, name, count=1):
+    """ time a block of code as part of phase name. count is the amount of work done, eg. simulation steps """
+    t0 = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.add(name, time.perf_counter() - t0, count)
+  def add(self, name, seconds, count=1):
+    with self.lock:
+      for totals, counts in [(self.totals, self.counts), (self.window_totals, self.window_counts)]:
+        totals[name] = totals.get(name, 0.) + seconds
+        counts[name] = counts.get(name, 0) + count
+  def step(self):
+    """ call once per training step """
+    self.steps += 1
+    self.window_steps += 1
+  def log(self, board, i, device):
+    """ log timings for the current window to board, then start a new window """
+    with self.lock:
+      totals, counts = with_derived(self.window_totals), self.window_counts
+      nsteps, wall = max(1, self.window_steps), time.perf_counter() - self.window_start_time
+      self.window_totals, self.window_counts = {}, {}
+      self.window_start_time = time.perf_counter()
+      self.window_steps = 0
+    for name in totals:
+      board.scalar("time/" + name, i, totals[name]/nsteps)
+    board.scalar("time/wall", i, wall/nsteps)
+    if totals.get("simulation", 0.) > 0.:
+      board.scalar("sim/steps_per_s", i, counts["simulation"]/totals["simulation"])
+    current, peak = memory_usage(device)
+    board.scalar("memory/current_MB", i, current)
+    board.scalar("memory/peak_MB", i, peak)
+  def summary(self, device):
+    """ table of the time spent in each phase over the whole run """
+    with self.lock:
+      totals, counts = with_derived(self.totals), dict(self.counts)
+      nsteps, wall = max(1, self.steps), time.perf_counter() - self.start_time
+    ans = ["%-12s %12s %14s %12s" % ("phase", "total [s]", "per step [ms]", "% of wall")]
+    for name in sorted(totals, key=totals.get, reverse=True):
+      ans.append("%-12s %12.2f %14.2f %12.1f" % (name, totals[name], 1000*totals[name]/nsteps, 100*totals[name]/wall))
+    ans.append("%-12s %12.2f %14.2f %12.1f" % ("wall", wall, 1000*wall/nsteps, 100.))
+    if totals.get("simulation", 0.) > 0.:
+      ans.append("simulation speed: %.4g steps/s" % (counts["simulation"]/totals["simulation"]))
+    current, peak = memory_usage(device)
+    ans.append("memory: %.1f MB current, %.1f MB peak" % (current, peak))
+    data_fraction = totals.get("data", 0.)/wall
+    if data_fraction > DATA_BOUND_FRACTION:
+      ans.append("simulation-bound: waited for data %.1f%% of the time" % (100*data_fraction))
+    else:
+      ans.append("model-bound: waited for data %.1f%% of the time" % (100*data_fraction))
+    return "\n".join(ans)
+  def forward_pre_hook(self, module, args):
+    self.starts.__dict__[id(module)] = time.perf_counter()
+  def forward_hook(self, module, args, output):
+    t0 = self.starts.__dict__.pop(id(module), None)
+    if t0 is not None:
+      self.add("forward", time.perf_counter() - t0)
+  def optim_pre_hook(self, optimizer, args, kwargs):
+    self.starts.__dict__[id(optimizer)] = time.perf_counter()
+  def optim_post_hook(self, optimizer, args, kwargs):
+    t0 = self.starts.__dict__.pop(id(optimizer), None)
+    if t0 is not None:
+      self.add("optim", time.perf_counter() - t0)
+
+
+TIMERS = PhaseTimers()
+
+
+def with_derived(totals):
+  """ add derived phases to a dict of phase totals """
+  ans = dict(totals)
+  if "train_step" in ans:
+    ans["backward"] = max(0., ans["train_step"] - ans.get("forward", 0.) - ans.get("optim", 0.))
+  return ans
+
+
+def memory_usage(device):
+  """ current and peak memory usage in MB: memory allocated by pytorch for cuda devices, otherwise the
+      resident set size of the process """
+  if torch.device(device).type == "cuda":
+    return torch.cuda.memory_allocated(device)/2**20, torch.cuda.max_memory_allocated(device)/2**20
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10 # linux reports this in kB
+  try:
+    with open("/proc/self/statm") as f:
+      current = int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")/2**20
+  except OSError:
+    current = peak
+  return current, max(current, peak)
+
+
+def instrument(model):
+  """ time train_step of model, and (if model is not compiled) the forward passes of its modules and
+      steps of its optimizers """
+  train_step = model.train_step
+  def timed_train_step(*args, **kwargs):
+    with TIMERS.phase("train_step"):
+      return train_step(*args, **kwargs)
+  model.train_step = timed_train_step
+  if model.config.compile_mode != "none":
+    return
+  owner = getattr(model, "lead", model) # ensembles keep their modules and optimizers in the lead model
+  for val in vars(owner).values():
+    if isinstance(val, torch.nn.Module):
+      val.register_forward_pre_hook(TIMERS.forward_pre_hook)
+      val.register_forward_hook(TIMERS.forward_hook)
+    if isinstance(val, torch.optim.Optimizer):
+      val.register_step_pre_hook(TIMERS.optim_pre_hook)
+      val.register_step_post_hook(TIMERS.optim_post_hook)
@@ -3,32 +3,53 @@ from threading import Thread
 from queue import Queue
 
 import torch
+from torch.profiler import record_function
 
-from run_visualization import TensorBoard
+from run_visualization import DummyTensorBoard
+from metrics import Metrics
 from sims import equilibrium_sample, get_dataset
-from config import Config, load, save, makenew
+from config import Config, load, makenew
+from checkpointing import CheckpointWriter, training_state, restore_training_state, load_training
+from distributed import get_rank, get_world_size, local_batch, split_rng, any_rank, average_buffers
+from precision import autocast
+from compiling import compile_model
+from profiling import profiler
+from timers import TIMERS, TIMER_LOG_EVERY, instrument
+from evaluation import Evaluator
 
 
-def dataset_gen(config):
+def generate_chunk(config, batch=None):
+  """ generate a chunk of trajectories, enough for 128 training batches (default batch size is config.batch) """
+  if batch is None: batch = config.batch
+  xv_init = equilibrium_sample(config, 128*batch)
+  return get_dataset(config, xv_init, config.simlen).to(config.device, torch.float32)
+
+
+def dataset_gen(config, initial_chunks=(), batch=None):
   """ generate many datasets in a separate thread
       one should use the send() method for controlling this generator, calling
-      send(True) if more data will be required and send(False) otherwise """
+      send(True) if more data will be required and send(False) otherwise
+      initial_chunks: chunks from generate_chunk() that were prepared in advance, these are used up first
+      batch: batch size to use, default is config.batch """
+  if batch is None: batch = config.batch
   data_queue = Queue(maxsize=32) # we set a maxsize to control the number of items taking up memory on GPU
   control_queue = Queue()
+  initial_chunks = list(initial_chunks)
   def thread_main():
     while True: # queue maxsize stops us from going crazy here
-      xv_init = equilibrium_sample(config, 128*config.batch)
-      next_dataset = get_dataset(config, xv_init, config.simlen).to(torch.float32)
-      for i in range(0, 128*config.batch, config.batch):
+      with record_function("simulation"):
+        next_dataset = initial_chunks.pop(0) if initial_chunks else generate_chunk(config, batch)
+      for i in range(0, next_dataset.shape[0], batch):
         if not control_queue.empty():
           command = control_queue.get_nowait()
           if command == "halt":
             return
-        data_queue.put(next_dataset[i:i+config.batch])
-  t = Thread(target=thread_main)
+        data_queue.put(next_dataset[i:i+batch])
+  t = Thread(target=thread_main, daemon=True) # daemon, so a thread blocked on a full queue can't keep the process alive
   t.start()
   while True:
-    data = data_queue.get()
+    with TIMERS.phase("data"):
+      data = data_queue.get()
     halt = yield data # "keep going" is encoded as None, since python requires the first send() to be passed a None anyway
     if halt is not None:
       control_queue.put("halt")
@@ -36,42 +57,109 @@ def dataset_gen(config):
       break
 
 
-def train(model, save_path):
+def train(model, save_path, resume_state=None, initial_chunks=()):
+  """ train model, saving checkpoints to save_path. if resume_state is given (see
+      checkpointing.training_state), continue an interrupted run from where it stopped.
+      initial_chunks are passed on to dataset_gen()
+      for data-parallel training (see distributed.py), this is called on every rank. each rank trains
+      on its share of config.batch, and only rank 0 logs to tensorboard and saves checkpoints. """
   assert save_path.split(".")[-1] == "pt", "expected pytorch .pt file suffix"
   run_name = ".".join(save_path.split("/")[-1].split(".")[:-1])
   print(run_name)
   print(model.config)
-  board = TensorBoard(run_name)
+  rank = get_rank()
+  board = Metrics(run_name) if rank == 0 else DummyTensorBoard()
   config = model.config # configuration for this run...
-  data_generator = dataset_gen(config)
+  data_generator = dataset_gen(config, initial_chunks, local_batch(config))
   trainer = config.trainerclass(model, board)
+  compile_model(model, config.compile_mode)
+  TIMERS.reset()
+  instrument(model)
   if isinstance(config.nsteps, list):
     nsteps = max(config.nsteps)
     checkpoints = [ns for ns in config.nsteps if ns < nsteps]
   else:
     nsteps = config.nsteps
     checkpoints = []
-  for i in itertools.count():
-    trajs = data_generator.send(None if i < nsteps else True)
-    if trajs is None: break
-    trainer.step(i, trajs) # main training step
-    if (i + 1) % config.save_every == 0:
-      print("\nsaving...")
-      save(model, save_path)
-      if i + 1 in checkpoints:
-        save(model, save_path[:-3] + ".chkp_" + str(i + 1) + ".pt")
-      # checkpoint
-      print("saved.\n")
+  ensemble = hasattr(model, "replicas") # ensembles are saved as one checkpoint per replica
+  start = 0
+  if resume_state is not None:
+    assert not ensemble, "resuming ensemble training is not supported"
+    start = restore_training_state(model, trainer, resume_state)
+    print("resuming from step %d" % start)
+  if get_world_size() > 1:
+    split_rng() # ranks must not all generate the same data
+  writer = CheckpointWriter()
+  evaluator = None
+  if config.early_stopping != "none":
+    assert not ensemble, "early stopping of ensemble training is not supported"
+    if rank == 0:
+      evaluator = Evaluator(model) # evaluates checkpoints in a separate process, see evaluation.py
+  stopping = False
+  with profiler(model, run_name, rank) as prof:
+    for i in itertools.count(start):
+      with record_function("data"):
+        trajs = data_generator.send(None if i < nsteps and not stopping else True)
+      if trajs is None: break
+      with autocast(config):
+        trainer.step(i, trajs) # main training step
+      if (i + 1) % config.save_every == 0 and config.early_stopping != "none":
+        stopping = any_rank(evaluator is not None and evaluator.should_stop(board))
+        if stopping and i + 1 < nsteps:
+          print("\nstopping early at step %d.\n" % (i + 1))
+          if hasattr(trainer, "finish"):
+            trainer.finish()
+      if (i + 1) % config.save_every == 0:
+        average_buffers(model) # so that rank 0's checkpoint has the batch norm stats of all ranks
+      if (i + 1) % config.save_every == 0 and rank == 0:
+        with record_function("checkpoint"), TIMERS.phase("checkpoint"):
+          if ensemble:
+            for replica, replica_path in zip(model.replicas(), model.replica_paths(save_path)):
+              aliases = [replica_path[:-3] + ".chkp_" + str(i + 1) + ".pt"] if i + 1 in checkpoints else []
+              writer.submit(replica, replica_path, aliases)
+          else:
+            aliases = [save_path[:-3] + ".chkp_" + str(i + 1) + ".pt"] if i + 1 in checkpoints else []
+            writer.submit(model, save_path, aliases, # written to disk in the background
+              extra={"training": training_state(model, trainer, i + 1)},
+              on_written=(None if evaluator is None else evaluator.submit(i + 1)))
+        print("\nqueued checkpoint.\n")
+      prof.step()
+      TIMERS.step()
+      if (i + 1) % TIMER_LOG_EVERY == 0:
+        TIMERS.log(board, i, config.device)
+  if hasattr(model, "close"): # eg. background processes for training diagnostics
+    model.close()
+  print(TIMERS.summary(config.device))
+  print("waiting for checkpoints to be written...")
+  writer.close()
+  print("saved.")
+  if evaluator is not None:
+    evaluator.close(board) # logs the evaluation of the last checkpoint
+  board.close()
+
+
+def training_run(save_path, src, resume=False):
+  """ src is a Config for a new model, or a path to start from a saved model.
+      resume=True continues training the saved model with its optimizer state,
+      learning rate schedule, step count and RNG states. """
+  model, resume_state = load_source(src, resume)
+  train(model, save_path, resume_state)
 
 
-def training_run(save_path, src):
+def load_source(src, resume=False):
+  """ get the model (and training state, if resuming) for training_run() """
+  resume_state = None
   if isinstance(src, Config): # create new from config
+    assert not resume, "can only resume from a saved model"
     model = makenew(src)
   elif isinstance(src, str): # load from path
-    model = load(src)
+    if resume:
+      model, resume_state = load_training(src)
+    else:
+      model = load(src)
   else:
     raise TypeError("incorrect source for training run!")
-  train(model, save_path)
+  return model, resume_state
 
 
 
@@ -4,7 +4,7 @@ import sys
 sys.path.append("/home/phillip/projects/torchenv/src/koopman")
 
 from config import Config, Condition
-from train import training_run
+from sweep import run_sweep
 
 
 SIMTYPE = "3d_ou_poly"
@@ -16,6 +16,7 @@ T_LIST = [30]#[3, 10, 30, 100, 300]
 NSTEPS_LIST = [1024, 2048, 4096, 8192, 16384, 32768, 65536]
 
 
+jobs = []
 if "gan" in ARCH:
   arch_specific = {
     "lr_d": 0.001,  "lr_d_fac": 0.995,
@@ -33,12 +34,12 @@ if "gan" in ARCH:
   for l in L_LIST:
     for t in T_LIST:
       sim_name = SIMTYPE + "_l%d_t%d" % (l, t)
-      training_run("models/%s_%s.%s.pt" % (RUN_ID, sim_name, ARCH),
+      jobs.append(("models/%s_%s.%s.pt" % (RUN_ID, sim_name, ARCH),
         Config(sim_name, ARCH,
           cond=Condition.COORDS, x_only=True,
           batch=8, simlen=6, t_eql=4,
           nsteps=NSTEPS_LIST, save_every=512,
-          arch_specific=arch_specific))
+          arch_specific=arch_specific)))
 elif "meanpred" in ARCH:
   arch_specific = {
     "lr": 0.0008,
@@ -50,13 +51,12 @@ elif "meanpred" in ARCH:
   for l in L_LIST:
     for t in T_LIST:
       sim_name = SIMTYPE + "_l%d_t%d" % (l, t)
-      training_run("models/%s_%s.%s.pt" % (RUN_ID, sim_name, ARCH),
+      jobs.append(("models/%s_%s.%s.pt" % (RUN_ID, sim_name, ARCH),
         Config(sim_name, ARCH,
           cond=Condition.COORDS, x_only=False,
           batch=8, simlen=6, t_eql=4,
           nsteps=65536, save_every=512,
-          arch_specific=arch_specific))
-
-
-
+          arch_specific=arch_specific)))
 
+if __name__ == "__main__":
+  run_sweep(jobs, "models/%s.%s.sweep.json" % (RUN_ID, ARCH))
@@ -4,7 +4,7 @@ import sys
 sys.path.append("/home/phillip/projects/torchenv/src/koopman")
 
 from config import Config, Condition
-from train import training_run
+from sweep import run_sweep
 
 
 SIMTYPE = "3d_quart_ou_poly"
@@ -22,15 +22,19 @@ arch_specific = {
   "z_scale": 10.,
 }
 
+jobs = []
 for l in L_LIST:
   for t in T_LIST:
     sim_name = SIMTYPE + "_l%d_t%d" % (l, t)
-    training_run("models/%s_%s.%s.pt" % (RUN_ID, sim_name, ARCH),
+    jobs.append(("models/%s_%s.%s.pt" % (RUN_ID, sim_name, ARCH),
       Config(sim_name, ARCH,
         cond=Condition.COORDS, x_only=True,
         batch=8, simlen=6, t_eql=4,
         nsteps=65536, save_every=512,
-        arch_specific=arch_specific))
+        arch_specific=arch_specific)))
+
+if __name__ == "__main__":
+  run_sweep(jobs, "models/%s.%s.sweep.json" % (RUN_ID, ARCH))
 
 
 
@@ -4,14 +4,15 @@ import sys
 sys.path.append("/home/phillip/projects/torchenv/src/koopman")
 
 from config import Config, Condition
-from train import training_run
+from sweep import run_sweep
 
 L_LIST = [12, 24, 36, 48]
 T_LIST = [3, 10, 30, 100]
 
+jobs = []
 for l in L_LIST:
   for t in T_LIST:
-    training_run("models/5_ou_poly_l%d_t%d.vampnet1.pt" % (l, t),
+    jobs.append(("models/5_ou_poly_l%d_t%d.vampnet1.pt" % (l, t),
       Config("ou_poly_l%d_t%d" % (l, t), "vampnet1",
         cond=Condition.COORDS, x_only=True, subtract_mean=1,
         batch=1024, simlen=16, t_eql=4,
@@ -21,7 +22,10 @@ for l in L_LIST:
           "beta_1": 0.5, "beta_2": 0.99,
           "nf": 96, "outdim": 20,
           "tuning_batches": 32,
-        }))
+        })))
+
+if __name__ == "__main__":
+  run_sweep(jobs, "models/5_ou_poly.vampnet1.sweep.json")
 
 
 
@@ -1,3 +1,5 @@
+import os
+
 import torch
 
 
@@ -55,3 +57,21 @@ def batched_model_eval(model, input, outdim, batch=16384):
   return ans
 
 
+# core affinity, for running several training processes side by side (see sweep.py, distributed.py):
+
+def available_cores():
+  if hasattr(os, "sched_getaffinity"):
+    return sorted(os.sched_getaffinity(0))
+  return list(range(os.cpu_count()))
+
+def split_cores(n_procs, threads_per_job):
+  """ divide the cores available to us into disjoint sets, one per process """
+  cores = available_cores()
+  assert n_procs*threads_per_job <= len(cores), "%d processes x %d threads needs more than the %d available cores" % (
+    n_procs, threads_per_job, len(cores))
+  return [cores[i*threads_per_job:][:threads_per_job] for i in range(n_procs)]
+
+def pin_to_cores(cores):
+  """ restrict the current process to cores, where the OS supports it """
+  if hasattr(os, "sched_setaffinity"):
+    os.sched_setaffinity(0, cores)